@@ -97,7 +97,7 @@ if [[ $cont == y* ]]; then
 	echo "Error: expected data/ directory" >&2
 	exit 1
     fi
-    tar --exclude="*.pkl" --exclude="*.2bit" -hczf $data data
+    tar --exclude="*.pkl" --exclude="*.db" --exclude="*.2bit" -hczf $data data
 fi
 
 # Tarball manuscript results
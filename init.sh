@@ -18,7 +18,8 @@ else
 fi
 
 
-# Maximum number of threads to use
+# Maximum number of threads to use (including to decompress bgzip'd
+# data files and VCFs)
 export SILVA_N_THREADS="${SILVA_N_THREADS:-8}"
 # Path to the root of the SilVA directory.
 export SILVA_PATH="${SILVA_PATH:-$(cd -P $(dirname $0); pwd)}"
@@ -37,6 +38,10 @@ export TMPDIR="${TMPDIR:-$(pwd)}"
 export SILVA_AF_MIN="${SILVA_AF_MIN:-0}"
 export SILVA_AF_MAX="${SILVA_AF_MAX:-0.05}"
 
+# Number of VCF records silva-preprocess streams through the pipeline at
+# a time. Set to 0 to instead run each step over the whole VCF in turn.
+export SILVA_CHUNK_SIZE="${SILVA_CHUNK_SIZE:-10000}"
+
 # Used to initialize the logging sensitivity of the python logger
 # Set to "DEBUG" for more logs, "WARNING" for fewer
 export SILVA_LOG_LEVEL="${SILVA_LOG_LEVEL:-INFO}"
@@ -56,6 +61,7 @@ SILVA_CONTROL:   '$SILVA_CONTROL'
 SILVA_TRAINED:   '$SILVA_TRAINED'
 SILVA_AF_MIN:    '$SILVA_AF_MIN'
 SILVA_AF_MAX:    '$SILVA_AF_MAX'
+SILVA_CHUNK_SIZE: '$SILVA_CHUNK_SIZE'
 SILVA_LOG_LEVEL: '$SILVA_LOG_LEVEL'
 TMPDIR:          '$TMPDIR'
 -----------
@@ -1,5 +1,6 @@
 from __future__ import with_statement, division
 
+import os
 import sys
 
 from datetime import datetime
@@ -8,7 +9,18 @@ from contextlib import closing
 
 
 def maybe_gzip_open(filename, *args, **kwargs):
+    """Open filename, which is gzip'd if it ends in .gz, or stdin if '-'
+
+    BGZF files opened for reading are decompressed in parallel with up to
+    SILVA_N_THREADS threads (see silva.bgzf).
+    """
     if filename.endswith('.gz'):
+        mode = kwargs.get('mode', args[0] if args else 'rb')
+        n_threads = int(os.getenv('SILVA_N_THREADS', 1))
+        if 'r' in mode and n_threads > 1:
+            from silva.bgzf import BgzfReader, is_bgzf
+            if is_bgzf(filename):
+                return BgzfReader(filename, n_threads=n_threads)
         return closing(_gzip_open(filename, *args, **kwargs))
     elif filename == '-':
         return sys.stdin
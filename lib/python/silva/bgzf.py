@@ -0,0 +1,188 @@
+"""
+Multithreaded reader for BGZF files (blocked gzip, as written by bgzip).
+
+A BGZF file is a series of gzip members, each holding at most 64KB of data
+and recording its own compressed size in the header, so blocks can be split
+off without inflating them and then inflated independently. A reader thread
+reads batches of blocks and hands them to a pool of worker threads (zlib
+releases the GIL while inflating), keeping a bounded queue of batches ahead
+of the consumer, so reading and decompression overlap with parsing.
+"""
+
+from __future__ import with_statement, division
+
+import zlib
+import threading
+
+from struct import unpack
+from Queue import Queue
+from multiprocessing.pool import ThreadPool
+
+# gzip magic, deflate, and FEXTRA flag (required for the BSIZE field)
+BGZF_MAGIC = '\x1f\x8b\x08\x04'
+# Blocks inflated together by one worker
+BLOCKS_PER_BATCH = 16
+# Batches queued ahead of the consumer
+READ_AHEAD = 32
+
+
+def _block_size(header, extra):
+    """Return total size of a BGZF block, given its 12-byte header and
+    extra field, or None if it has no BSIZE subfield"""
+    i = 0
+    while i + 4 <= len(extra):
+        slen = unpack('<H', extra[i + 2:i + 4])[0]
+        if extra[i:i + 2] == 'BC' and slen == 2:
+            return unpack('<H', extra[i + 4:i + 6])[0] + 1
+        i += 4 + slen
+    return None
+
+def is_bgzf(filename):
+    """Return whether filename starts with a BGZF block"""
+    with open(filename, 'rb') as ifp:
+        header = ifp.read(12)
+        if len(header) < 12 or header[:4] != BGZF_MAGIC:
+            return False
+        xlen = unpack('<H', header[10:12])[0]
+        return _block_size(header, ifp.read(xlen)) is not None
+
+def read_block(ifp):
+    """Return next raw BGZF block from ifp, or None at end of file"""
+    header = ifp.read(12)
+    if not header:
+        return None
+    if len(header) < 12 or header[:4] != BGZF_MAGIC:
+        raise IOError("Invalid BGZF block header")
+    xlen = unpack('<H', header[10:12])[0]
+    extra = ifp.read(xlen)
+    size = _block_size(header, extra)
+    if size is None:
+        raise IOError("BGZF block without BSIZE field")
+    rest = ifp.read(size - 12 - xlen)
+    if len(rest) < size - 12 - xlen:
+        raise IOError("Truncated BGZF block")
+    return header + extra + rest
+
+def inflate_block(block):
+    """Return data of a raw BGZF block, checking its CRC and size"""
+    xlen = unpack('<H', block[10:12])[0]
+    crc, size = unpack('<II', block[-8:])
+    data = zlib.decompress(block[12 + xlen:-8], -15)
+    if len(data) != size or zlib.crc32(data) & 0xffffffff != crc:
+        raise IOError("BGZF block failed CRC or size check")
+    return data
+
+def inflate_batch(blocks):
+    return ''.join([inflate_block(block) for block in blocks])
+
+
+class BgzfReader(object):
+    """Read-only file-like object for a BGZF file, decompressed in
+    parallel by n_threads worker threads"""
+    def __init__(self, filename, n_threads=2, read_ahead=READ_AHEAD):
+        self.name = filename
+        self.closed = False
+        self._raw = open(filename, 'rb')
+        self._pool = ThreadPool(n_threads)
+        self._queue = Queue(maxsize=read_ahead)
+        self._eof = False
+        # Decompressed data not yet returned: complete lines (in reverse
+        # order, to be popped) and then a partial line
+        self._lines = []
+        self._buffer = ''
+        self._reader = threading.Thread(target=self._read_batches)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def _read_batches(self):
+        """Queue pending decompressions of batches of blocks, in order"""
+        try:
+            while not self.closed:
+                batch = []
+                while len(batch) < BLOCKS_PER_BATCH:
+                    block = read_block(self._raw)
+                    if block is None:
+                        break
+                    batch.append(block)
+                if not batch:
+                    break
+                self._queue.put(self._pool.apply_async(inflate_batch,
+                                                       (batch,)))
+        except Exception, e:
+            self._queue.put(e)
+        self._queue.put(None)
+
+    def _next_chunk(self):
+        """Return next non-empty decompressed chunk, or '' at end of file"""
+        while not self._eof:
+            item = self._queue.get()
+            if item is None:
+                self._eof = True
+            elif isinstance(item, Exception):
+                self._eof = True
+                raise item
+            else:
+                chunk = item.get()
+                if chunk:
+                    return chunk
+        return ''
+
+    def readline(self):
+        while not self._lines:
+            chunk = self._next_chunk()
+            if not chunk:
+                line, self._buffer = self._buffer, ''
+                return line
+            lines = (self._buffer + chunk).split('\n')
+            self._buffer = lines.pop()
+            self._lines = [line + '\n' for line in reversed(lines)]
+        return self._lines.pop()
+
+    def read(self, size=-1):
+        data = [''.join(reversed(self._lines)), self._buffer]
+        self._lines = []
+        self._buffer = ''
+        n_read = sum([len(chunk) for chunk in data])
+        while size < 0 or n_read < size:
+            chunk = self._next_chunk()
+            if not chunk:
+                break
+            data.append(chunk)
+            n_read += len(chunk)
+
+        data = ''.join(data)
+        if size >= 0:
+            data, self._buffer = data[:size], data[size:]
+        return data
+
+    def readlines(self):
+        return list(self)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        # Unblock and wait for the reader thread
+        while not self._eof:
+            item = self._queue.get()
+            if item is None or isinstance(item, Exception):
+                self._eof = True
+        self._reader.join()
+        # Let workers finish any queued batches and exit, without waiting
+        self._pool.close()
+        self._raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
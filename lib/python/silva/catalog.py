@@ -0,0 +1,95 @@
+"""
+Persistent catalog of sites (e.g. all possible synonymous SNVs) grouped by
+transcript.
+
+Each attribute of the sites is a column array, with the sites of
+transcript i in offsets[i]:offsets[i+1] of every column. The catalog is
+saved to a directory of numpy arrays and memory-mapped on load, so the
+sites of a transcript are a slice of each column and a filter over them
+(e.g. CpG status) is a single array operation.
+"""
+
+from __future__ import with_statement, division
+
+import os
+import shutil
+
+from numpy import array, asarray, load, save, cumsum, concatenate, int64
+
+
+class SiteCatalog(object):
+    """Sites of each transcript: transcript id -> dict of column arrays
+
+    Built with SiteCatalog.build(...) and saved to and loaded from a
+    directory of memory-mapped numpy arrays with save() and load().
+    """
+    def __init__(self, offsets, columns):
+        """columns: dict: name -> array, with the sites of transcript i in
+        offsets[i]:offsets[i+1]"""
+        self.offsets = offsets
+        self.columns = columns
+
+    @classmethod
+    def build(cls, sites, dtypes):
+        """Build catalog from sites, an iterable with an item for every
+        transcript, in order, which is a dict: column name -> array (one
+        entry per site of the transcript)
+
+        dtypes is a dict: column name -> dtype of the stored column.
+        """
+        parts = dict([(name, []) for name in dtypes])
+        counts = []
+        for tx_sites in sites:
+            n_sites = None
+            for name, dtype in dtypes.iteritems():
+                values = asarray(tx_sites[name]).astype(dtype)
+                assert n_sites is None or len(values) == n_sites, \
+                    "Columns differ in length: %s" % name
+                n_sites = len(values)
+                parts[name].append(values)
+            counts.append(n_sites or 0)
+
+        offsets = concatenate([[0], cumsum(counts)]).astype(int64)
+        columns = dict([(name, concatenate(parts[name] or
+                                           [array([], dtype=dtype)]))
+                        for name, dtype in dtypes.iteritems()])
+        return cls(offsets, columns)
+
+    def save(self, dirname):
+        """Save catalog to the directory dirname (created atomically)"""
+        tmpdir = '%s.tmp%d' % (dirname.rstrip('/'), os.getpid())
+        os.makedirs(tmpdir)
+        try:
+            save(os.path.join(tmpdir, 'offsets.npy'), self.offsets)
+            for name, values in self.columns.iteritems():
+                save(os.path.join(tmpdir, '%s.npy' % name), values)
+            os.rename(tmpdir, dirname)
+        except:
+            # Leave no partial directory behind
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            raise
+
+    @classmethod
+    def load(cls, dirname):
+        """Load (memory-mapped) catalog saved to the directory dirname"""
+        columns = {}
+        for filename in os.listdir(dirname):
+            name, ext = os.path.splitext(filename)
+            if ext == '.npy':
+                columns[name] = load(os.path.join(dirname, filename),
+                                     mmap_mode='r')
+        offsets = columns.pop('offsets')
+        return cls(offsets, columns)
+
+    def __len__(self):
+        """Return number of transcripts"""
+        return len(self.offsets) - 1
+
+    def n_sites(self):
+        return int(self.offsets[-1])
+
+    def sites(self, i):
+        """Return dict: column name -> array of the sites of transcript i"""
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return dict([(name, values[start:end])
+                     for name, values in self.columns.iteritems()])
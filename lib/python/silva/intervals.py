@@ -0,0 +1,129 @@
+"""
+Persistent overlap index over closed, 1-indexed intervals [start, end].
+
+For each chromosome, intervals are sorted by start and stored alongside the
+running maximum of their ends. The intervals containing a position are then
+found among a contiguous run of candidates bounded by two binary searches:
+every interval before the first running maximum >= pos ends before pos, and
+every interval after the last start <= pos starts after it. Long intervals
+are stored once, rather than duplicated into every bin they span.
+"""
+
+from __future__ import with_statement, division
+
+import os
+import shutil
+
+from numpy import array, asarray, arange, cumsum, maximum, lexsort, load, \
+    save, unique, int64
+
+
+class IntervalIndex(object):
+    """Overlap index: chrom, pos -> ids of intervals containing pos
+
+    Built with IntervalIndex.build(...) and saved to and loaded from a
+    directory of memory-mapped numpy arrays with save() and load().
+    """
+    COLUMNS = ['names', 'offsets', 'starts', 'ends', 'max_ends', 'ids']
+
+    def __init__(self, names, offsets, starts, ends, max_ends, ids):
+        """All intervals, sorted by chromosome and then start
+
+        Intervals on chromosome names[i] are those in
+        offsets[i]:offsets[i+1], and max_ends is the running maximum of
+        ends within each chromosome.
+        """
+        self.names = names
+        self.offsets = offsets
+        self.starts = starts
+        self.ends = ends
+        self.max_ends = max_ends
+        self.ids = ids
+        self._chroms = dict([(str(name), i)
+                             for i, name in enumerate(names.tolist())])
+
+    @classmethod
+    def build(cls, chroms, starts, ends, ids=None):
+        """Build index of intervals [starts[i], ends[i]] on chroms[i]
+
+        ids default to the positions of the intervals in the input
+        """
+        starts = asarray(starts, dtype=int64)
+        ends = asarray(ends, dtype=int64)
+        if ids is None:
+            ids = arange(len(starts), dtype=int64)
+        else:
+            ids = asarray(ids, dtype=int64)
+
+        names, codes = unique(asarray(chroms, dtype=str), return_inverse=True)
+        order = lexsort((ids, starts, codes))
+        codes = codes[order]
+        starts = starts[order]
+        ends = ends[order]
+        ids = ids[order]
+        offsets = codes.searchsorted(arange(len(names) + 1))
+        max_ends = ends.copy()
+        for i in xrange(len(names)):
+            chrom_ends = max_ends[offsets[i]:offsets[i + 1]]
+            maximum.accumulate(chrom_ends, out=chrom_ends)
+
+        return cls(names, offsets.astype(int64), starts, ends, max_ends, ids)
+
+    def save(self, dirname):
+        """Save index to the directory dirname (created atomically)"""
+        tmpdir = '%s.tmp%d' % (dirname.rstrip('/'), os.getpid())
+        os.makedirs(tmpdir)
+        try:
+            for col in self.COLUMNS:
+                save(os.path.join(tmpdir, '%s.npy' % col), getattr(self, col))
+            os.rename(tmpdir, dirname)
+        except:
+            # Leave no partial directory behind
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            raise
+
+    @classmethod
+    def load(cls, dirname):
+        """Load (memory-mapped) index saved to the directory dirname"""
+        return cls(*[load(os.path.join(dirname, '%s.npy' % col),
+                          mmap_mode='r')
+                     for col in cls.COLUMNS])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _chrom_slice(self, chrom):
+        i = self._chroms[chrom]
+        return slice(self.offsets[i], self.offsets[i + 1])
+
+    def query_batch(self, chrom, positions):
+        """Find the intervals on chrom containing each of positions
+
+        Returns (which, ids) arrays, such that interval ids[k] contains
+        positions[which[k]], grouped by position in input order (and by
+        start within a position). Positions need not be sorted, but sorted
+        positions (e.g. a chunk of a sorted VCF) make the lookups cheaper.
+        """
+        positions = asarray(positions, dtype=int64)
+        try:
+            chrom_slice = self._chrom_slice(chrom)
+        except KeyError:
+            empty = array([], dtype=int64)
+            return empty, empty
+
+        starts = self.starts[chrom_slice]
+        max_ends = self.max_ends[chrom_slice]
+        # Candidates for positions[k] are in [los[k], his[k])
+        his = starts.searchsorted(positions, 'right')
+        los = max_ends.searchsorted(positions, 'left')
+        counts = maximum(his - los, 0)
+        which = arange(len(positions)).repeat(counts)
+        firsts = (cumsum(counts) - counts).repeat(counts)
+        candidates = arange(counts.sum()) - firsts + los.repeat(counts)
+        candidates += chrom_slice.start
+        hits = self.ends[candidates] >= positions[which]
+        return which[hits], self.ids[candidates[hits]]
+
+    def query(self, chrom, pos):
+        """Return array of the ids of intervals on chrom containing pos"""
+        return self.query_batch(chrom, [pos])[1]
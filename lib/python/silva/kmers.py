@@ -0,0 +1,148 @@
+"""
+Fast matching of sequences against a fixed set of k-mers.
+
+Sequences are encoded 2 bits per nucleotide, and the code of every window
+is computed at once with k shift-and-or array operations (a vectorized rolling
+hash), then looked up in a bitmap over all 4^k codes. No string is created
+per window, and many sequences can be matched in a single pass by joining
+them with an invalid separator (see encode).
+"""
+
+from __future__ import with_statement, division
+
+from numpy import array, zeros, frombuffer, bincount, arange, flatnonzero, \
+    maximum, int8, uint8, uint16, uint32, uint64, int64
+
+NUCS = 'ACGT'
+# Lookup table: byte -> index into NUCS (or -1)
+NUC_CODES = zeros(256, dtype=int8) - 1
+for i, nuc in enumerate(NUCS):
+    NUC_CODES[ord(nuc)] = i
+del i, nuc
+
+
+def nuc_codes(seq):
+    """Return array of the NUCS index of each nucleotide in seq (-1 for
+    invalid ones, including lowercase)"""
+    return NUC_CODES[frombuffer(seq, dtype=uint8)]
+
+def encode(seqs):
+    """Return (codes, ids) arrays for the concatenation of seqs
+
+    codes are the NUCS indices of each nucleotide (-1 for invalid ones),
+    with a -1 separating consecutive sequences, so no valid window spans
+    two of them. ids are the index in seqs of each code.
+    """
+    if not seqs:
+        return array([], dtype=int8), array([], dtype=int64)
+    codes = nuc_codes('N'.join(seqs) + 'N')
+    lengths = array([len(seq) + 1 for seq in seqs], dtype=int64)
+    ids = arange(len(seqs)).repeat(lengths)
+    return codes, ids
+
+
+class KmerSet(object):
+    """Set of k-mers, stored as a bitmap over their 2-bit codes"""
+    def __init__(self, kmers, k=None):
+        kmers = list(kmers)
+        if k is None:
+            k = len(kmers[0]) if kmers else 0
+        self.k = k
+        # Smallest unsigned type that fits a 2-bit code of k nucleotides
+        for dtype in [uint8, uint16, uint32, uint64]:
+            if 2 * k <= dtype().itemsize * 8:
+                break
+        self.dtype = dtype
+        self.bitmap = zeros(4 ** k, dtype=bool)
+        for kmer in kmers:
+            assert len(kmer) == k, "Expected %d-mer: %s" % (k, kmer)
+            code = self.code(kmer)
+            if code is None:
+                raise KeyError("Invalid nucleotide in k-mer: %s" % kmer)
+            self.bitmap[code] = True
+
+    def __len__(self):
+        return int(self.bitmap.sum())
+
+    def __contains__(self, kmer):
+        if len(kmer) != self.k:
+            return False
+        code = self.code(kmer)
+        return code is not None and bool(self.bitmap[code])
+
+    def __iter__(self):
+        for code in flatnonzero(self.bitmap).tolist():
+            yield self.kmer(code)
+
+    def code(self, kmer):
+        """Return 2-bit code of kmer, or None if it is not all ACGT"""
+        code = 0
+        for nuc in kmer:
+            value = NUC_CODES[ord(nuc)]
+            if value < 0:
+                return None
+            code = (code << 2) | int(value)
+        return code
+
+    def kmer(self, code):
+        """Return k-mer with 2-bit code"""
+        return ''.join([NUCS[(code >> (2 * (self.k - i - 1))) & 3]
+                        for i in xrange(self.k)])
+
+    def match(self, codes):
+        """Return boolean array: whether the window starting at each of
+        codes (as returned by encode) is in the set"""
+        k = self.k
+        n_windows = len(codes) - k + 1
+        found = zeros(len(codes), dtype=bool)
+        if n_windows <= 0:
+            return found
+
+        invalid = flatnonzero(codes < 0)
+        window_codes = zeros(n_windows, dtype=self.dtype)
+        codes = maximum(codes, 0).astype(self.dtype)
+        for i in xrange(k):
+            window_codes <<= 2
+            window_codes |= codes[i:i + n_windows]
+
+        found[:n_windows] = self.bitmap[window_codes]
+        # Invalid nucleotides are rare (e.g. sequence separators), so
+        # unset the windows containing them directly
+        for i in xrange(k):
+            found[maximum(invalid - i, 0)] = False
+        return found
+
+    def count(self, seqs, encoded=None):
+        """Return array of the number of matching windows in each of seqs
+
+        encoded is the result of encode(seqs), if already computed.
+        """
+        codes, ids = encode(seqs) if encoded is None else encoded
+        return bincount(ids[self.match(codes)], minlength=len(seqs))
+
+    def positions(self, seq):
+        """Return list of the offsets of matching windows in seq"""
+        codes, ids = encode([seq])
+        return flatnonzero(self.match(codes)).tolist()
+
+    def find(self, seq):
+        """Return dict: pos -> k-mer found in seq"""
+        k = self.k
+        return dict([(pos, seq[pos:pos + k]) for pos in self.positions(seq)])
+
+    def count_changes(self, old_seqs, new_seqs, encoded=None):
+        """Return (lost, gained) arrays: the number of windows of each of
+        old_seqs that match and do not in the corresponding new_seqs, and
+        vice versa. Each new sequence must be the same length as the old.
+
+        encoded is (encode(old_seqs), encode(new_seqs)), if already computed.
+        """
+        if encoded is None:
+            encoded = (encode(old_seqs), encode(new_seqs))
+        (old_codes, ids), (new_codes, new_ids) = encoded
+        assert len(old_codes) == len(new_codes), \
+            "Old and new sequences differ in length"
+        old = self.match(old_codes)
+        new = self.match(new_codes)
+        return (bincount(ids[old & ~new], minlength=len(old_seqs)),
+                bincount(ids[new & ~old], minlength=len(old_seqs)))
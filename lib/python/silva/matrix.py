@@ -0,0 +1,212 @@
+"""
+Binary feature matrices (.smat), and parsing of text ones (.mat, .input).
+
+A .smat file holds a matrix of float64 values in row-major order after a
+small header, so it is written a chunk of rows at a time and read back
+memory-mapped, without any parsing. All values are little-endian:
+
+  8 bytes   magic: 'SILVAMAT'
+  int32     format version
+  int32     length of the column names (including padding)
+  int32     number of rows
+  int32     number of columns
+  names     tab-separated column names, padded with spaces so the data
+            start on an 8-byte boundary
+  data      float64 values, one row after another
+
+lib/R/smat.R reads the same format from R.
+"""
+
+from __future__ import with_statement, division
+
+import os
+
+from struct import pack, unpack
+from numpy import array, asarray, fromstring, concatenate, memmap, \
+    zeros, dtype as _dtype
+
+MAGIC = 'SILVAMAT'
+VERSION = 1
+HEADER_FORMAT = '<8siiii'
+HEADER_SIZE = 24
+DTYPE = _dtype('<f8')
+# Rows of a text matrix parsed or printed at a time
+CHUNK_SIZE = 10000
+
+
+def is_smat(filename):
+    """Return whether filename is a binary matrix file"""
+    with open(filename, 'rb') as ifp:
+        return ifp.read(len(MAGIC)) == MAGIC
+
+def _read_header(ifp):
+    """Return (columns, nrows, data offset) from the start of ifp"""
+    header = ifp.read(HEADER_SIZE)
+    if len(header) < HEADER_SIZE or not header.startswith(MAGIC):
+        raise IOError("Not a binary matrix file: %s" % ifp.name)
+    magic, version, names_size, nrows, ncols = unpack(HEADER_FORMAT, header)
+    if version != VERSION:
+        raise IOError("Unsupported matrix format version %d: %s"
+                      % (version, ifp.name))
+    columns = ifp.read(names_size).rstrip(' ').split('\t')
+    assert len(columns) == ncols, \
+        "Expected %d column names in %s" % (ncols, ifp.name)
+    return columns, nrows, HEADER_SIZE + names_size
+
+
+class MatrixWriter(object):
+    """Write a binary matrix file, a chunk of rows at a time
+
+    The file is created atomically when the writer is closed.
+    """
+    def __init__(self, filename, columns):
+        self.filename = filename
+        self.columns = list(columns)
+        self.nrows = 0
+        self._tmp_filename = '%s.tmp%d' % (filename, os.getpid())
+        self._ofp = open(self._tmp_filename, 'wb')
+        self._write_header()
+
+    def _write_header(self):
+        names = '\t'.join(self.columns)
+        names += ' ' * (-(HEADER_SIZE + len(names)) % DTYPE.itemsize)
+        self._ofp.write(pack(HEADER_FORMAT, MAGIC, VERSION, len(names),
+                             self.nrows, len(self.columns)))
+        self._ofp.write(names)
+
+    def write(self, mat):
+        """Append the rows of 2D array mat"""
+        mat = asarray(mat, dtype=DTYPE)
+        assert mat.ndim == 2 and mat.shape[1] == len(self.columns), \
+            "Expected rows of %d columns" % len(self.columns)
+        self._ofp.write(mat.tostring())
+        self.nrows += mat.shape[0]
+
+    def close(self):
+        if self._ofp is None:
+            return
+        # Record the final number of rows
+        self._ofp.seek(0)
+        self._write_header()
+        self._ofp.close()
+        self._ofp = None
+        os.rename(self._tmp_filename, self.filename)
+
+    def abort(self):
+        """Close and remove the partial file"""
+        if self._ofp is None:
+            return
+        self._ofp.close()
+        self._ofp = None
+        os.remove(self._tmp_filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def load(filename):
+    """Return (columns, data) of binary matrix file, with data a read-only
+    memory-mapped array of shape (rows, columns)"""
+    with open(filename, 'rb') as ifp:
+        columns, nrows, offset = _read_header(ifp)
+    if nrows == 0:
+        return columns, zeros((0, len(columns)), dtype=DTYPE)
+    return columns, memmap(filename, dtype=DTYPE, mode='r', offset=offset,
+                           shape=(nrows, len(columns)))
+
+def merge(filenames, filename):
+    """Concatenate binary matrix files, which must have the same columns"""
+    columns = load(filenames[0])[0] if filenames else []
+    with MatrixWriter(filename, columns) as writer:
+        for part in filenames:
+            columns, data = load(part)
+            assert columns == writer.columns, \
+                "Column mismatch in %s" % part
+            writer.write(data)
+
+
+def read_header(ifp):
+    """Return (header, class_col) from the first line of a text matrix"""
+    header = ifp.readline().strip()
+    assert header.startswith('#')
+    header = header.replace('#', '')
+
+    # Find class column
+    cols = header.split()
+    if cols and cols[0] == 'class':
+        class_col = 0
+    else:
+        class_col = None
+
+    return header, class_col
+
+def parse_rows(lines, ncols, filename):
+    """Return 2D float array of the rows of values in lines"""
+    # Every row must have ncols tab-separated values, or values would be
+    # shifted between rows by the reshape
+    n_tabs = ncols - 1
+    values = None
+    if all([line.count('\t') == n_tabs for line in lines]):
+        values = fromstring(' '.join(lines), dtype=float, sep=' ')
+    if values is None or len(values) != len(lines) * ncols:
+        # Bad row (or not tab-separated): parse row by row to report it
+        rows = []
+        for line in lines:
+            tokens = [float(val) for val in line.split()]
+            assert ncols == len(tokens), \
+                "Found row in %s with %d columns (%d expected)" % (filename, len(tokens), ncols)
+            rows.append(tokens)
+        return array(rows, dtype=float)
+
+    return values.reshape((len(lines), ncols))
+
+def iter_chunks(ifp, filename, chunk_size=CHUNK_SIZE):
+    """Yield 2D float arrays of up to chunk_size rows of the rest of ifp"""
+    ncols = None
+    lines = []
+    for line in ifp:
+        line = line.strip()
+        if not line: continue
+
+        assert not line.startswith('#')
+        if ncols is None:
+            ncols = len(line.split())
+        lines.append(line)
+        if len(lines) >= chunk_size:
+            yield parse_rows(lines, ncols, filename)
+            lines = []
+
+    if lines:
+        yield parse_rows(lines, ncols, filename)
+
+def read_matrix(filename):
+    """Return (columns, data) of a binary or text matrix file"""
+    if is_smat(filename):
+        return load(filename)
+
+    with open(filename) as ifp:
+        header, class_col = read_header(ifp)
+        chunks = list(iter_chunks(ifp, filename))
+
+    columns = header.split()
+    if chunks:
+        data = concatenate(chunks)
+    else:
+        data = zeros((0, len(columns)), dtype=float)
+    return columns, data
+
+def export_text(filename, out):
+    """Print binary matrix file as text, as written by standardize.py"""
+    columns, data = load(filename)
+    fields = ['%d' if col == 'class' else '%.4f' for col in columns]
+    fmt = '\t'.join(fields)
+    print >>out, '#%s' % '\t'.join(columns)
+    for start in xrange(0, len(data), CHUNK_SIZE):
+        for row in data[start:start + CHUNK_SIZE].tolist():
+            print >>out, fmt % tuple(row)
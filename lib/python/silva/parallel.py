@@ -0,0 +1,47 @@
+"""
+Order-preserving parallel map over a pool of worker processes.
+"""
+
+from __future__ import with_statement, division
+
+from collections import deque
+from multiprocessing import Pool
+
+
+def imap_ordered(func, iterable, n_jobs=1, initializer=None, initargs=(),
+                 max_pending=None):
+    """Yield func(item) for each item of iterable, in order
+
+    Items are processed by a pool of n_jobs processes, each set up with
+    initializer(*initargs). At most max_pending (default: 2 * n_jobs) items
+    are submitted ahead of the results consumed, so iterable is read
+    lazily and memory use is bounded. With n_jobs <= 1, everything runs in
+    this process.
+    """
+    if n_jobs <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for item in iterable:
+            yield func(item)
+        return
+
+    if max_pending is None:
+        max_pending = 2 * n_jobs
+
+    pool = Pool(n_jobs, initializer, initargs)
+    completed = False
+    try:
+        pending = deque()
+        for item in iterable:
+            pending.append(pool.apply_async(func, (item,)))
+            if len(pending) >= max_pending:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        completed = True
+    finally:
+        if completed:
+            pool.close()
+            pool.join()
+        else:
+            pool.terminate()
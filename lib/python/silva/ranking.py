@@ -0,0 +1,53 @@
+"""
+Tie-aware ranking of scores, in place of scipy.stats.rankdata.
+
+Values are ranked with one stable argsort, and each run of equal values in
+sorted order is given the mean of the ranks it spans, so ranking takes
+O(n log n) array operations with no Python loop over the values. NaN
+values sort after all others and are never tied with each other.
+"""
+
+from __future__ import with_statement, division
+
+from numpy import asarray, concatenate, cumsum, empty, flatnonzero, \
+    isnan, where, float64
+
+
+def rankdata(values):
+    """Return array of the 1-based ranks of values (lowest first), with
+    tied values given the mean of their ranks"""
+    values = asarray(values)
+    n = len(values)
+    ranks = empty(n, dtype=float64)
+    if not n:
+        return ranks
+
+    order = values.argsort(kind='mergesort')
+    sorted_values = values[order]
+    # Start of each run of equal values, and the run of each value
+    is_start = concatenate([[True], sorted_values[1:] != sorted_values[:-1]])
+    starts = flatnonzero(is_start)
+    ends = concatenate([starts[1:], [n]])
+    runs = cumsum(is_start) - 1
+    # A run from start to end (exclusive) spans ranks start+1 to end
+    ranks[order] = ((starts + 1 + ends) / 2)[runs]
+    return ranks
+
+def rank_against(values, reference):
+    """Return array of the rank each of values would have among the
+    reference values, as rankdata(concatenate([[value], reference]))[0]"""
+    values = asarray(values, dtype=float64)
+    reference = asarray(reference, dtype=float64)
+    reference = reference[~isnan(reference)]
+    reference.sort()
+    below = reference.searchsorted(values, side='left')
+    ties = reference.searchsorted(values, side='right') - below
+    ranks = below + (ties + 2) / 2
+    # NaN ranks after all other values, and before any NaN in reference
+    return where(isnan(values), len(reference) + 1, ranks)
+
+def mean_reciprocal_rank(ranks):
+    """Return the mean reciprocal rank of each row of 2D array ranks (one
+    column per ranking)"""
+    ranks = asarray(ranks, dtype=float64)
+    return (1 / ranks).sum(axis=1) / ranks.shape[1]
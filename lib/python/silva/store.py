@@ -0,0 +1,219 @@
+"""
+Persistent store of float values keyed by chromosome and position.
+
+For each chromosome, keys (positions, or integers derived from them) are
+stored in sorted order alongside their values (as float32), all in one
+pair of arrays with per-chromosome offsets. The store is saved to a
+directory of numpy arrays and memory-mapped on load, and batches of keys
+are looked up with binary searches, so only the pages holding the queried
+keys are ever read. A store may also carry a Bloom filter over its keys,
+which rejects most absent keys before the sorted keys are searched at all.
+"""
+
+from __future__ import with_statement, division
+
+import os
+import shutil
+
+from array import array as _array
+from numpy import array, asarray, arange, zeros, ones, concatenate, load, \
+    save, bitwise_or, int64, uint8, uint64, float32
+
+
+class BloomFilter(object):
+    """Bloom filter over uint64 keys, stored as an array of bits
+
+    Bit positions are derived from two multiplicative hashes of each key
+    (by double hashing), so all keys are added or tested at once.
+    """
+    MULTIPLIERS = [0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F]
+
+    def __init__(self, bits, n_hashes):
+        """bits: uint8 array whose length is a power of 2"""
+        self.bits = bits
+        self.n_hashes = n_hashes
+        self._log_bits = 0
+        while (1 << self._log_bits) < len(bits) * 8:
+            self._log_bits += 1
+        assert len(bits) * 8 == 1 << self._log_bits
+
+    @classmethod
+    def build(cls, keys, bits_per_key=10, n_hashes=6):
+        n_bits = 64
+        while n_bits < len(keys) * bits_per_key:
+            n_bits *= 2
+        bloom = cls(zeros(n_bits // 8, dtype=uint8), n_hashes)
+        bloom.add(keys)
+        return bloom
+
+    def _indices(self, keys):
+        """Yield arrays of the bit positions of keys, for each hash"""
+        keys = asarray(keys).astype(uint64)
+        shift = uint64(64 - self._log_bits)
+        h1, h2 = [(keys * uint64(m)) >> shift for m in self.MULTIPLIERS]
+        h2 |= uint64(1)
+        mask = uint64((1 << self._log_bits) - 1)
+        for i in xrange(self.n_hashes):
+            yield (h1 + uint64(i) * h2) & mask
+
+    def add(self, keys):
+        for indices in self._indices(keys):
+            bitwise_or.at(self.bits, indices >> uint64(3),
+                          (uint8(1) << (indices & uint64(7)).astype(uint8)))
+
+    def contains(self, keys):
+        """Return boolean array: whether each key may be in the filter"""
+        found = ones(len(keys), dtype=bool)
+        for indices in self._indices(keys):
+            found &= (self.bits[indices >> uint64(3)] >>
+                      (indices & uint64(7)).astype(uint8)) & 1 == 1
+        return found
+
+
+class PositionStore(object):
+    """Sorted store: chrom, key -> value
+
+    Built with PositionStore.build(...) and saved to and loaded from a
+    directory of memory-mapped numpy arrays with save() and load().
+    """
+    COLUMNS = ['names', 'offsets', 'keys', 'values']
+    BLOOM_FILENAME = 'bloom.npy'
+    # Bits and hashes of the Bloom filter, for about a 1% false positive rate
+    BLOOM_BITS_PER_KEY = 10
+    BLOOM_HASHES = 6
+
+    def __init__(self, names, offsets, keys, values, bloom=None):
+        """Keys on chromosome names[i] are in keys[offsets[i]:offsets[i+1]],
+        sorted and unique, with values in the same places of values
+
+        bloom is an optional BloomFilter of the salted keys (see _salt).
+        """
+        self.names = names
+        self.offsets = offsets
+        self.keys = keys
+        self.values = values
+        self.bloom = bloom
+        self._chroms = dict([(str(name), i)
+                             for i, name in enumerate(names.tolist())])
+
+    @classmethod
+    def build(cls, data, key_dtype=int64, bloom=False):
+        """Build store from dict: chrom -> (keys, values)
+
+        Keys and values may be any sequences of equal length (such as
+        array.array, to keep a large table compact while it is read). If a
+        key occurs more than once on a chromosome, its last value is kept.
+        If bloom, a Bloom filter of the keys is built too.
+        """
+        names = sorted(data)
+        all_keys = []
+        all_values = []
+        offsets = [0]
+        for name in names:
+            keys, values = data[name]
+            keys = asarray(keys).astype(key_dtype)
+            values = asarray(values).astype(float32)
+            assert len(keys) == len(values)
+            order = keys.argsort(kind='mergesort')
+            keys = keys[order]
+            # Last of each run of equal keys (the sort is stable)
+            last = concatenate([keys[1:] != keys[:-1], [True]])
+            all_keys.append(keys[last])
+            all_values.append(values[order][last])
+            offsets.append(offsets[-1] + int(last.sum()))
+
+        store = cls(array(names, dtype=str),
+                    array(offsets, dtype=int64),
+                    concatenate(all_keys or [array([], dtype=key_dtype)]),
+                    concatenate(all_values or [array([], dtype=float32)]))
+        if bloom:
+            store.bloom = BloomFilter.build(
+                concatenate([store._salt(i, store._chrom_keys(i))
+                             for i in xrange(len(names))] or [[]]),
+                bits_per_key=cls.BLOOM_BITS_PER_KEY,
+                n_hashes=cls.BLOOM_HASHES)
+        return store
+
+    def save(self, dirname):
+        """Save store to the directory dirname (created atomically)"""
+        tmpdir = '%s.tmp%d' % (dirname.rstrip('/'), os.getpid())
+        os.makedirs(tmpdir)
+        try:
+            for col in self.COLUMNS:
+                save(os.path.join(tmpdir, '%s.npy' % col), getattr(self, col))
+            if self.bloom is not None:
+                save(os.path.join(tmpdir, self.BLOOM_FILENAME),
+                     self.bloom.bits)
+            os.rename(tmpdir, dirname)
+        except:
+            # Leave no partial directory behind
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            raise
+
+    @classmethod
+    def load(cls, dirname):
+        """Load (memory-mapped) store saved to the directory dirname"""
+        store = cls(*[load(os.path.join(dirname, '%s.npy' % col),
+                           mmap_mode='r')
+                      for col in cls.COLUMNS])
+        bloom_filename = os.path.join(dirname, cls.BLOOM_FILENAME)
+        if os.path.isfile(bloom_filename):
+            # The filter is read in full: it is small and accessed randomly
+            store.bloom = BloomFilter(load(bloom_filename), cls.BLOOM_HASHES)
+        return store
+
+    def __len__(self):
+        return len(self.keys)
+
+    def chroms(self):
+        return self._chroms.keys()
+
+    def _chrom_keys(self, i):
+        return self.keys[self.offsets[i]:self.offsets[i + 1]]
+
+    def _salt(self, i, keys):
+        """Return keys of chromosome i, made distinct across chromosomes
+        for the Bloom filter"""
+        salt = ((i + 1) * 0xD6E8FEB86659FD93) & 0xFFFFFFFFFFFFFFFF
+        return asarray(keys).astype(uint64) ^ uint64(salt)
+
+    def lookup_batch(self, chrom, keys):
+        """Look up each of keys on chrom
+
+        Returns (found, values) arrays, where found[k] is whether keys[k]
+        is in the store and values[k] is its value (0 if not found).
+        """
+        keys = asarray(keys).astype(self.keys.dtype)
+        found = zeros(len(keys), dtype=bool)
+        values = zeros(len(keys), dtype=float32)
+        try:
+            i = self._chroms[chrom]
+        except KeyError:
+            return found, values
+
+        start, end = self.offsets[i], self.offsets[i + 1]
+        if start == end:
+            return found, values
+
+        queries = arange(len(keys))
+        if self.bloom is not None:
+            queries = queries[self.bloom.contains(self._salt(i, keys))]
+
+        chrom_keys = self.keys[start:end]
+        indices = chrom_keys.searchsorted(keys[queries])
+        indices[indices == end - start] = 0
+        hits = chrom_keys[indices] == keys[queries]
+        found[queries[hits]] = True
+        values[queries[hits]] = self.values[start + indices[hits]]
+        return found, values
+
+    def lookup(self, chrom, key):
+        """Return value of key on chrom, or None if not found"""
+        found, values = self.lookup_batch(chrom, [key])
+        return float(values[0]) if found[0] else None
+
+
+def new_columns(key_typecode='l'):
+    """Return empty (keys, values) arrays to accumulate a chromosome of
+    data for PositionStore.build, using little memory per entry"""
+    return _array(key_typecode), _array('f')
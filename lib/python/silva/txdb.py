@@ -0,0 +1,143 @@
+"""
+On-disk transcript database.
+
+A database is a directory of numpy arrays, one per coordinate column, plus
+a single blob holding the (transcript-strand) pre-mRNA sequence of every
+transcript back to back. All arrays are memory-mapped on open, so only the
+pages belonging to transcripts that are actually looked up are ever read.
+"""
+
+from __future__ import with_statement, division
+
+import os
+import sys
+import shutil
+
+from mmap import mmap, ACCESS_READ
+from numpy import array, load, save, cumsum, concatenate, int32, int64
+
+STRING_COLUMNS = ['gene', 'tx', 'chrom', 'strand']
+INT_COLUMNS = ['tx_start', 'tx_end', 'cds_start', 'cds_end']
+# Flattened exon coordinates; transcript i owns entries
+# exon_index[i]:exon_index[i+1]
+EXON_COLUMNS = ['exon_starts', 'exon_ends']
+SEQ_FILENAME = 'premrna.seq'
+
+
+def write_db(dirname, transcripts):
+    """Write a database to the directory dirname
+
+    transcripts: iterable of (record, premrna), where record is a dict with
+    STRING_COLUMNS, INT_COLUMNS and EXON_COLUMNS keys (as accepted by
+    synonymous.Transcript) and premrna is the transcript-strand sequence.
+
+    The database is written to a temporary directory and moved into place
+    once complete, so an interrupted or failed build never leaves a partial
+    database.
+    """
+    tmpdir = '%s.tmp%d' % (dirname.rstrip('/'), os.getpid())
+    os.makedirs(tmpdir)
+    try:
+        columns = dict([(col, []) for col in STRING_COLUMNS + INT_COLUMNS])
+        exon_starts = []
+        exon_ends = []
+        exon_counts = []
+        seq_lengths = []
+        with open(os.path.join(tmpdir, SEQ_FILENAME), 'wb') as ofp:
+            for record, premrna in transcripts:
+                for col in STRING_COLUMNS:
+                    columns[col].append(record[col])
+                for col in INT_COLUMNS:
+                    columns[col].append(int(record[col]))
+                starts = [int(x) for x in record['exon_starts']]
+                ends = [int(x) for x in record['exon_ends']]
+                assert len(starts) == len(ends)
+                exon_starts.extend(starts)
+                exon_ends.extend(ends)
+                exon_counts.append(len(starts))
+                seq_lengths.append(len(premrna))
+                ofp.write(premrna)
+
+        def save_column(name, values):
+            save(os.path.join(tmpdir, '%s.npy' % name), values)
+
+        for col in STRING_COLUMNS:
+            save_column(col, array(columns[col], dtype=str))
+        for col in INT_COLUMNS:
+            save_column(col, array(columns[col], dtype=int32))
+        save_column('exon_starts', array(exon_starts, dtype=int32))
+        save_column('exon_ends', array(exon_ends, dtype=int32))
+        save_column('exon_index',
+                    concatenate([[0], cumsum(exon_counts)]).astype(int64))
+        save_column('seq_index',
+                    concatenate([[0], cumsum(seq_lengths)]).astype(int64))
+        os.rename(tmpdir, dirname)
+    except:
+        # Leave no partial database behind
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        raise
+
+
+class TranscriptDB(object):
+    """Read-only, memory-mapped transcript database written by write_db
+
+    Transcripts are identified by their index, in [0, len(db)). Coordinate
+    columns are available as arrays (e.g. db.cds_start), and individual
+    transcripts are read with record(i) and premrna(i).
+    """
+    def __init__(self, dirname):
+        self.dirname = dirname
+        for col in STRING_COLUMNS + INT_COLUMNS + EXON_COLUMNS + \
+                ['exon_index', 'seq_index']:
+            setattr(self, col, self._load_column(col))
+
+        seq_filename = os.path.join(dirname, SEQ_FILENAME)
+        if os.path.getsize(seq_filename) > 0:
+            with open(seq_filename, 'rb') as ifp:
+                self._seqs = mmap(ifp.fileno(), 0, access=ACCESS_READ)
+        else:
+            self._seqs = ''
+
+        self._gene_index = None
+
+    def _load_column(self, name):
+        filename = os.path.join(self.dirname, '%s.npy' % name)
+        if not os.path.isfile(filename):
+            raise IOError("Transcript database %s is missing %s. Please"
+                          " remove it so it can be rebuilt."
+                          % (self.dirname, filename))
+        return load(filename, mmap_mode='r')
+
+    def __len__(self):
+        return len(self.tx)
+
+    def record(self, i):
+        """Return dict of the coordinates of transcript i"""
+        record = dict([(col, str(getattr(self, col)[i]))
+                       for col in STRING_COLUMNS])
+        for col in INT_COLUMNS:
+            record[col] = int(getattr(self, col)[i])
+        start, end = self.exon_index[i], self.exon_index[i + 1]
+        record['exon_starts'] = self.exon_starts[start:end].tolist()
+        record['exon_ends'] = self.exon_ends[start:end].tolist()
+        return record
+
+    def premrna(self, i):
+        """Return the transcript-strand pre-mRNA sequence of transcript i"""
+        return self._seqs[int(self.seq_index[i]):int(self.seq_index[i + 1])]
+
+    def gene_index(self):
+        """Return dict: gene name -> list of transcript indices"""
+        if self._gene_index is None:
+            index = {}
+            for i, gene in enumerate(self.gene.tolist()):
+                index.setdefault(gene, []).append(i)
+            self._gene_index = index
+        return self._gene_index
+
+
+def remove_db(dirname):
+    """Remove a database directory, if it exists"""
+    if os.path.isdir(dirname):
+        print >>sys.stderr, "Removing transcript database: %s" % dirname
+        shutil.rmtree(dirname)
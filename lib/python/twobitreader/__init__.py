@@ -14,10 +14,18 @@ except ImportError:
     strerror = lambda x: 'strerror not supported'
 from os.path import exists, getsize
 from itertools import izip
+from mmap import mmap, ACCESS_READ
 import logging
 import textwrap
 import sys
 
+# Optional dependency added by OJB for SilVA: with numpy available, packed DNA
+# is decoded straight out of a memory-mapped file (see TwoBitSequence)
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 def true_long_type():
     """
@@ -102,8 +110,20 @@ def create_twobyte_table():
         d[x] = byte_to_bases(c) + byte_to_bases(f)
     return d
 
+
+def create_numpy_byte_table():
+    """
+    create NUMPY_BYTE_TABLE, a (256, 4) uint8 array of the ASCII codes
+    of the four bases encoded by each byte
+    """
+    if numpy is None:
+        return None
+    return numpy.array([[ord(base) for base in byte_to_bases(x)]
+                        for x in xrange(2**8)], dtype=numpy.uint8)
+
 BYTE_TABLE = create_byte_table()
 TWOBYTE_TABLE = create_twobyte_table()
+NUMPY_BYTE_TABLE = create_numpy_byte_table()
 
 
 def longs_to_char_array(longs, first_base_offset, last_base_offset, array_size,
@@ -213,10 +233,18 @@ See TwoBitSequence for more info
         self._file_handle = open(foo, 'rb')
         self._load_header()
         self._load_index()
+        # Added by OJB: map the whole file once so sequences can decode
+        # regions without seeking and reading through the file handle
+        if numpy is not None and self._file_size > 0:
+            self._mmap = mmap(self._file_handle.fileno(), 0,
+                              access=ACCESS_READ)
+        else:
+            self._mmap = None
         for name, offset in self._offset_dict.iteritems():
             self[name] = TwoBitSequence(self._file_handle, offset,
                                         self._file_size,
-                                        self._byteswapped)
+                                        self._byteswapped,
+                                        mmap_=self._mmap)
         return
 
     def _load_header(self):
@@ -309,9 +337,11 @@ x = TwoBitFile('my.2bit')
 d = x.dict()
 for k,v in d.iteritems(): d[k] = str(v)
     """
-    def __init__(self, file_handle, offset, file_size, byteswapped=False):
+    def __init__(self, file_handle, offset, file_size, byteswapped=False,
+                 mmap_=None):
         self._file_size = file_size
         self._file_handle = file_handle
+        self._mmap = mmap_
         self._original_offset = offset
         self._byteswapped = byteswapped
         file_handle.seek(offset)
@@ -380,6 +410,53 @@ for k,v in d.iteritems(): d[k] = str(v)
         # load all the data
         if max_ is None or max_ > dna_size:
             max_ = dna_size
+        # Added by OJB: decode straight from the memory-mapped file if we can.
+        # Byteswapped files keep the original decoder so output is unchanged.
+        if self._mmap is not None and not self._byteswapped:
+            return self._get_slice_mmap(min_, max_)
+        return self._get_slice_longs(min_, max_)
+
+    def _get_slice_mmap(self, min_, max_):
+        """
+        decodes the region [min_, max_) (already clipped to the sequence)
+        by unpacking the covering bytes of the memory-mapped file through
+        NUMPY_BYTE_TABLE, with no per-byte python loop
+
+        returns the same array('c') as _get_slice_longs
+        """
+        region_size = max_ - min_
+        if region_size < 0:
+            raise ValueError('array_size must be at least 0')
+        first_byte = min_ // 4
+        last_byte = (max_ + 3) // 4
+        packed = numpy.frombuffer(self._mmap, dtype=numpy.uint8,
+                                  count=last_byte - first_byte,
+                                  offset=self._offset + first_byte)
+        first_base_offset = min_ % 4
+        dna = NUMPY_BYTE_TABLE[packed].ravel()[first_base_offset:
+                                               first_base_offset + region_size]
+        n_block_starts = self._n_block_starts
+        n_block_sizes = self._n_block_sizes
+        # N blocks are sorted and disjoint, so only the one starting at or
+        # before min_ can reach back into the region
+        first_n_block = max(0, bisect_right(n_block_starts, min_) - 1)
+        for i in xrange(first_n_block, len(n_block_starts)):
+            start = n_block_starts[i]
+            if start >= max_:
+                break
+            end = min(start + n_block_sizes[i], max_)
+            start = max(start, min_)
+            if start < end:
+                dna[start - min_:end - min_] = ord('N')
+        return array('c', dna.tostring())
+
+    def _get_slice_longs(self, min_, max_):
+        """
+        decodes the region [min_, max_) (already clipped to the sequence)
+        with array.fromfile and longs_to_char_array, as in the original
+        twobitreader
+        """
+        dna_size = self._dna_size
         file_handle = self._file_handle
         byteswapped = self._byteswapped
         n_block_starts = self._n_block_starts
@@ -0,0 +1,77 @@
+"""
+benchmarks the memory-mapped numpy decoder of TwoBitSequence against the
+original array.fromfile/longs_to_char_array decoder
+
+Usage: python -m twobitreader.benchmark FILE.2bit [N_SLICES [SLICE_LENGTH]]
+
+Random slices (by default 200 slices of 100kb, roughly a long pre-mRNA) are
+drawn from the sequences in FILE.2bit, decoded with both methods, checked to
+be byte-identical, and the total time taken by each decoder is reported.
+"""
+from random import Random
+from time import time
+import sys
+
+from twobitreader import TwoBitFile
+
+
+def random_slices(twobit_file, n_slices, slice_length, seed=0):
+    """returns a list of (name, start, end) slices, weighted by length"""
+    rng = Random(seed)
+    sizes = [(name, size)
+             for name, size in sorted(twobit_file.sequence_sizes().items())
+             if size > 0]
+    total = sum([size for name, size in sizes])
+    slices = []
+    for i in xrange(n_slices):
+        target = rng.randint(0, total - 1)
+        for name, size in sizes:
+            if target < size:
+                break
+            target -= size
+        length = min(slice_length, size)
+        start = rng.randint(0, size - length)
+        slices.append((name, start, start + length))
+    return slices
+
+
+def time_decoder(twobit_file, slices, method):
+    """returns (seconds, decoded slices) for the named decoding method"""
+    decoded = []
+    start_time = time()
+    for name, start, end in slices:
+        decoded.append(getattr(twobit_file[name], method)(start, end))
+    return time() - start_time, decoded
+
+
+def benchmark(filename, n_slices=200, slice_length=100000, out=sys.stdout):
+    twobit_file = TwoBitFile(filename)
+    if twobit_file._mmap is None:
+        raise ImportError("numpy is required for the memory-mapped decoder")
+    slices = random_slices(twobit_file, n_slices, slice_length)
+    n_bases = sum([end - start for name, start, end in slices])
+    print >>out, "Decoding %d slices (%d bases) from %s" % \
+        (len(slices), n_bases, filename)
+    longs_time, longs_seqs = time_decoder(twobit_file, slices,
+                                          '_get_slice_longs')
+    mmap_time, mmap_seqs = time_decoder(twobit_file, slices,
+                                        '_get_slice_mmap')
+    for (name, start, end), a, b in zip(slices, longs_seqs, mmap_seqs):
+        if a.tostring() != b.tostring():
+            raise RuntimeError("Decoders disagree on %s:%d-%d" %
+                               (name, start, end))
+    print >>out, "array.fromfile: %.3fs (%.1f Mb/s)" % \
+        (longs_time, n_bases / 1e6 / max(longs_time, 1e-9))
+    print >>out, "mmap + numpy:   %.3fs (%.1f Mb/s)" % \
+        (mmap_time, n_bases / 1e6 / max(mmap_time, 1e-9))
+    print >>out, "speedup:        %.1fx" % (longs_time / max(mmap_time, 1e-9))
+
+
+def main(args=sys.argv[1:]):
+    if not 1 <= len(args) <= 3:
+        print >>sys.stderr, __doc__.strip()
+        sys.exit(1)
+    benchmark(args[0], *[int(arg) for arg in args[1:]])
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+
+"""
+Time each stage of the SilVA pipeline on VCF (default: example/example.vcf)
+and on copies of it scaled up SCALE times: synonymous filtering, allele
+frequency annotation, mRNA annotation, each feature, standardization,
+each trained model and summarization.
+
+The wall time, CPU time (user + system), peak resident memory and
+variants per second of every stage are printed and appended to HISTORY,
+one JSON record per input. Stages slower (or larger) than in the stored
+BASELINE by more than the tolerance are reported as regressions, and
+the exit status is then 1.
+
+Expects the environment set up by init.sh (run it through perf.sh).
+"""
+
+# Author: Orion Buske
+# Date:   ...
+from __future__ import division, with_statement
+
+import os
+import sys
+import json
+import socket
+import shutil
+import logging
+import tempfile
+import subprocess
+
+from glob import glob
+from time import time, strftime
+
+assert os.getenv('SILVA_PATH') is not None, \
+    "Error: SILVA_PATH is unset."
+SILVA_PATH = os.getenv('SILVA_PATH')
+SRC_DIR = os.path.join(SILVA_PATH, 'src')
+DATA_DIR = os.path.join(SILVA_PATH, 'data')
+LOG_LEVEL = os.getenv('SILVA_LOG_LEVEL', 'INFO')
+sys.path.insert(0, os.path.join(SRC_DIR, 'models', 'forest'))
+from forest import is_current_export
+
+# Stages differing from the baseline by less than these are never flagged
+MIN_SECONDS = 0.1
+MIN_RSS_KB = 10 * 1024
+
+
+def count_records(filename):
+    """Return number of non-header, non-empty lines in filename"""
+    n = 0
+    with open(filename) as ifp:
+        for line in ifp:
+            if line.strip() and not line.startswith('#'):
+                n += 1
+    return n
+
+def scale_vcf(filename, scale, out_filename):
+    """Write VCF with the records of filename repeated scale times"""
+    with open(filename) as ifp:
+        lines = ifp.readlines()
+    with open(out_filename, 'w') as ofp:
+        ofp.writelines([line for line in lines if line.startswith('#')])
+        records = [line for line in lines if not line.startswith('#')]
+        for i in xrange(scale):
+            ofp.writelines(records)
+
+def run_stage(name, args, n_variants, stdin=None, stdout=None):
+    """Run command args as a pipeline stage, returning its measurements
+
+    stdin and stdout are filenames, if given. Resource usage is that of
+    the command and any children it waited for.
+    """
+    logging.info("Running stage: %s" % name)
+    ifp = open(stdin) if stdin else None
+    ofp = open(stdout, 'w') if stdout else None
+    try:
+        start = time()
+        proc = subprocess.Popen(args, stdin=ifp, stdout=ofp)
+        pid, status, usage = os.wait4(proc.pid, 0)
+        wall = time() - start
+        # Already reaped, so keep Popen from waiting for it again
+        proc.returncode = status
+    finally:
+        for fp in [ifp, ofp]:
+            if fp is not None:
+                fp.close()
+
+    if status != 0:
+        raise RuntimeError("Stage %s failed (status %d): %s"
+                           % (name, status, ' '.join(args)))
+
+    return {'stage': name,
+            'wall': round(wall, 3),
+            'cpu': round(usage.ru_utime + usage.ru_stime, 3),
+            # Kilobytes on Linux (bytes on Mac OS)
+            'max_rss': usage.ru_maxrss,
+            'variants': n_variants,
+            'variants_per_s': round(n_variants / wall, 1) if wall else None}
+
+def filter_lines(in_filename, out_filename, keep):
+    """Copy header lines and those data lines (token lists) kept"""
+    with open(in_filename) as ifp:
+        with open(out_filename, 'w') as ofp:
+            for line in ifp:
+                if line.startswith('#') or keep(line.rstrip('\n').split('\t')):
+                    ofp.write(line)
+
+def paste_columns(filenames, out_filename):
+    """Join the lines of filenames with tabs, as the paste command"""
+    ifps = [open(filename) for filename in filenames]
+    try:
+        with open(out_filename, 'w') as ofp:
+            for lines in zip(*ifps):
+                ofp.write('\t'.join([line.rstrip('\n')
+                                     for line in lines]) + '\n')
+    finally:
+        for ifp in ifps:
+            ifp.close()
+
+def run_pipeline(vcf, workdir, models=[]):
+    """Run the stages of silva-preprocess and silva-run on vcf in workdir,
+    returning list of stage measurements
+
+    The shell glue between stages (dropping chromosome Y, applying the
+    allele frequency range, cutting columns) is done here, untimed.
+    """
+    base = os.path.join(workdir, 'in')
+    synonymous = [os.path.join(SRC_DIR, 'input', 'synonymous.py'),
+                  '--genome=%s/hg19.2bit' % DATA_DIR,
+                  '--genes=%s/refGene.ucsc.gz' % DATA_DIR,
+                  '--cache-genes=%s/refGene.db' % DATA_DIR]
+    engine = [os.path.join(SRC_DIR, 'features', 'engine.py'),
+              '--gerp=%s/gerp.refGene.table.gz' % DATA_DIR,
+              '--gerp-cache=%s/gerp.refGene.db' % DATA_DIR]
+    stages = []
+
+    stages.append(run_stage('filter', synonymous + ['filter', vcf],
+                            count_records(vcf),
+                            stdout=base + '.syn.all'))
+    filter_lines(base + '.syn.all', base + '.syn',
+                 lambda tokens: tokens[0] != 'Y')
+
+    # Allele frequencies of chrom, pos, alt
+    with open(base + '.syn') as ifp:
+        with open(base + '.syn.cut', 'w') as ofp:
+            for line in ifp:
+                tokens = line.rstrip('\n').split('\t')
+                print >>ofp, '\t'.join([tokens[0], tokens[1], tokens[4]])
+    stages.append(run_stage('af', [os.path.join(SRC_DIR, 'input', '1000gp.py'),
+                                   '%s/1000gp.refGene.vcf.gz' % DATA_DIR,
+                                   '%s/1000gp.refGene.db' % DATA_DIR],
+                            count_records(base + '.syn'),
+                            stdin=base + '.syn.cut', stdout=base + '.af'))
+    af_min = float(os.getenv('SILVA_AF_MIN', 0))
+    af_max = float(os.getenv('SILVA_AF_MAX', 1))
+    with open(base + '.af') as af_fp:
+        with open(base + '.syn') as syn_fp:
+            with open(base + '.flt', 'w') as ofp:
+                for af_line, line in zip(af_fp, syn_fp):
+                    af = af_line.split('\t')[0].strip()
+                    if line.startswith('#') or \
+                            af_min <= float(0 if af == '.' else af) <= af_max:
+                        ofp.write(line)
+
+    stages.append(run_stage('annotate',
+                            synonymous + ['annotate', '--context',
+                                          base + '.flt'],
+                            count_records(base + '.flt'),
+                            stdout=base + '.mrna'))
+
+    # Each feature alone, pasted into the full MAT file
+    n_mrna = count_records(base + '.mrna')
+    names = subprocess.Popen(engine + ['--list-features'],
+                             stdout=subprocess.PIPE).communicate()[0].split()
+    parts = []
+    for name in names:
+        part = '%s.mat.%s' % (base, name)
+        stages.append(run_stage('feature:%s' % name,
+                                engine + ['--only=%s' % name, base + '.mrna'],
+                                n_mrna, stdout=part))
+        parts.append(part)
+    paste_columns(parts, base + '.mat')
+
+    stages.append(run_stage('standardize',
+                            [os.path.join(SRC_DIR, 'input', 'standardize.py'),
+                             '--class=0',
+                             '--control=%s.mat' % os.getenv('SILVA_CONTROL'),
+                             '--binary=%s.smat' % base, base + '.mat'],
+                            count_records(base + '.mat'),
+                            stdout=base + '.input'))
+
+    n_input = count_records(base + '.input')
+    forest_dir = os.path.join(SRC_DIR, 'models', 'forest')
+    scored = []
+    for modelfile in models:
+        model = os.path.basename(modelfile)[:-len('.model')]
+        forest = os.path.splitext(modelfile)[0] + '.forest'
+        if is_current_export(modelfile, forest):
+            args = [os.path.join(forest_dir, 'forest.py'), forest,
+                    base + '.smat']
+        else:
+            args = [os.path.join(forest_dir, 'test'), modelfile,
+                    base + '.input']
+        out = '%s.%s.out' % (base, model)
+        stages.append(run_stage('model:%s' % model, args, n_input,
+                                stdout=out))
+        scorefile = '%s.%s.scored' % (base, model)
+        with open(out) as ifp:
+            with open(scorefile, 'w') as ofp:
+                for line in ifp:
+                    print >>ofp, line.split('\t')[0].strip()
+        scored.append(scorefile)
+
+    if scored:
+        stages.append(run_stage('summarize',
+                                [os.path.join(SRC_DIR, 'util',
+                                              'summarize_scores.py'),
+                                 base + '.flt'] + scored,
+                                count_records(base + '.flt'),
+                                stdout=base + '.ranked'))
+
+    return stages
+
+def find_regressions(record, baseline, tolerance):
+    """Return list of messages for stages of record slower or larger than
+    in baseline (the record of the same input) by more than tolerance"""
+    previous = dict([(stage['stage'], stage) for stage in baseline['stages']])
+    messages = []
+    for stage in record['stages']:
+        old = previous.get(stage['stage'])
+        if old is None:
+            continue
+        for key, unit, min_change in [('wall', 's', MIN_SECONDS),
+                                      ('cpu', 's', MIN_SECONDS),
+                                      ('max_rss', 'KB', MIN_RSS_KB)]:
+            value, old_value = stage[key], old[key]
+            if value > old_value * (1 + tolerance) and \
+                    value - old_value > min_change:
+                messages.append("%s %s: %g %s -> %g %s (+%.0f%%)"
+                                % (stage['stage'], key, old_value, unit,
+                                   value, unit,
+                                   100 * (value - old_value) / old_value))
+    return messages
+
+def print_record(record, out=sys.stdout):
+    print >>out, "# %s (%d variants)" % (record['input'], record['variants'])
+    print >>out, '#%s' % '\t'.join(['stage', 'wall', 'cpu', 'max_rss',
+                                    'variants', 'variants_per_s'])
+    for stage in record['stages']:
+        print >>out, '\t'.join([str(stage[key]) for key in
+                                ['stage', 'wall', 'cpu', 'max_rss',
+                                 'variants', 'variants_per_s']])
+
+def git_commit():
+    """Return current commit of SILVA_PATH, or None if not a git checkout"""
+    try:
+        proc = subprocess.Popen(['git', 'rev-parse', 'HEAD'], cwd=SILVA_PATH,
+                                stdout=subprocess.PIPE,
+                                stderr=open(os.devnull, 'w'))
+        commit = proc.communicate()[0].strip()
+    except OSError:
+        return None
+    return commit if proc.returncode == 0 else None
+
+def silva_version():
+    """Return the SilVA version, from the VERSION file"""
+    try:
+        with open(os.path.join(SILVA_PATH, 'VERSION')) as ifp:
+            return ifp.read().strip()
+    except IOError:
+        return None
+
+def script(vcfs, scales=[], history='silva-perf.jsonl',
+           baseline='silva-perf.baseline.json', save_baseline=False,
+           tolerance=0.2, workdir=None, keep=False):
+    models = sorted(glob(os.path.join(os.getenv('SILVA_TRAINED', ''),
+                                      '*.model')))
+    if not models:
+        logging.warning("No trained models found in SILVA_TRAINED;"
+                        " skipping model and summarize stages")
+
+    baselines = {}
+    if baseline and os.path.isfile(baseline) and not save_baseline:
+        with open(baseline) as ifp:
+            baselines = dict([(record['input'], record)
+                              for record in json.load(ifp)])
+
+    rootdir = tempfile.mkdtemp(prefix='silva-perf.', dir=workdir)
+    records = []
+    regressions = []
+    try:
+        for vcf in vcfs:
+            for scale in [1] + scales:
+                label = os.path.basename(vcf)
+                input_filename = os.path.abspath(vcf)
+                rundir = os.path.join(rootdir, '%s.x%d' % (label, scale))
+                os.makedirs(rundir)
+                if scale != 1:
+                    label = '%s x%d' % (label, scale)
+                    input_filename = os.path.join(rundir, 'input.vcf')
+                    scale_vcf(vcf, scale, input_filename)
+
+                record = {'input': label,
+                          'time': strftime('%Y-%m-%d %H:%M:%S'),
+                          'host': socket.gethostname(),
+                          'version': silva_version(),
+                          'commit': git_commit(),
+                          'n_threads': int(os.getenv('SILVA_N_THREADS', 1)),
+                          'variants': count_records(input_filename),
+                          'stages': run_pipeline(input_filename, rundir,
+                                                 models=models)}
+                records.append(record)
+                print_record(record)
+                with open(history, 'a') as ofp:
+                    print >>ofp, json.dumps(record, sort_keys=True)
+
+                if label in baselines:
+                    regressions.extend(['%s: %s' % (label, message)
+                                        for message in find_regressions(
+                                record, baselines[label], tolerance)])
+    finally:
+        if keep:
+            logging.info("Kept stage outputs in: %s" % rootdir)
+        else:
+            shutil.rmtree(rootdir)
+
+    if save_baseline and baseline:
+        with open(baseline, 'w') as ofp:
+            json.dump(records, ofp, indent=1, sort_keys=True)
+        logging.info("Saved baseline: %s" % baseline)
+
+    for message in regressions:
+        print >>sys.stderr, "REGRESSION: %s" % message
+    return 1 if regressions else 0
+
+def parse_args(args):
+    from optparse import OptionParser
+    usage = "usage: %prog [options] [VCF...]"
+    description = __doc__.strip()
+
+    parser = OptionParser(usage=usage,
+                          description=description)
+    parser.add_option("-s", "--scale", metavar="N,...",
+                      dest="scales", default='',
+                      help="Also run on each VCF repeated N times")
+    parser.add_option("--history", metavar="HISTORY",
+                      dest="history", default="silva-perf.jsonl",
+                      help="Append results to HISTORY (default: %default)")
+    parser.add_option("--baseline", metavar="BASELINE",
+                      dest="baseline", default="silva-perf.baseline.json",
+                      help="Compare results to BASELINE (default: %default)")
+    parser.add_option("--save-baseline", action="store_true",
+                      dest="save_baseline", default=False,
+                      help="Save results as the new BASELINE")
+    parser.add_option("--tolerance", metavar="FRAC", type="float",
+                      dest="tolerance", default=0.2,
+                      help="Flag stages slower or larger than BASELINE by"
+                      " more than FRAC (default: %default)")
+    parser.add_option("--workdir", metavar="DIR",
+                      dest="workdir", default=None,
+                      help="Write stage outputs under DIR (default: TMPDIR)")
+    parser.add_option("--keep", action="store_true",
+                      dest="keep", default=False,
+                      help="Keep stage outputs")
+    options, args = parser.parse_args(args)
+
+    try:
+        options.scales = [int(scale) for scale in options.scales.split(',')
+                          if scale]
+    except ValueError:
+        parser.error("Invalid --scale: %s" % options.scales)
+    if not args:
+        args = [os.path.join(SILVA_PATH, 'example', 'example.vcf')]
+
+    return options, args
+
+def main(args=sys.argv[1:]):
+    options, args = parse_args(args)
+    kwargs = dict(options.__dict__)
+    logging.basicConfig(level=LOG_LEVEL)
+
+    return script(args, **kwargs)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,11 @@
+#!/usr/bin/env bash
+
+set -eu
+set -o pipefail
+
+# Time each pipeline stage, with the environment of silva-preprocess and
+# silva-run (see perf.py --help)
+export SILVA_PATH="${SILVA_PATH:-$(cd -P $(dirname $0)/../..; pwd)}"
+source $SILVA_PATH/init.sh
+
+exec $SILVA_PATH/src/benchmark/perf.py "$@"
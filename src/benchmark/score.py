@@ -13,7 +13,9 @@ import os
 from glob import glob
 from collections import defaultdict
 from numpy import array, concatenate
-from scipy.stats.mstats import rankdata
+
+sys.path.insert(0, os.path.expandvars('$SILVA_PATH/lib/python'))
+from silva.ranking import rankdata
 
 def read_scores(filename):
     pos = []
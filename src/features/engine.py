@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+
+"""
+Annotates every variant in MRNA (as printed by synonymous.py annotate)
+with all features, and prints the resulting matrix in MAT format: one
+header line with a '#'-prefixed group of columns per feature, then one
+tab-delimited row per variant, with missing values ('na') set to 0.
+
+Each row is parsed once and passed to every registered feature, in the
+same process, rather than to a separate script per feature. The last
+column of MRNA is either the full mutated pre-mRNA or its bounded context
+(from synonymous.py annotate --context).
+"""
+
+# Author: Orion Buske
+# Date:   ...
+
+from __future__ import division, with_statement
+
+import os
+import sys
+import re
+import logging
+
+from itertools import islice
+
+assert os.getenv('SILVA_PATH') is not None, \
+       "Error: SILVA_PATH is unset."
+sys.path.insert(0, os.path.expandvars('$SILVA_PATH/lib/python'))
+from silva import maybe_gzip_open
+
+FEATURE_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.expandvars('$SILVA_PATH/data')
+LOG_LEVEL = os.getenv('SILVA_LOG_LEVEL', 'INFO')
+
+# Columns of the MRNA file (0-indexed)
+GERP_COLS = [0, 1]  # chrom, pos
+CODON_COLS = [3, 4, 7, 8, 9]  # ref, alt, strand, codon, frame
+MRNA_COL = 10
+# Number of MRNA rows scored together
+CHUNK_SIZE = 10000
+FOLDING_DOMAIN = 50
+
+SEQ_RE = re.compile(r'([ACGT]*)\[([ACGT])/([ACGT])\]([ACGT]*)')
+
+
+def import_feature(dirname, name):
+    """Import feature script dirname/name.py as a module"""
+    path = os.path.join(FEATURE_DIR, dirname)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+    return __import__(name)
+
+
+class Entry(object):
+    """A row of an MRNA file, parsed once for all features"""
+    def __init__(self, tokens):
+        self.tokens = tokens
+        value = tokens[MRNA_COL].strip()
+        if '=' in value:
+            # Context of the form: exon=AAGA[C/G]TCG;up=GGAG;down=GTAA;...
+            # (see synonymous.Transcript.mutation_context)
+            self.seq = None
+            self.context = dict([(key, seq.upper()) for key, seq in
+                                 [item.split('=', 1)
+                                  for item in value.split(';')]])
+            mut_exon = self.context['exon']
+        else:
+            # Mutation string of the form: GGAG|AAGA[C/G]TCG|GTAA
+            self.seq = value.upper()
+            self.context = None
+            mut_exons = [chunk for chunk in self.seq.split('|')
+                         if '/' in chunk]
+            assert len(mut_exons) == 1, \
+                "Expected one mutation in sequence: %s" % self.seq[:20]
+            mut_exon = mut_exons[0]
+
+        m = SEQ_RE.search(mut_exon)
+        if m:
+            # (pre, old, new, post) nucleotides of the mutated exon
+            self.exon = m.groups()
+            self.exon_start = m.start()
+        else:
+            logging.warning("Invalid sequence: %s" % mut_exon)
+            self.exon = None
+            self.exon_start = None
+
+    def splice_seq(self):
+        """Return mutation string with (at least) the splice site flanks
+        of the mutated exon"""
+        if self.context is None:
+            return self.seq
+        return '|'.join([seq for seq in [self.context['up'],
+                                         self.context['exon'],
+                                         self.context['down']] if seq])
+
+    def folding_seqs(self):
+        """Return (pre-mRNA, mRNA) mutation strings, without splice markers,
+        with (at least) the folding window around the mutation"""
+        if self.context is None:
+            return (self.seq.replace('|', ''),
+                    ''.join(self.seq.split('|')[::2]))
+        return self.context['premrna'], self.context['mrna']
+
+
+class Feature(object):
+    """A group of MAT columns, computed from Entry objects
+
+    Features are output in order of name. Subclasses define fields and
+    either score_entry (returning a list of formatted values for one entry)
+    or, for features that are computed in batch, score_entries.
+    """
+    name = None
+    fields = []
+
+    def null(self):
+        return ['na'] * len(self.fields)
+
+    def score_entries(self, entries):
+        return [self.score_entry(entry) for entry in entries]
+
+    def score_entry(self, entry):
+        raise NotImplementedError()
+
+
+class ExonFeature(Feature):
+    """A feature of the mutated exon: (pre, old, new, post)"""
+    def score_entry(self, entry):
+        if entry.exon is None:
+            return self.null()
+        return self.score_exon(*entry.exon)
+
+
+class GerpFeature(Feature):
+    name = '0_gerp'
+    fields = ['GERP++']
+
+    def __init__(self,
+                 table=os.path.join(DATA_DIR, 'gerp.refGene.table.gz'),
+                 optfile=os.path.join(DATA_DIR, 'gerp.refGene.db')):
+        self.gerp = import_feature('other', 'gerp')
+        self.table = self.gerp.load_table(table, optfile)
+
+    def score_entries(self, entries):
+        # Positions are looked up in one batch per chromosome
+        loci = [[entry.tokens[i] for i in GERP_COLS] for entry in entries]
+        return [[score] for score in self.gerp.get_scores(self.table, loci)]
+
+
+class CodonFeature(Feature):
+    name = 'codon'
+    fields = ['RSCU', 'dRSCU']
+
+    def __init__(self):
+        self.codon_usage = import_feature('other', 'codon_usage')
+
+    def score_entry(self, entry):
+        codon, new_codon = self.codon_usage.mutate_codon(
+            *[entry.tokens[i] for i in CODON_COLS])
+        old, new, delta = self.codon_usage.calc_delta_rscu(codon, new_codon)
+        return ['%.4f' % new, '%.4f' % delta]
+
+
+class CpgFeature(ExonFeature):
+    name = 'cpg'
+    fields = ['CpG?', 'CpG_exon']
+
+    def __init__(self):
+        self.cpg = import_feature('other', 'cpg')
+
+    def score_entry(self, entry):
+        # cpg.py requires the mutated exon to be entirely ACGT
+        if entry.exon_start != 0:
+            return self.null()
+        return ExonFeature.score_entry(self, entry)
+
+    def score_exon(self, pre, old, new, post):
+        mut_cpg, cpg_exon = self.cpg.score_exon(pre, old, new, post)
+        return ['%d' % mut_cpg, '%.4f' % cpg_exon]
+
+
+class SpliceFeature(Feature):
+    name = 'splice'
+    fields = ['f_premrna', 'f_mrna']
+
+    def __init__(self):
+        self.splice = import_feature('other', 'splice')
+
+    def score_entry(self, entry):
+        if entry.context is None:
+            fractions = self.splice.score_sequence(entry.seq)
+        else:
+            # Lengths of the mutation string on either side of the mutation
+            # (including splice markers), and of its exons
+            context = entry.context
+            pre, post = [int(x) for x in context['premrna_flanks'].split(',')]
+            pre_cds, post_cds = [int(x) for x in
+                                 context['mrna_flanks'].split(',')]
+            pre_junctions, post_junctions = [int(x) for x in
+                                             context['junctions'].split(',')]
+            fractions = self.splice.score_lengths(pre + pre_junctions,
+                                                  post + post_junctions,
+                                                  pre_cds, post_cds)
+        return ['%.4f' % f for f in fractions]
+
+
+class Ese3Feature(Feature):
+    name = 'ese3'
+    fields = ['SR-', 'SR+']
+
+    def __init__(self):
+        self.ese3 = import_feature('ese3', 'ese3')
+        self.weights = self.ese3.read_weights(
+            os.path.join(FEATURE_DIR, 'ese3', 'weights.txt'))
+
+    def score_entries(self, entries):
+        # Motifs are scanned over all exons at once
+        totals = iter(self.ese3.score_totals(self.weights,
+                                             [entry.exon for entry in entries
+                                              if entry.exon is not None]))
+        return [self.null() if entry.exon is None else totals.next()
+                for entry in entries]
+
+
+class PesxFeature(Feature):
+    name = 'pesx'
+    fields = ['PESE-', 'PESE+', 'PESS-', 'PESS+']
+
+    def __init__(self):
+        self.pesx = import_feature('pesx', 'pesx')
+        dirname = os.path.join(FEATURE_DIR, 'pesx')
+        self.pese = self.pesx.read_octamers(os.path.join(dirname,
+                                                         'pese262.txt'))
+        self.pess = self.pesx.read_octamers(os.path.join(dirname,
+                                                         'pess262.txt'))
+
+    def score_entries(self, entries):
+        # Octamers are matched in all exons at once
+        fractions = iter(self.pesx.score_all_fractions(
+                self.pese, self.pess, [entry.exon for entry in entries
+                                       if entry.exon is not None]))
+        return [self.null() if entry.exon is None else fractions.next()
+                for entry in entries]
+
+
+class FasEssFeature(Feature):
+    name = 'fas-ess'
+    fields = ['FAS6-', 'FAS6+']
+
+    def __init__(self):
+        self.fas_ess = import_feature('fas-ess', 'fas-ess')
+        self.hexs = self.fas_ess.read_hexamers(
+            os.path.join(FEATURE_DIR, 'fas-ess', 'fas-hex3.txt'))
+
+    def score_entries(self, entries):
+        # Hexamers are matched in all exons at once
+        fractions = iter(self.fas_ess.score_all_fractions(
+                self.hexs, [entry.exon for entry in entries
+                            if entry.exon is not None]))
+        return [self.null() if entry.exon is None else fractions.next()
+                for entry in entries]
+
+
+class MaxentFeature(Feature):
+    name = 'maxent'
+    fields = ['MES', 'dMES', 'MES+', 'MES-', 'MEC-MC?', 'MEC-CS?', 'MES-KM?']
+
+    def __init__(self):
+        self.maxent = import_feature('maxent', 'maxent')
+
+    def score_entries(self, entries):
+        # Sites are scored in one batch, for all entries
+        seqs = [self.maxent.Seq(entry.splice_seq()) for entry in entries]
+        return [self.maxent.format_row(row)
+                for row in self.maxent.score_seqs(seqs)]
+
+
+class FoldingFeature(Feature):
+    """RNA folding with unafold.py or vienna.py, within a window"""
+    def __init__(self, dirname, domain=FOLDING_DOMAIN):
+        self.name = '%s-%d' % (dirname, domain)
+        self.module = import_feature(dirname, dirname)
+        self.domain = domain
+        self.fields = self.module.get_fields(domain)
+
+    def score_entries(self, entries):
+        return self.module.score_pairs([entry.folding_seqs()
+                                        for entry in entries], self.domain)
+
+
+FEATURES = [GerpFeature, CodonFeature, CpgFeature, SpliceFeature,
+            Ese3Feature, PesxFeature, FasEssFeature, MaxentFeature]
+FOLDING_FEATURES = ['unafold', 'vienna']
+
+
+class FeatureEngine(object):
+    def __init__(self, exclude_folding=None, only=None, **kwargs):
+        """Load all features, passing kwargs to matching constructors
+
+        e.g. gerp={'table': ...} is passed to GerpFeature. RNA folding
+        features are excluded if exclude_folding, which defaults to
+        whether EXCLUDE_RNA_FOLDING is set. If only is given, just the
+        features with those names are loaded.
+        """
+        if exclude_folding is None:
+            exclude_folding = bool(os.getenv('EXCLUDE_RNA_FOLDING'))
+
+        classes = FEATURES
+        folding = FOLDING_FEATURES
+        if exclude_folding:
+            logging.info("Excluding RNA folding features")
+            folding = []
+        if only is not None:
+            names = feature_names(exclude_folding=exclude_folding)
+            unknown = set(only) - set(names)
+            if unknown:
+                raise ValueError("Unknown features: %s (expected: %s)"
+                                 % (', '.join(sorted(unknown)),
+                                    ', '.join(names)))
+            classes = [cls for cls in classes if cls.name in only]
+            folding = [dirname for dirname in folding
+                       if '%s-%d' % (dirname, FOLDING_DOMAIN) in only]
+
+        features = [cls(**kwargs.get(cls.name, {})) for cls in classes]
+        features.extend([FoldingFeature(dirname) for dirname in folding])
+        features.sort(key=lambda feature: feature.name)
+        self.features = features
+
+    def header(self):
+        return '\t'.join(['#%s' % '\t'.join(feature.fields)
+                          for feature in self.features])
+
+    def score(self, entries):
+        """Return list of MAT rows (lists of strings), one per entry"""
+        rows = [[] for entry in entries]
+        for feature in self.features:
+            values = feature.score_entries(entries)
+            assert len(values) == len(entries)
+            for row, value in zip(rows, values):
+                assert len(value) == len(feature.fields)
+                row.extend(value)
+
+        for row in rows:
+            row[:] = ['0' if value == 'na' else value for value in row]
+        return rows
+
+    def write_mat(self, mrna_filename, out=sys.stdout,
+                  chunk_size=CHUNK_SIZE):
+        """Print MAT file for all entries in mrna_filename to out"""
+        print >>out, self.header()
+        entries = iter_entries(mrna_filename)
+        while True:
+            chunk = list(islice(entries, chunk_size))
+            if not chunk:
+                break
+            for row in self.score(chunk):
+                print >>out, '\t'.join(row)
+
+
+def feature_names(exclude_folding=None):
+    """Return names of all features, in the order of their MAT columns"""
+    if exclude_folding is None:
+        exclude_folding = bool(os.getenv('EXCLUDE_RNA_FOLDING'))
+    names = [cls.name for cls in FEATURES]
+    if not exclude_folding:
+        names.extend(['%s-%d' % (dirname, FOLDING_DOMAIN)
+                      for dirname in FOLDING_FEATURES])
+    return sorted(names)
+
+def iter_entries(filename):
+    """Yield an Entry for each variant in MRNA file"""
+    with maybe_gzip_open(filename) as ifp:
+        for line in ifp:
+            line = line.rstrip('\r\n')
+            if not line or line.startswith('#'): continue
+            yield Entry(line.split('\t'))
+
+def script(filename, gerp_table=None, gerp_cache=None, only=None, **kwargs):
+    gerp = {}
+    if gerp_table is not None:
+        gerp['table'] = gerp_table
+        gerp['optfile'] = gerp_cache
+    if only is not None:
+        only = only.split(',')
+    engine = FeatureEngine(only=only, **{GerpFeature.name: gerp})
+    engine.write_mat(filename)
+
+def parse_args(args):
+    from optparse import OptionParser
+    usage = "usage: %prog [options] MRNA > MAT"
+    description = __doc__.strip()
+
+    parser = OptionParser(usage=usage,
+                          description=description)
+    parser.add_option("--gerp", metavar="TABLE",
+                      dest="gerp_table", default=None,
+                      help="Read GERP scores from TABLE (see gerp.py)"
+                      " [default: $SILVA_PATH/data/gerp.refGene.table.gz]")
+    parser.add_option("--gerp-cache", metavar="DIR",
+                      dest="gerp_cache", default=None,
+                      help="Read/write optimized GERP table (a directory)")
+    parser.add_option("--only", metavar="NAME,...",
+                      dest="only", default=None,
+                      help="Only compute the named features (their columns"
+                      " of the full MAT file)")
+    parser.add_option("--list-features", action="store_true",
+                      dest="list_features", default=False,
+                      help="Print the names of all features and exit")
+    options, args = parser.parse_args(args)
+
+    if options.list_features:
+        print '\n'.join(feature_names())
+        sys.exit(0)
+
+    if len(args) != 1:
+        parser.error("Inappropriate number of arguments")
+
+    return options, args
+
+def main(args=sys.argv[1:]):
+    options, args = parse_args(args)
+    kwargs = dict(options.__dict__)
+    del kwargs['list_features']
+    logging.basicConfig(level=LOG_LEVEL)
+    script(*args, **kwargs)
+
+if __name__ == '__main__':
+    sys.exit(main())
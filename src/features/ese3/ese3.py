@@ -17,13 +17,20 @@ import os
 import sys
 import re
 
+from itertools import islice
+from numpy import array, zeros, concatenate, cumsum, arange, \
+    flatnonzero, int64, float64
+
 assert os.getenv('SILVA_PATH') is not None, \
        "Error: SILVA_PATH is unset."
 sys.path.insert(0, os.path.expandvars("$SILVA_PATH/lib/python"))
 from silva import maybe_gzip_open, print_args
+from silva.kmers import NUCS, nuc_codes
 
 PRE_LEN = 7
 POST_LEN = 7
+# Number of sequences scored together
+CHUNK_SIZE = 10000
 
 def read_weights(filename):
     with open(filename) as ifp:
@@ -46,6 +53,17 @@ def iter_sequences(filename):
                 print >>sys.stderr, "Error, invalid sequence: %s" % exon
                 yield None
 
+def encode(seq):
+    """Return array of NUCS indices for each nucleotide in seq"""
+    codes = nuc_codes(seq)
+    if (codes < 0).any():
+        raise KeyError("Invalid nucleotide in sequence: %s" % seq)
+    return codes
+
+def motif_array(motif):
+    """Return motif weights as array: [motif position, nucleotide index]"""
+    return array([motif[nuc] for nuc in NUCS], dtype=float64).T
+
 def score_target(motif, target):
     assert len(target) == len(motif['A'])
     score = 0.0
@@ -53,20 +71,47 @@ def score_target(motif, target):
         score += motif[nuc][i]
     return score
 
-def score_sequence(matrix, seq):
-    """Return dict: pos -> score for all motif hits above threshold"""
-    motif = matrix['motif']
+def score_sequences(matrix, seqs):
+    """Return list of (hit offsets, hit scores) arrays, for each of seqs
+
+    All windows of all seqs are scored at once, by concatenating the
+    sequences and summing motif weights position by position (in the same
+    order as score_target, so scores are identical). Windows spanning two
+    sequences are discarded.
+    """
+    weights = motif_array(matrix['motif'])
     threshold = matrix['threshold']
-    motif_len = len(motif['A'])
+    motif_len = len(weights)
+
+    lengths = array([len(seq) for seq in seqs], dtype=int64)
+    starts = concatenate([[0], cumsum(lengths)[:-1]]).astype(int64)
+    codes = encode(''.join(seqs))
+    n_windows = len(codes) - motif_len + 1
+    if n_windows <= 0:
+        return [(array([], dtype=int64), array([], dtype=float64))
+                for seq in seqs]
+
+    scores = zeros(n_windows, dtype=float64)
+    for i in xrange(motif_len):
+        scores += weights[i][codes[i:i + n_windows]]
 
-    hits = {}
-    for offset in xrange(0, len(seq) - motif_len + 1):
-        target_seq = seq[offset: offset + motif_len]
-        score = score_target(motif, target_seq)
-        if score >= threshold:
-            hits[offset] = score
+    hits = flatnonzero(scores >= threshold)
+    which = starts.searchsorted(hits, 'right') - 1
+    offsets = hits - starts[which]
+    # Keep windows entirely within one sequence
+    keep = offsets <= lengths[which] - motif_len
+    hits = hits[keep]
+    which = which[keep]
+    offsets = offsets[keep]
+    bounds = which.searchsorted(arange(len(seqs) + 1))
+    return [(offsets[bounds[i]:bounds[i + 1]],
+             scores[hits[bounds[i]:bounds[i + 1]]])
+            for i in xrange(len(seqs))]
 
-    return hits
+def score_sequence(matrix, seq):
+    """Return dict: pos -> score for all motif hits above threshold"""
+    offsets, scores = score_sequences(matrix, [seq])[0]
+    return dict(zip(offsets.tolist(), scores.tolist()))
 
 def score_mutation(matrix, old_seq, new_seq, verbose=False):
     """Return tuple (# motifs lost, # motifs gained)"""
@@ -79,6 +124,58 @@ def score_mutation(matrix, old_seq, new_seq, verbose=False):
     old_pos = set(old)
     new_pos = set(new)
     return len(old_pos - new_pos), len(new_pos - old_pos)
+
+def safe_div(num, denom):
+    if num + denom > 0:
+        return '%.4f' % (num / (num + denom))
+    else:
+        return 'na'
+
+def score_exons(weights, exons):
+    """Return list of [(PSSM name, # motifs, # lost, # gained)] for each exon
+
+    Each exon is (pre, old, new, post), and each PSSM is scanned over the
+    full and short (old and new) sequences of all exons at once.
+    """
+    seqs = []
+    for pre, mut_old, mut_new, post in exons:
+        seqs.append(pre + mut_old + post)
+        seqs.append(pre[-PRE_LEN:] + mut_old + post[:POST_LEN])
+        seqs.append(pre[-PRE_LEN:] + mut_new + post[:POST_LEN])
+
+    results = [[] for exon in exons]
+    for name in sorted(weights):
+        hits = score_sequences(weights[name], seqs)
+        for i, result in enumerate(results):
+            old, short_old, short_new = [set(offsets.tolist()) for
+                                         offsets, scores in hits[3*i:3*i + 3]]
+            result.append((name, len(old), len(short_old - short_new),
+                           len(short_new - short_old)))
+
+    return results
+
+def score_exon(weights, pre, mut_old, mut_new, post, verbose=False):
+    """Return list of (PSSM name, # motifs, # lost, # gained) for each PSSM"""
+    if verbose:
+        short_old = pre[-PRE_LEN:] + mut_old + post[:POST_LEN]
+        short_new = pre[-PRE_LEN:] + mut_new + post[:POST_LEN]
+        for name in sorted(weights):
+            score_mutation(weights[name], short_old, short_new, verbose=True)
+
+    return score_exons(weights, [(pre, mut_old, mut_new, post)])[0]
+
+def score_totals(weights, exons):
+    """Return [fraction of motifs lost, fraction gained] for each exon"""
+    totals = []
+    for result in score_exons(weights, exons):
+        tot = tot_lost = tot_gained = 0
+        for name, n_old, n_lost, n_gained in result:
+            tot += n_old
+            tot_lost += n_lost
+            tot_gained += n_gained
+        totals.append([safe_div(tot_lost, tot), safe_div(tot_gained, tot)])
+
+    return totals
                     
 def script(filename, weight_filename='weights.txt',
            quiet=False, verbose=False, **kwargs):
@@ -92,40 +189,56 @@ def script(filename, weight_filename='weights.txt',
         print "#PSSM  n_motifs  motif_loss  motif_gain"
         NULL = '\t'.join(['na'] * 3)
 
-    def safe_div(num, denom):
-        if num + denom > 0:
-            return '%.4f' % (num / (num + denom))
-        else:
-            return 'na'
+    if quiet:
+        # Only print totalled effects, scoring many sequences at once
+        entries = iter_sequences(filename)
+        while True:
+            chunk = list(islice(entries, CHUNK_SIZE))
+            if not chunk:
+                break
+            totals = iter(score_totals(weights, [entry for entry in chunk
+                                                 if entry is not None]))
+            for entry in chunk:
+                if entry is None:
+                    print NULL
+                else:
+                    print '\t'.join(totals.next())
+        return
 
     for entry in iter_sequences(filename):
         if entry is None:
             print NULL
             continue
         
-        pre, mut_old, mut_new, post = entry
-        old = pre + mut_old + post
-        
-        tot = tot_lost = tot_gained = 0
-        for name in sorted(weights):
-            pssm = weights[name]
-            n_old = len(score_sequence(pssm, old))
-
-            short_old = pre[-7:] + mut_old + post[:7]
-            short_new = pre[-7:] + mut_new + post[:7]
-            n_lost, n_gained = score_mutation(pssm, short_old, short_new,
-                                              verbose=verbose)
-
+        tot = 0
+        for name, n_old, n_lost, n_gained in \
+                score_exon(weights, *entry, verbose=verbose):
             tot += n_old
-            tot_lost += n_lost
-            tot_gained += n_gained
-            if not quiet:
-                print "%s\t%d\t%d\t%d" % (name, tot, n_lost, n_gained)
+            print "%s\t%d\t%d\t%d" % (name, tot, n_lost, n_gained)
+
+def run_tests(weight_filename='weights.txt'):
+    from random import Random
+    rng = Random(0)
+    weights = read_weights(weight_filename)
+    seqs = [''.join([rng.choice(NUCS) for i in xrange(rng.randint(0, 40))])
+            for j in xrange(200)]
+    for name, matrix in sorted(weights.items()):
+        motif = matrix['motif']
+        motif_len = len(motif['A'])
+        for seq, (offsets, scores) in zip(seqs,
+                                          score_sequences(matrix, seqs)):
+            # Compare against scoring each window in turn
+            expected = {}
+            for offset in xrange(0, len(seq) - motif_len + 1):
+                score = score_target(motif, seq[offset:offset + motif_len])
+                if score >= matrix['threshold']:
+                    expected[offset] = score
+            found = dict(zip(offsets.tolist(), scores.tolist()))
+            assert found == expected, \
+                "%s hits differ in %s: %s != %s" % (name, seq, found,
+                                                     expected)
 
-        if quiet:
-            # Only print totalled effects
-            print '\t'.join([safe_div(tot_lost, tot),
-                             safe_div(tot_gained, tot)])
+    print >>sys.stderr, "All tests passed"
 
 def parse_args(args):
     from optparse import OptionParser
@@ -140,8 +253,13 @@ def parse_args(args):
                       " for additional processing")
     parser.add_option("-v", "--verbose", default=False,
                       dest="verbose", action='store_true')
+    parser.add_option("--test", default=False,
+                      dest="test", action='store_true')
     options, args = parser.parse_args()
 
+    if options.test:
+        sys.exit(run_tests())
+
     if len(args) != 1:
         parser.error("Inappropriate number of arguments")
 
@@ -17,21 +17,20 @@ import os
 import sys
 import re
 
+from itertools import islice
+
 assert os.getenv('SILVA_PATH') is not None, \
        "Error: SILVA_PATH is unset."
 sys.path.insert(0, os.path.expandvars("$SILVA_PATH/lib/python"))
 from silva import maybe_gzip_open, print_args
+from silva.kmers import KmerSet
+
+# Number of sequences scored together
+CHUNK_SIZE = 10000
 
 def hexamer_subsequences(hexs, seq):
     """Return dict: pos -> hexamer found in seq"""
-    found = dict()
-    motif_len = 6  # hexamers
-    for offset in xrange(0, len(seq) - motif_len + 1):
-        target_seq = seq[offset: offset + motif_len]
-        if target_seq in hexs:
-            found[offset] = target_seq
-
-    return found
+    return hexs.find(seq)
 
 def score_mutation(hexs, old_seq, new_seq):
     """Return differences in hex hits between new and old sequences
@@ -44,6 +43,45 @@ def score_mutation(hexs, old_seq, new_seq):
     new_pos = set(new)
     return len(old_pos - new_pos), len(new_pos - old_pos)
 
+def safe_div(num, denom):
+    if num + denom > 0:
+        return '%.4f' % (num / (num + denom))
+    else:
+        return 'na'
+
+def score_exons(hexs, exons):
+    """Return list of (# hexamers, # lost, # gained)
+
+    Each exon is (pre, old, new, post), and the hexamers of all exons are
+    matched at once.
+    """
+    olds = []
+    short_olds = []
+    short_news = []
+    for pre, nuc_old, nuc_new, post in exons:
+        olds.append(pre + nuc_old + post)
+        short_olds.append(pre[-7:] + nuc_old + post[:7])
+        short_news.append(pre[-7:] + nuc_new + post[:7])
+
+    n_lost, n_gained = hexs.count_changes(short_olds, short_news)
+    return zip(hexs.count(olds).tolist(), n_lost.tolist(), n_gained.tolist())
+
+def score_exon(hexs, pre, nuc_old, nuc_new, post):
+    """Return (# hexamers, # lost, # gained)"""
+    return score_exons(hexs, [(pre, nuc_old, nuc_new, post)])[0]
+
+def fractions(n_old, n_lost, n_gained):
+    """Return fractions of hexamers lost and gained, as strings"""
+    return [safe_div(n_lost, n_old), safe_div(n_gained, n_old)]
+
+def score_fractions(hexs, pre, nuc_old, nuc_new, post):
+    """Return fractions of hexamers lost and gained, as strings"""
+    return fractions(*score_exon(hexs, pre, nuc_old, nuc_new, post))
+
+def score_all_fractions(hexs, exons):
+    """Return score_fractions for each exon, matching all at once"""
+    return [fractions(*counts) for counts in score_exons(hexs, exons)]
+
 def read_hexamers(filename):
     hexs = []
     with open(filename) as ifp:
@@ -54,7 +92,7 @@ def read_hexamers(filename):
                     hexs.append(line)
                 else:
                     print >>sys.stderr, "Found invalid hexamer: %s" % line
-    return set(hexs)
+    return KmerSet(hexs, k=6)
 
 def iter_sequences(filename):
     # Get exon
@@ -83,30 +121,20 @@ def script(filename, hex_filename='fas-hex3.txt', quiet=False, **kwargs):
         print '#n_initial n_lost n_gained'
         NULL = 'na na na'
         
-    def safe_div(num, denom):
-        if num + denom > 0:
-            return '%.4f' % (num / (num + denom))
-        else:
-            return 'na'
-                
-    for entry in iter_sequences(filename):
-        if entry is None:
-            print NULL
-            continue
-        
-        pre, nuc_old, nuc_new, post = entry
-        old = pre + nuc_old + post
-        short_old = pre[-7:] + nuc_old + post[:7]
-        short_new = pre[-7:] + nuc_new + post[:7]
-        
-        n_old = len(hexamer_subsequences(hexs, old))
-        n_lost, n_gained = score_mutation(hexs, short_old, short_new)
-
-        if quiet:
-            print '\t'.join([safe_div(n_lost, n_old),
-                             safe_div(n_gained, n_old)])
-        else:
-            print '%d\t%d\t%d' % (n_old, n_lost, n_gained)
+    entries = iter_sequences(filename)
+    while True:
+        chunk = list(islice(entries, CHUNK_SIZE))
+        if not chunk:
+            break
+        results = iter(score_exons(hexs, [entry for entry in chunk
+                                          if entry is not None]))
+        for entry in chunk:
+            if entry is None:
+                print NULL
+            elif quiet:
+                print '\t'.join(fractions(*results.next()))
+            else:
+                print '%d\t%d\t%d' % results.next()
 
 def parse_args(args):
     from optparse import OptionParser
@@ -14,18 +14,29 @@ from __future__ import division, with_statement
 import os
 import sys
 import re
+import atexit
 
 from datetime import datetime
-from itertools import chain, imap
+from itertools import chain
 from subprocess import Popen, PIPE
 
 assert os.getenv('SILVA_PATH') is not None, \
            "Error: SILVA_PATH is unset."
 sys.path.insert(0, os.path.expandvars("$SILVA_PATH/lib/python"))
 from silva import maybe_gzip_open, print_args
+from maxentscan import MaxEntScan
+import sitecache
 
 MAXENT_PATH = os.path.expandvars('$SILVA_PATH/tools/maxent')
+CACHE_PATH = os.path.expandvars('$SILVA_PATH/data')
 GOOD_SCORE = 2
+# Set to score sites with the original Perl scripts instead of MaxEntScan
+USE_PERL = bool(os.getenv('SILVA_MAXENT_PERL'))
+# Set to score all sites, without reading or writing the site score caches
+NO_CACHE = bool(os.getenv('SILVA_MAXENT_NO_CACHE'))
+
+_scorer = None
+_caches = {}
 
 class Seq(object):
     seq_re=re.compile('([ACGT]*)\[([ACGT])/([ACGT])\]([ACGT]*)')
@@ -216,7 +227,59 @@ def parse_maxent_output(output):
             
     return scores
 
+def get_cache(side):
+    """Return (lazily-loaded) site score cache for side, or None
+
+    The open caches are saved once, when the process exits.
+    """
+    if NO_CACHE:
+        return None
+    if not _caches:
+        atexit.register(save_caches)
+    if side not in _caches:
+        _caches[side] = sitecache.open_cache(side, MAXENT_PATH, CACHE_PATH)
+    return _caches[side]
+
+def save_caches():
+    """Save new scores and recency of all open site score caches"""
+    for cache in _caches.values():
+        if cache is not None:
+            cache.save()
+
 def score_sites(side, sites):
+    """Return dict: site -> score, for 5' (9-mer) or 3' (23-mer) sites
+
+    Sites are looked up in the cache for side first, and only the rest
+    are scored (and added to the cache).
+    """
+    cache = get_cache(side)
+    if cache is None:
+        return compute_sites(side, sites)
+
+    scores, misses = cache.lookup(sites)
+    if misses:
+        if side == 5 and not USE_PERL:
+            # Scoring every 5' site at once is about as fast as scoring
+            # a batch, and completes the table
+            new_scores = compute_sites(side, sitecache.all_sites(side))
+        else:
+            new_scores = compute_sites(side, misses)
+        cache.update(new_scores)
+        scores.update([(site, new_scores[site]) for site in misses])
+
+    return scores
+
+def compute_sites(side, sites):
+    """Return dict: site -> score, scoring all sites"""
+    if USE_PERL:
+        return score_sites_perl(side, sites)
+
+    global _scorer
+    if _scorer is None:
+        _scorer = MaxEntScan(MAXENT_PATH)
+    return _scorer.score(side, sites)
+
+def score_sites_perl(side, sites):
     assert side == 5 or side == 3
     script = 'score%d.pl' % side
     p = Popen(['/usr/bin/perl', script, '-'],
@@ -230,7 +293,7 @@ def score_sites(side, sites):
     return scores
 
 
-def print_row(scores):
+def format_row(scores):
     strs = []
     for val in scores:
         if val is None:
@@ -243,20 +306,13 @@ def print_row(scores):
             except TypeError:
                 strs.append(str(val))
 
-    print '\t'.join(strs)
+    return strs
 
-def script(filename, quiet=False, verbose=False, **kwargs):
-    fields = ['MES', 'dMES', 'MES+', 'MES-', 'MEC-MC?', 'MEC-CS?', 'MES-KM?']
-    print '#%s' % '\t'.join(fields)
-    NULL = [None] * len(fields)
+def print_row(scores):
+    print '\t'.join(format_row(scores))
 
-    seqs = []
-    with maybe_gzip_open(filename) as ifp:
-        for line in ifp:
-            line = line.strip()
-            if line:
-                seqs.append(Seq(line))
-                
+def score_seqs(seqs):
+    """Return list of field-wise max of 3' and 5' scores, for each Seq"""
     sites = {}
     scores = {}
     # Accumulate sites for each side
@@ -268,10 +324,24 @@ def script(filename, quiet=False, verbose=False, **kwargs):
         # Score ALL sites at once!
         scores[side] = score_sites(side, sites[side])
 
+    # Compute field-wise max of rows for 3' and 5'
+    return [map(max, s.score(3, scores[3]), s.score(5, scores[5]))
+            for s in seqs]
+
+def script(filename, quiet=False, verbose=False, **kwargs):
+    fields = ['MES', 'dMES', 'MES+', 'MES-', 'MEC-MC?', 'MEC-CS?', 'MES-KM?']
+    print '#%s' % '\t'.join(fields)
+    NULL = [None] * len(fields)
+
+    seqs = []
+    with maybe_gzip_open(filename) as ifp:
+        for line in ifp:
+            line = line.strip()
+            if line:
+                seqs.append(Seq(line))
+                
     # Print stats for each object, given queried scores
-    for s in seqs:
-        # Compute field-wise max of rows for 3' and 5'
-        max_row = imap(max, s.score(3, scores[3]), s.score(5, scores[5]))
+    for max_row in score_seqs(seqs):
         print_row(max_row)
 
 def run_tests():
@@ -323,10 +393,26 @@ def parse_args(args):
                       " for additional processing")
     parser.add_option("-v", "--verbose", default=False,
                       dest="verbose", action='store_true')
+    parser.add_option("--perl", default=False,
+                      dest="perl", action='store_true',
+                      help="Score sites with the MaxEntScan Perl scripts"
+                      " (also set by SILVA_MAXENT_PERL)")
+    parser.add_option("--no-cache", default=False,
+                      dest="no_cache", action='store_true',
+                      help="Score all sites, without reading or writing"
+                      " $SILVA_PATH/data/maxent*.cache.npz"
+                      " (also set by SILVA_MAXENT_NO_CACHE)")
     parser.add_option("--test", default=False,
                       dest="test", action='store_true')
     options, args = parser.parse_args()
 
+    if options.perl:
+        global USE_PERL
+        USE_PERL = True
+    if options.no_cache:
+        global NO_CACHE
+        NO_CACHE = True
+
     if options.test:
         sys.exit(run_tests())
 
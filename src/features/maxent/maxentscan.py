@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+"""
+Native implementation of the MaxEntScan splice site models of score5.pl
+(5' sites: 9-mers, 3 exonic + 6 intronic bases) and score3.pl (3' sites:
+23-mers, 20 intronic + 3 exonic bases) from tools/maxent.
+
+The same score tables are read from tools/maxent, once, and arrays of
+sites are scored in bulk, with the same arithmetic as the Perl scripts
+(so scores rounded to 2 decimals, as printed by them, are identical).
+
+Yeo G, Burge CB. Maximum entropy modeling of short sequence motifs with
+applications to RNA splicing signals. J Comput Biol. 2004;11(2-3):377-94.
+"""
+
+# Author: Orion Buske
+# Date:   ...
+
+from __future__ import division, with_statement
+
+import os
+import sys
+
+from numpy import array, zeros, empty, log, int64, float64
+
+assert os.getenv('SILVA_PATH') is not None, \
+    "Error: SILVA_PATH is unset."
+sys.path.insert(0, os.path.expandvars('$SILVA_PATH/lib/python'))
+from silva.kmers import nuc_codes
+
+MAXENT_PATH = os.path.expandvars('$SILVA_PATH/tools/maxent')
+
+# Nucleotide probabilities, in NUCS order
+BGD = array([0.27, 0.23, 0.23, 0.27])
+# Consensus GT of 5' sites (at positions 3 and 4)
+CONS5 = [(3, array([0.004, 0.0032, 0.9896, 0.0032])),
+         (4, array([0.0034, 0.0039, 0.0042, 0.9884]))]
+# Consensus AG of 3' sites (at positions 18 and 19)
+CONS3 = [(18, array([0.9903, 0.0032, 0.0034, 0.0030])),
+         (19, array([0.0027, 0.0037, 0.9905, 0.0030]))]
+
+# Positions of the non-consensus bases of each site
+REST5 = [0, 1, 2, 5, 6, 7, 8]
+REST3 = range(18) + [20, 21, 22]
+# (offset, length) into the non-consensus 3' bases for each me2x3acc table
+# (numerator tables first, then denominator tables)
+ACC_NUMERATOR = [(0, 7), (7, 7), (14, 7), (4, 7), (11, 7)]
+ACC_DENOMINATOR = [(4, 3), (7, 4), (11, 3), (14, 4)]
+
+SITE_LENGTH = {5: 9, 3: 23}
+
+
+def read_values(filename):
+    """Return list of the (whitespace-stripped) lines of a model file"""
+    with open(filename) as ifp:
+        return [line.strip() for line in ifp]
+
+def encode(sites, length):
+    """Return array [site, position] of NUCS indices (sites must be
+    uppercase)"""
+    codes = nuc_codes(''.join(sites))
+    codes = codes.reshape((len(sites), length))
+    if (codes < 0).any():
+        raise KeyError("Invalid nucleotide in splice sites")
+    return codes
+
+def hash_codes(codes):
+    """Return base-4 hash of each row of codes (first column most
+    significant), as in hashseq of score3.pl"""
+    hashes = zeros(codes.shape[0], dtype=int64)
+    for i in xrange(codes.shape[1]):
+        hashes *= 4
+        hashes += codes[:, i]
+    return hashes
+
+def log2(values):
+    return log(values) / log(2)
+
+
+class MaxEntScan(object):
+    def __init__(self, dirname=MAXENT_PATH):
+        """Load score tables from a MaxEntScan installation directory"""
+        self.dirname = dirname
+
+        # 5': me2x5[i] is the score of the i-th 7-mer of splice5sequences
+        scores = [value for value in
+                  read_values(os.path.join(dirname, 'me2x5')) if value]
+        seqs = [value for value in
+                read_values(os.path.join(dirname, 'splicemodels',
+                                         'splice5sequences')) if value]
+        assert len(seqs) == len(scores) == 4 ** len(REST5), \
+            "Unexpected 5' model size in %s" % dirname
+        table = empty(len(seqs), dtype=float64)
+        table[hash_codes(encode(seqs, len(REST5)))] = \
+            array([float(score) for score in scores])
+        self.me2x5 = table
+
+        # 3': me2x3accN[i] is the score of the 7/4/3-mer with hash i
+        self.me2x3acc = []
+        for i, (offset, length) in enumerate(ACC_NUMERATOR +
+                                             ACC_DENOMINATOR):
+            filename = os.path.join(dirname, 'splicemodels',
+                                    'me2x3acc%d' % (i + 1))
+            values = [float(value) for value in read_values(filename)
+                      if value]
+            assert len(values) == 4 ** length, \
+                "Unexpected 3' model size: %s" % filename
+            self.me2x3acc.append(array(values, dtype=float64))
+
+    @staticmethod
+    def _consensus(codes, cons):
+        """Return consensus score, computed in the same order as
+        scoreconsensus: cons1 * cons2 / (bgd1 * bgd2)"""
+        (pos1, cons1), (pos2, cons2) = cons
+        return cons1[codes[:, pos1]] * cons2[codes[:, pos2]] / \
+            (BGD[codes[:, pos1]] * BGD[codes[:, pos2]])
+
+    def score5(self, sites):
+        """Return array of MaxEnt scores of 9-mer 5' sites"""
+        codes = encode(sites, SITE_LENGTH[5])
+        rest = self.me2x5[hash_codes(codes[:, REST5])]
+        return log2(self._consensus(codes, CONS5) * rest)
+
+    def score3(self, sites):
+        """Return array of MaxEnt scores of 23-mer 3' sites"""
+        codes = encode(sites, SITE_LENGTH[3])
+        rest = codes[:, REST3]
+        scores = [table[hash_codes(rest[:, offset:offset + length])]
+                  for table, (offset, length) in
+                  zip(self.me2x3acc, ACC_NUMERATOR + ACC_DENOMINATOR)]
+        numerator = scores[0] * scores[1] * scores[2] * scores[3] * scores[4]
+        denominator = scores[5] * scores[6] * scores[7] * scores[8]
+        return log2(self._consensus(codes, CONS3) *
+                    (numerator / denominator))
+
+    def score(self, side, sites):
+        """Return dict: site -> score, rounded as printed by score5.pl and score3.pl"""
+        assert side == 5 or side == 3
+        sites = list(sites)
+        if not sites:
+            return {}
+        if side == 5:
+            scores = self.score5(sites)
+        else:
+            scores = self.score3(sites)
+        return dict([(site, float('%.2f' % score))
+                     for site, score in zip(sites, scores.tolist())])
+
+
+def main(args=sys.argv[1:]):
+    """Usage: maxentscan.py (5|3) < SITES
+
+    Prints each site and its score, like score5.pl and score3.pl
+    """
+    if len(args) != 1 or args[0] not in ['5', '3']:
+        print >>sys.stderr, main.__doc__
+        sys.exit(1)
+
+    sites = [line.strip().upper() for line in sys.stdin if line.strip()]
+    scores = MaxEntScan().score(int(args[0]), sites)
+    for site in sites:
+        print '%s\t%.2f' % (site, scores[site])
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+
+"""
+Persistent caches of MaxEnt splice site scores, so that sites shared by
+variants (and by runs over the same genes) are only scored once.
+
+5' sites (9-mers) are few enough to keep a full table of all 4^9 scores,
+indexed by the base-4 hash of the site, with NaN for sites not yet scored.
+3' sites (23-mers) are stored by hash in a sorted array, bounded to the
+most recently used sites.
+
+Each cache is saved atomically as a .npz file, along with a checksum of the
+model files it was scored with, and is ignored if those files change.
+"""
+
+# Author: Orion Buske
+# Date:   ...
+
+from __future__ import division, with_statement
+
+import os
+import sys
+import logging
+
+from hashlib import sha1
+from itertools import product
+
+from numpy import array, empty, concatenate, isnan, lexsort, load, savez, \
+    nan, int64, uint64, float64
+
+assert os.getenv('SILVA_PATH') is not None, \
+    "Error: SILVA_PATH is unset."
+sys.path.insert(0, os.path.expandvars('$SILVA_PATH/lib/python'))
+from silva.kmers import NUCS
+from maxentscan import SITE_LENGTH, encode, hash_codes
+
+# Maximum number of 3' sites to keep
+CAPACITY = int(os.getenv('SILVA_MAXENT_CACHE_SIZE', 1000000))
+MODEL_FILES = {5: ['me2x5', 'splicemodels/splice5sequences'],
+               3: ['splicemodels/me2x3acc%d' % i for i in range(1, 10)]}
+
+
+def model_checksum(dirname, side):
+    """Return sha1 hex digest of the MaxEntScan model files for side"""
+    digest = sha1()
+    for name in MODEL_FILES[side]:
+        with open(os.path.join(dirname, name), 'rb') as ifp:
+            digest.update(ifp.read())
+    return digest.hexdigest()
+
+def site_keys(side, sites):
+    """Return array of the base-4 hashes of sites"""
+    return hash_codes(encode(sites, SITE_LENGTH[side])).astype(uint64)
+
+def all_sites(side):
+    """Return list of all possible sites, in hash order"""
+    return [''.join(site) for site in product(NUCS, repeat=SITE_LENGTH[side])]
+
+
+class SiteCache(object):
+    """Base class for a cache of site scores saved to filename
+
+    Subclasses define lookup, update and _merge.
+    """
+    def __init__(self, filename, checksum):
+        self.filename = filename
+        self.checksum = checksum
+        self.dirty = False
+
+    def _read(self):
+        """Return dict of arrays saved to filename, or None if the file
+        is missing, unreadable, or was scored with other model files"""
+        if not os.path.isfile(self.filename):
+            return None
+
+        try:
+            with open(self.filename, 'rb') as ifp:
+                data = load(ifp)
+                arrays = dict([(key, data[key]) for key in data.files])
+        except (IOError, ValueError, KeyError), e:
+            logging.warning("Ignoring unreadable cache %s: %s"
+                            % (self.filename, e))
+            return None
+
+        if str(arrays.pop('checksum', '')) != self.checksum:
+            logging.info("Ignoring cache for different models: %s"
+                         % self.filename)
+            return None
+
+        return arrays
+
+    def save(self):
+        """Merge with any cache saved since loading, and save atomically"""
+        if not self.dirty:
+            return
+
+        arrays = self._merge(self._read())
+        tmp_filename = '%s.tmp%d' % (self.filename, os.getpid())
+        try:
+            with open(tmp_filename, 'wb') as ofp:
+                savez(ofp, checksum=array(self.checksum), **arrays)
+            os.rename(tmp_filename, self.filename)
+        except (IOError, OSError), e:
+            logging.warning("Unable to save cache %s: %s"
+                            % (self.filename, e))
+        else:
+            self.dirty = False
+
+
+class SiteTable(SiteCache):
+    """Table of the scores of all 5' sites (NaN if not yet scored)"""
+    side = 5
+
+    def __init__(self, filename, checksum):
+        SiteCache.__init__(self, filename, checksum)
+        arrays = self._read()
+        if arrays is None:
+            self.scores = empty(4 ** SITE_LENGTH[self.side], dtype=float64)
+            self.scores.fill(nan)
+        else:
+            self.scores = arrays['scores']
+
+    def lookup(self, sites):
+        """Return (dict: site -> score, list of sites not in cache)"""
+        sites = list(sites)
+        if not sites:
+            return {}, []
+
+        values = self.scores[site_keys(self.side, sites)]
+        missing = isnan(values).tolist()
+        scores = dict([(site, value) for site, value, miss
+                       in zip(sites, values.tolist(), missing) if not miss])
+        return scores, [site for site, miss in zip(sites, missing) if miss]
+
+    def update(self, scores):
+        """Add dict: site -> score to cache"""
+        if scores:
+            sites = scores.keys()
+            self.scores[site_keys(self.side, sites)] = \
+                [scores[site] for site in sites]
+            self.dirty = True
+
+    def _merge(self, saved):
+        if saved is not None:
+            missing = isnan(self.scores)
+            self.scores[missing] = saved['scores'][missing]
+        return {'scores': self.scores}
+
+
+class SiteStore(SiteCache):
+    """Scores of the (at most capacity) most recently used 3' sites
+
+    Sites are stored by hash in sorted order, with the generation (run) in
+    which they were last used. The least recently used sites are dropped
+    whenever the cache is saved.
+    """
+    side = 3
+
+    def __init__(self, filename, checksum, capacity=CAPACITY):
+        SiteCache.__init__(self, filename, checksum)
+        self.capacity = capacity
+        arrays = self._read()
+        if arrays is None:
+            self.keys = array([], dtype=uint64)
+            self.scores = array([], dtype=float64)
+            self.stamps = array([], dtype=int64)
+            self.generation = 0
+        else:
+            self.keys = arrays['keys']
+            self.scores = arrays['scores']
+            self.stamps = arrays['stamps']
+            self.generation = int(arrays['generation']) + 1
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, sites):
+        """Return (dict: site -> score, list of sites not in cache)"""
+        sites = list(sites)
+        if not sites or not len(self.keys):
+            return {}, sites
+
+        keys = site_keys(self.side, sites)
+        indices = self.keys.searchsorted(keys)
+        indices[indices == len(self.keys)] = 0
+        found = self.keys[indices] == keys
+        # Mark the sites used in this generation, so the cache is saved
+        # with their recency even if no new sites are scored
+        if found.any():
+            self.stamps[indices[found]] = self.generation
+            self.dirty = True
+
+        scores = self.scores[indices].tolist()
+        found = found.tolist()
+        return (dict([(site, score) for site, score, hit
+                      in zip(sites, scores, found) if hit]),
+                [site for site, hit in zip(sites, found) if not hit])
+
+    def update(self, scores):
+        """Add dict: site -> score to cache"""
+        if scores:
+            sites = scores.keys()
+            stamps = empty(len(sites), dtype=int64)
+            stamps.fill(self.generation)
+            self._combine(site_keys(self.side, sites),
+                          array([scores[site] for site in sites],
+                                dtype=float64),
+                          stamps)
+            self.dirty = True
+
+    def _combine(self, keys, scores, stamps):
+        """Add arrays of sites to cache, keeping the most recent stamp of
+        any duplicates and then the capacity most recent sites"""
+        keys = concatenate([self.keys, keys])
+        scores = concatenate([self.scores, scores])
+        stamps = concatenate([self.stamps, stamps])
+        order = lexsort((stamps, keys))
+        sorted_keys = keys[order]
+        # Last (most recent) of each run of equal keys
+        order = order[concatenate([sorted_keys[1:] != sorted_keys[:-1],
+                                   [True]])]
+        if len(order) > self.capacity:
+            # Keep the most recent, preserving key order
+            recent = stamps[order].argsort(kind='mergesort')
+            recent = recent[-self.capacity:]
+            recent.sort()
+            order = order[recent]
+
+        self.keys = keys[order]
+        self.scores = scores[order]
+        self.stamps = stamps[order]
+
+    def _merge(self, saved):
+        if saved is not None:
+            self._combine(saved['keys'], saved['scores'], saved['stamps'])
+        return {'keys': self.keys, 'scores': self.scores,
+                'stamps': self.stamps,
+                'generation': array(self.generation, dtype=int64)}
+
+
+def open_cache(side, model_dirname, cache_dirname):
+    """Return SiteTable (5') or SiteStore (3') in cache_dirname for the
+    models in model_dirname, or None if the models cannot be read"""
+    try:
+        checksum = model_checksum(model_dirname, side)
+    except IOError, e:
+        logging.warning("Not caching MaxEnt scores: %s" % e)
+        return None
+
+    filename = os.path.join(cache_dirname, 'maxent%d.cache.npz' % side)
+    if side == 5:
+        return SiteTable(filename, checksum)
+    else:
+        return SiteStore(filename, checksum)
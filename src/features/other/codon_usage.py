@@ -71,19 +71,21 @@ def iter_lines(filename):
         for line in ifp:
             line = line.strip()
             if not line or line.startswith('#'): continue
-            ref, alt, strand, codon, offset = line.split()[:5]
-            assert strand in set(['+', '-', '.'])
-            assert len(ref) == len(alt) == 1
-            assert len(codon) == 3
-            offset = int(offset)
-            if strand == '-':
-                ref = COMPLEMENT[ref]
-                alt = COMPLEMENT[alt]
-                
-            assert codon[offset] == ref
-            new_codon = codon[:offset] + alt + codon[offset+1:]
-
-            yield codon, new_codon
+            yield mutate_codon(*line.split()[:5])
+
+def mutate_codon(ref, alt, strand, codon, offset):
+    """Return (old codon, new codon) for genomic ref/alt nucleotides"""
+    assert strand in set(['+', '-', '.'])
+    assert len(ref) == len(alt) == 1
+    assert len(codon) == 3
+    offset = int(offset)
+    if strand == '-':
+        ref = COMPLEMENT[ref]
+        alt = COMPLEMENT[alt]
+
+    assert codon[offset] == ref
+    new_codon = codon[:offset] + alt + codon[offset+1:]
+    return codon, new_codon
 
 def calc_delta_rscu(old_codon, new_codon):
     """Return change in relative synonymous codon usage (RSCU):
@@ -54,6 +54,15 @@ def calc_cpg(seq):
         return seq.count('CG') * len(seq) / float(denom)
     else:
         return 0
+
+def score_exon(pre, old, new, post):
+    """Return (whether mutation alters a CpG, obs/exp CpG in exon)"""
+    # Was a CpG created or destroyed by the mutation?
+    mut_cpg = bool((pre and  pre[-1] == 'C' and (old == 'G' or new == 'G')) or 
+                   (post and post[0] == 'G' and (old == 'C' or new == 'C')))
+
+    exon = pre+old+post
+    return mut_cpg, calc_cpg(exon)
                     
 def script(filename, quiet=False, **kwargs):
     fields = ['CpG?', 'CpG_exon']
@@ -63,13 +72,7 @@ def script(filename, quiet=False, **kwargs):
             print '\t'.join(['na'] * len(fields))
             continue
         
-        pre, old, new, post = entry
-        # Was a CpG created or destroyed by the mutation?
-        mut_cpg = bool((pre and  pre[-1] == 'C' and (old == 'G' or new == 'G')) or 
-                       (post and post[0] == 'G' and (old == 'C' or new == 'C')))
-
-        exon = pre+old+post
-        cpg_exon = calc_cpg(exon)
+        mut_cpg, cpg_exon = score_exon(*entry)
         print '%d\t%.4f' % (mut_cpg, cpg_exon)
 
 def parse_args(args):
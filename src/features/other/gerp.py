@@ -1,22 +1,23 @@
 #!/usr/bin/env python
 
 """
-Usage: gerp.py TABLE [TABLE.pkl] < POSITIONS > GERP
+Usage: gerp.py TABLE [STORE] < POSITIONS > GERP
 
 Given input lines of the form: chrom, pos, ...
 (with pos 1-indexed), prints the corresponding GERP
 score. Reads table of scores from TABLE, with lines
-of the form: score, chrom, pos, .... If TABLE.pkl is
+of the form: score, chrom, pos, .... If STORE is
 specified, and exists, data is read from it instead.
 If it does not exist, it is created from the data in
-TABLE, allowing faster data retrieval in the future.
+TABLE: a directory of sorted, memory-mapped arrays
+(see silva.store), so that future runs only read the
+scores of the positions they look up.
 """
 
 from __future__ import with_statement, division
 
 import os
 import sys
-import cPickle
 
 from collections import defaultdict
 
@@ -24,56 +25,82 @@ assert os.getenv('SILVA_PATH') is not None, \
        "Error: SILVA_PATH is unset."
 sys.path.insert(0, os.path.expandvars('$SILVA_PATH/lib/python'))
 from silva import maybe_gzip_open
+from silva.store import PositionStore, new_columns
 
-args = sys.argv[1:]
-
-if sys.stdin.isatty():
-    print >>sys.stderr, __doc__
-    sys.exit(1)
-
-if len(args) == 1:
-    optfile = None
-elif len(args) == 2:
-    optfile = args[1]
-else:
-    print >>sys.stderr, __doc__
-    sys.exit(1)
-    
-tablefile = args[0]
+from numpy import uint32
 
 def read_table(filename, optfile=None):
-    data = defaultdict(dict)
+    data = defaultdict(new_columns)
     with maybe_gzip_open(filename) as ifp:
         for line in ifp:
             line = line.strip()
             if not line or line.startswith('#'): continue
             value, chrom, pos = line.split()
-            data[chrom.lstrip('chr')][int(pos)] = float(value)
+            positions, values = data[chrom.lstrip('chr')]
+            positions.append(int(pos))
+            values.append(float(value))
 
-    if optfile and not os.path.isfile(optfile):
+    table = PositionStore.build(data, key_dtype=uint32)
+    if optfile and not os.path.exists(optfile):
         print >>sys.stderr, "Saving optimized table to:", optfile
-        with maybe_gzip_open(optfile, 'wb') as ofp:
-            cPickle.dump(data, ofp, cPickle.HIGHEST_PROTOCOL)
-
-    return data
-
-
-if optfile and os.path.isfile(optfile):
-    print >>sys.stderr, "Loading optimized table from:", optfile
-    with maybe_gzip_open(optfile, 'rb') as ifp:
-        table = cPickle.load(ifp)
-else:
-    print >>sys.stderr, "Loading table from:", tablefile
-    table = read_table(tablefile, optfile)
-
-print '#GERP++'
-for line in sys.stdin:
-    line = line.strip()
-    if not line or line.startswith('#'): continue
-    chrom, pos = line.split(None)
-    try:
-        value = '%.4f' % table[chrom.lstrip('chr')][int(pos)]
-    except (IndexError, KeyError):
-        value = 'na'
-        
-    print value
+        table.save(optfile)
+
+    return table
+
+
+def load_table(tablefile, optfile=None):
+    if optfile and os.path.isdir(optfile):
+        print >>sys.stderr, "Loading optimized table from:", optfile
+        return PositionStore.load(optfile)
+    else:
+        if optfile and os.path.exists(optfile):
+            print >>sys.stderr, "Ignoring old optimized table:", optfile
+        print >>sys.stderr, "Loading table from:", tablefile
+        return read_table(tablefile, optfile)
+
+def format_score(found, value):
+    return '%.4f' % value if found else 'na'
+
+def get_score(table, chrom, pos):
+    """Return formatted GERP score, or 'na' if not found"""
+    found, values = table.lookup_batch(chrom.lstrip('chr'), [int(pos)])
+    return format_score(found[0], values[0])
+
+def get_scores(table, loci):
+    """Return formatted GERP scores (or 'na') for list of (chrom, pos)
+
+    Positions are looked up in one batch per chromosome.
+    """
+    by_chrom = defaultdict(list)
+    for i, (chrom, pos) in enumerate(loci):
+        by_chrom[chrom.lstrip('chr')].append(i)
+
+    scores = [None] * len(loci)
+    for chrom, indices in by_chrom.iteritems():
+        found, values = table.lookup_batch(chrom, [int(loci[i][1])
+                                                   for i in indices])
+        for i, is_found, value in zip(indices, found.tolist(),
+                                      values.tolist()):
+            scores[i] = format_score(is_found, value)
+
+    return scores
+
+def script(tablefile, optfile=None):
+    table = load_table(tablefile, optfile)
+
+    print '#GERP++'
+    for line in sys.stdin:
+        line = line.strip()
+        if not line or line.startswith('#'): continue
+        chrom, pos = line.split(None)
+        print get_score(table, chrom, pos)
+
+def main(args=sys.argv[1:]):
+    if sys.stdin.isatty() or len(args) not in [1, 2]:
+        print >>sys.stderr, __doc__
+        sys.exit(1)
+
+    script(*args)
+
+if __name__ == '__main__':
+    sys.exit(main())
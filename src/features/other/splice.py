@@ -19,31 +19,38 @@ assert os.getenv('SILVA_PATH') is not None, \
 sys.path.insert(0, os.path.expandvars('$SILVA_PATH/lib/python'))
 from silva import maybe_gzip_open, print_args
 
+def score_sequence(line):
+    """Return relative position of mutation in pre-mRNA and mRNA"""
+    assert line.count('/') == 1
+
+    pre, post = line.split('/')
+    # Trim off mutation nucs and brackets
+    pre = pre[:-2]  # e,g, '[A'
+    post = post[2:]  # e.g. 'C]'
+
+    pre_chunks = pre.split('|')
+    post_chunks = post.split('|')
+    # Assume mutation is in exon
+
+    pre_cds = ''.join(pre_chunks[::2])
+    post_cds = ''.join(post_chunks[::2])
+    #splice_dist = min(len(pre_chunks[-1]), len(post_chunks[0]))
+    return score_lengths(len(pre), len(post), len(pre_cds), len(post_cds))
+
+def score_lengths(pre, post, pre_cds, post_cds):
+    """Return relative position of mutation in pre-mRNA and mRNA, given
+    the lengths of the sequence before and after it"""
+    premrna_f = min(pre, post) / (pre + post + 1)
+    mrna_f = min(pre_cds, post_cds) / (pre_cds + post_cds + 1)
+    return premrna_f, mrna_f
+
 def script(filename, quiet=False, verbose=False, **kwargs):
     fields = ['f_premrna', 'f_mrna']  #, 'splice_dist']
     print '#%s' % '\t'.join(fields)
     with maybe_gzip_open(filename) as ifp:
         for line in ifp:
             line = line.strip().upper()
-            assert line.count('/') == 1
-
-            pre, post = line.split('/')
-            # Trim off mutation nucs and brackets
-            pre = pre[:-2]  # e,g, '[A'
-            post = post[2:]  # e.g. 'C]'
-
-            pre_chunks = pre.split('|')
-            post_chunks = post.split('|')
-            # Assume mutation is in exon
-
-            premrna_f = min(len(pre), len(post)) \
-                           / (len(pre) + len(post) + 1)
-            pre_cds = ''.join(pre_chunks[::2])
-            post_cds = ''.join(post_chunks[::2])
-            mrna_f = min(len(pre_cds), len(post_cds)) \
-                        / (len(pre_cds) + len(post_cds) + 1)
-            #splice_dist = min(len(pre_chunks[-1]), len(post_chunks[0]))
-
+            premrna_f, mrna_f = score_sequence(line)
             print '%.4f\t%.4f' % (premrna_f, mrna_f) #, splice_dist)
 
 def parse_args(args):
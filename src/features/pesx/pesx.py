@@ -18,21 +18,20 @@ import os
 import sys
 import re
 
+from itertools import islice
+
 assert os.getenv('SILVA_PATH') is not None, \
        "Error: SILVA_PATH is unset."
 sys.path.insert(0, os.path.expandvars("$SILVA_PATH/lib/python"))
 from silva import maybe_gzip_open, print_args
+from silva.kmers import KmerSet, encode
+
+# Number of sequences scored together
+CHUNK_SIZE = 10000
 
 def octamer_subsequences(octs, seq):
     """Return dict: pos -> octamer found in seq"""
-    found = dict()
-    motif_len = 8  # octamers
-    for offset in xrange(0, len(seq) - motif_len + 1):
-        target_seq = seq[offset: offset + motif_len]
-        if target_seq in octs:
-            found[offset] = target_seq
-
-    return found
+    return octs.find(seq)
 
 def score_mutation(octs, old_seq, new_seq):
     """Return differences in oct hits between new and old sequences
@@ -45,6 +44,59 @@ def score_mutation(octs, old_seq, new_seq):
     new_pos = set(new)
     return len(old_pos - new_pos), len(new_pos - old_pos)
 
+def safe_div(num, denom):
+    if num + denom > 0:
+        return '%.4f' % (num / (num + denom))
+    else:
+        return 'na'
+
+def score_exons(pese_set, pess_set, exons):
+    """Return list of (# pESE, # lost, # gained, # pESS, # lost, # gained)
+
+    Each exon is (pre, old, new, post), and the octamers of all exons are
+    matched at once.
+    """
+    olds = []
+    short_olds = []
+    short_news = []
+    for pre, nuc_old, nuc_new, post in exons:
+        olds.append(pre + nuc_old + post)
+        short_olds.append(pre[-7:] + nuc_old + post[:7])
+        short_news.append(pre[-7:] + nuc_new + post[:7])
+
+    # Encode sequences once, for both sets
+    encoded = encode(olds)
+    encoded_shorts = (encode(short_olds), encode(short_news))
+    columns = []
+    for octs in [pese_set, pess_set]:
+        columns.append(octs.count(olds, encoded))
+        columns.extend(octs.count_changes(short_olds, short_news,
+                                          encoded_shorts))
+    return zip(*[column.tolist() for column in columns])
+
+def score_exon(pese_set, pess_set, pre, nuc_old, nuc_new, post):
+    """Return (# pESE, # lost, # gained, # pESS, # lost, # gained)"""
+    return score_exons(pese_set, pess_set,
+                       [(pre, nuc_old, nuc_new, post)])[0]
+
+def fractions(n_old_pese, pese_down, pese_up,
+              n_old_pess, pess_down, pess_up):
+    """Return fractions of pESEs lost and gained, then pESSs, as strings"""
+    return [safe_div(pese_down, n_old_pese),
+            safe_div(pese_up, n_old_pese),
+            safe_div(pess_down, n_old_pess),
+            safe_div(pess_up, n_old_pess)]
+
+def score_fractions(pese_set, pess_set, pre, nuc_old, nuc_new, post):
+    """Return fractions of pESEs lost and gained, then pESSs, as strings"""
+    return fractions(*score_exon(pese_set, pess_set,
+                                 pre, nuc_old, nuc_new, post))
+
+def score_all_fractions(pese_set, pess_set, exons):
+    """Return score_fractions for each exon, matching all at once"""
+    return [fractions(*counts)
+            for counts in score_exons(pese_set, pess_set, exons)]
+
 def read_octamers(filename):
     octs = []
     with open(filename) as ifp:
@@ -55,7 +107,7 @@ def read_octamers(filename):
                 octs.append(line.upper())
             else:
                 print >>sys.stderr, "Found invalid octamer: %s" % line
-    return set(octs)
+    return KmerSet(octs, k=8)
 
 def iter_sequences(filename):
     seq_re = re.compile(r'([ACGT]*)\[([ACGT])/([ACGT])\]([ACGT]*)')
@@ -85,35 +137,21 @@ def script(filename, pese_filename='pese262.txt',
         print '#n_pESE\t+\t-\tn_pESS\t+\t-'
         NULL = '\t'.join(['na'] * 6)
         
-    for entry in iter_sequences(filename):
-        if entry is None:
-            print NULL
-            continue
-        
-        pre, nuc_old, nuc_new, post = entry
-        old = pre + nuc_old + post
-        short_old = pre[-7:] + nuc_old + post[:7]
-        short_new = pre[-7:] + nuc_new + post[:7]
-        
-        n_old_pese = len(octamer_subsequences(pese_set, old))
-        n_old_pess = len(octamer_subsequences(pess_set, old))
-        
-        pese_down, pese_up = score_mutation(pese_set, short_old, short_new)
-        pess_down, pess_up = score_mutation(pess_set, short_old, short_new)
-        def safe_div(num, denom):
-            if num + denom > 0:
-                return '%.4f' % (num / (num + denom))
+    entries = iter_sequences(filename)
+    while True:
+        chunk = list(islice(entries, CHUNK_SIZE))
+        if not chunk:
+            break
+        results = iter(score_exons(pese_set, pess_set,
+                                   [entry for entry in chunk
+                                    if entry is not None]))
+        for entry in chunk:
+            if entry is None:
+                print NULL
+            elif quiet:
+                print '\t'.join(fractions(*results.next()))
             else:
-                return 'na'
-
-        if quiet:
-            print '\t'.join([safe_div(pese_down, n_old_pese),
-                             safe_div(pese_up, n_old_pese),
-                             safe_div(pess_down, n_old_pess),
-                             safe_div(pess_up, n_old_pess)])
-        else:
-            print '\t'.join([str(x) for x in [n_old_pese, pese_down, pese_up,
-                                              n_old_pess, pess_down, pess_up]])
+                print '\t'.join([str(x) for x in results.next()])
 
 def parse_args(args):
     from optparse import OptionParser
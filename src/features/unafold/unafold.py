@@ -35,64 +35,92 @@ def score_sequence(*seqs):
     assert len(output) == len(seqs)
     return output
 
-def iter_sequences(filename, domain=None, **kwargs):
-    def get_mut_seqs(seq):
-        pre, post = seq.split('/')
-        pre, old = pre.split('[')
-        new, post = post.split(']')
-
-        if domain:
-            pre_len = min(len(pre), domain)
-            post_len = min(len(post), domain)
-            # If too close to one end of sequence, accomodate
-            if pre_len < domain:
-                post_len = min(len(post), 2*domain - pre_len)
-            if post_len < domain:
-                pre_len = min(len(pre), 2*domain - post_len)
-
-            pre = pre[-pre_len:]
-            post = post[:post_len]
-            assert len(pre) + len(post) == 2 * domain
-
-        return pre + old + post, pre + new + post
-
+def get_mut_seqs(seq, domain=None):
+    pre, post = seq.split('/')
+    pre, old = pre.split('[')
+    new, post = post.split(']')
+
+    if domain:
+        pre_len = min(len(pre), domain)
+        post_len = min(len(post), domain)
+        # If too close to one end of sequence, accomodate
+        if pre_len < domain:
+            post_len = min(len(post), 2*domain - pre_len)
+        if post_len < domain:
+            pre_len = min(len(pre), 2*domain - post_len)
+
+        pre = pre[-pre_len:]
+        post = post[:post_len]
+        assert len(pre) + len(post) == 2 * domain
+
+    return pre + old + post, pre + new + post
+
+def split_seq(seq):
+    """Return (pre-mRNA, mRNA) mutation strings for sequence, without
+    splice markers"""
+    premrna = seq.replace('|', '')
+    postmrna = ''.join(seq.split('|')[::2])
+    return premrna, postmrna
+
+def get_seqs(seq, domain=None):
+    """Return mutated (pre-mRNA, mRNA) sequence pairs for sequence"""
+    premrna, postmrna = split_seq(seq)
+    return get_mut_seqs(premrna, domain), get_mut_seqs(postmrna, domain)
+
+def iter_sequences(filename):
     with maybe_gzip_open(filename) as ifp:
         for line in ifp:
-            seq = line.strip().upper()
-            try:
-                premrna = seq.replace('|', '')
-                postmrna = ''.join(seq.split('|')[::2])
-                yield get_mut_seqs(premrna), get_mut_seqs(postmrna)
-            except (ValueError, AssertionError):
-                print >>sys.stderr, "Error, invalid sequence: %s" % seq
-                yield None
+            yield line.strip().upper()
 
-def script(filename, quiet=False, domain=None, **kwargs):
+def get_fields(domain=None):
     fields = ['pdG_pre', 'pdG_post']
     if domain is not None:
         fields = ['%s_%d' % (field, domain) for field in fields]
-        
-    print "#%s" % '\t'.join(fields)
-    seqs = []
-    for entry in iter_sequences(filename, domain=domain, **kwargs):
-        if entry is None:
-            print '\t'.join(['na'] * len(fields))
-            continue
-        
-        seqs.extend(entry[0])
-        seqs.extend(entry[1])
-        
-    scores = score_sequence(*seqs)
+    return fields
+
+def score_entries(seqs, domain=None):
+    """Return list of formatted (pre-mRNA, mRNA) scores for each sequence"""
+    return score_pairs([split_seq(seq) for seq in seqs], domain)
+
+def score_pairs(pairs, domain=None):
+    """Return list of formatted (pre-mRNA, mRNA) scores for each pair of
+    (pre-mRNA, mRNA) mutation strings (see split_seq)"""
+    entries = []
+    to_score = []
+    for premrna, postmrna in pairs:
+        try:
+            entry = (get_mut_seqs(premrna, domain),
+                     get_mut_seqs(postmrna, domain))
+        except (ValueError, AssertionError):
+            print >>sys.stderr, "Error, invalid sequence: %s" % premrna
+            entry = None
+        else:
+            to_score.extend(entry[0])
+            to_score.extend(entry[1])
+        entries.append(entry)
+
+    scores = iter(score_sequence(*to_score)) if to_score else iter([])
 
     def safe_f(new, old):
         try:
             return '%.4f' % -log10(new / old)
         except ValueError:
             return 'na'
-        
-    for dg_pre_old, dg_pre_new, dg_post_old, dg_post_new in \
-            zip(scores[::4], scores[1::4], scores[2::4], scores[3::4]):
-        print '\t'.join([safe_f(dg_pre_new, dg_pre_old), safe_f(dg_post_new, dg_post_old)])
+
+    rows = []
+    for entry in entries:
+        if entry is None:
+            rows.append(['na', 'na'])
+        else:
+            pre_old, pre_new, post_old, post_new = [scores.next()
+                                                    for i in range(4)]
+            rows.append([safe_f(pre_new, pre_old), safe_f(post_new, post_old)])
+    return rows
+
+def script(filename, quiet=False, domain=None, **kwargs):
+    print "#%s" % '\t'.join(get_fields(domain))
+    for row in score_entries(iter_sequences(filename), domain=domain):
+        print '\t'.join(row)
 
 def parse_args(args):
     from optparse import OptionParser
@@ -1,23 +1,24 @@
 #!/usr/bin/env python
 
 """
-Usage: 1000gp.py VCF [VCF.pkl] < POSITIONS > AF
+Usage: 1000gp.py VCF [STORE] < POSITIONS > AF
 
 Given input lines of the form: chrom, pos, alt, ...
 (with pos 1-indexed), prints the corresponding
 allele frequencies (or '.' if not found).
 Reads allele frequencies from VCF file, with info fields
-containing AC and AN annotations. If VCF.pkl is
+containing AC and AN annotations. If STORE is
 specified, and exists, data is read from it instead.
 If it does not exist, it is created from the data in
-VCF, allowing faster data retrieval in the future.
+VCF: a directory of sorted, memory-mapped arrays (see
+silva.store), so that future runs only read the
+frequencies of the variants they look up.
 """
 
 from __future__ import with_statement, division
 
 import os
 import sys
-import cPickle
 
 from collections import defaultdict
 
@@ -25,25 +26,23 @@ assert os.getenv('SILVA_PATH') is not None, \
        "Error: SILVA_PATH is unset."
 sys.path.insert(0, os.path.expandvars('$SILVA_PATH/lib/python'))
 from silva import maybe_gzip_open
+from silva.store import PositionStore, new_columns
 
-args = sys.argv[1:]
+from numpy import uint64
 
-if sys.stdin.isatty():
-    print >>sys.stderr, __doc__
-    sys.exit(1)
+# Alleles are packed into the low 2 bits of the store keys: pos << 2 | allele
+ALLELE_CODES = dict([(nuc, i) for i, nuc in enumerate('ACGT')])
 
-if len(args) == 1:
-    optfile = None
-elif len(args) == 2:
-    optfile = args[1]
-else:
-    print >>sys.stderr, __doc__
-    sys.exit(1)
-    
-tablefile = args[0]
+def pack_key(pos, alt):
+    """Return store key of alt allele at pos, or None if alt is not a
+    single nucleotide"""
+    code = ALLELE_CODES.get(alt)
+    if code is None:
+        return None
+    return (int(pos) << 2) | code
 
 def read_table(filename, optfile=None):
-    data = defaultdict(dict)
+    data = defaultdict(lambda: new_columns('L'))
     with maybe_gzip_open(filename) as ifp:
         for line in ifp:
             line = line.strip()
@@ -51,50 +50,95 @@ def read_table(filename, optfile=None):
             tokens = line.split('\t')
             chrom, pos = tokens[:2]
             alt = tokens[4].split(',')[0]
-            info = tokens[7]
+            key = pack_key(pos, alt)
+            if key is None:
+                # Only single-nucleotide alleles can be looked up
+                continue
+
             # Split AC and AN from INFO field
-            fields = info.split(';')
-            fields.sort()
             ac = an = None
-            for field in fields:
+            for field in tokens[7].split(';'):
                 if field.startswith('AC='):
-                    ac = int(field.split('=')[1])
+                    ac = int(field[3:])
                     if an is not None:
                         break
                 elif field.startswith('AN='):
-                    an = int(field.split('=')[1])
+                    an = int(field[3:])
                     if ac is not None:
                         break
 
             assert ac is not None and an is not None, \
                    "Error: entry with AC and AN: %s" % line
-            
-            data[chrom.lstrip('chr')][(int(pos), alt)] = float(ac) / an
 
-    if optfile and not os.path.isfile(optfile):
+            keys, afs = data[chrom.lstrip('chr')]
+            keys.append(key)
+            # Rounded as printed (to 4 decimals). float32 does not hold most
+            # such values exactly, but is close enough that each prints back
+            # the same with '%.4f'
+            afs.append(float('%.4f' % (ac / an)))
+
+    table = PositionStore.build(data, key_dtype=uint64, bloom=True)
+    if optfile and not os.path.exists(optfile):
         print >>sys.stderr, "Saving optimized table to:", optfile
-        with maybe_gzip_open(optfile, 'wb') as ofp:
-            cPickle.dump(data, ofp, cPickle.HIGHEST_PROTOCOL)
-
-    return data
-
-
-if optfile and os.path.isfile(optfile):
-    print >>sys.stderr, "Loading optimized table from:", optfile
-    with maybe_gzip_open(optfile, 'rb') as ifp:
-        table = cPickle.load(ifp)
-else:
-    print >>sys.stderr, "Loading table from:", tablefile
-    table = read_table(tablefile, optfile)
-
-print '#1000GP_AF'
-for line in sys.stdin:
-    line = line.strip()
-    if not line or line.startswith('#'): continue
-    chrom, pos, alt = line.split()
-    try:
-        value = '%.4f' % table[chrom.lstrip('chr')][(int(pos), alt)]
-    except (IndexError, KeyError):
-        value = '.'
-        
-    print value
+        table.save(optfile)
+
+    return table
+
+
+def load_table(tablefile, optfile=None):
+    if optfile and os.path.isdir(optfile):
+        print >>sys.stderr, "Loading optimized table from:", optfile
+        return PositionStore.load(optfile)
+    else:
+        if optfile and os.path.exists(optfile):
+            print >>sys.stderr, "Ignoring old optimized table:", optfile
+        print >>sys.stderr, "Loading table from:", tablefile
+        return read_table(tablefile, optfile)
+
+def format_af(found, af):
+    return '%.4f' % af if found else '.'
+
+def get_af(table, chrom, pos, alt):
+    """Return formatted allele frequency, or '.' if not found"""
+    return get_afs(table, [(chrom, pos, alt)])[0]
+
+def get_afs(table, variants):
+    """Return formatted allele frequencies (or '.') for list of
+    (chrom, pos, alt)
+
+    Variants are looked up in one batch per chromosome.
+    """
+    by_chrom = defaultdict(list)
+    afs = ['.'] * len(variants)
+    for i, (chrom, pos, alt) in enumerate(variants):
+        key = pack_key(pos, alt)
+        if key is not None:
+            by_chrom[chrom.lstrip('chr')].append((i, key))
+
+    for chrom, queries in by_chrom.iteritems():
+        found, values = table.lookup_batch(chrom, [key for i, key in queries])
+        for (i, key), is_found, af in zip(queries, found.tolist(),
+                                          values.tolist()):
+            afs[i] = format_af(is_found, af)
+
+    return afs
+
+def script(tablefile, optfile=None):
+    table = load_table(tablefile, optfile)
+
+    print '#1000GP_AF'
+    for line in sys.stdin:
+        line = line.strip()
+        if not line or line.startswith('#'): continue
+        chrom, pos, alt = line.split()
+        print get_af(table, chrom, pos, alt)
+
+def main(args=sys.argv[1:]):
+    if sys.stdin.isatty() or len(args) not in [1, 2]:
+        print >>sys.stderr, __doc__
+        sys.exit(1)
+
+    script(*args)
+
+if __name__ == '__main__':
+    sys.exit(main())
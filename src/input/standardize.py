@@ -5,6 +5,13 @@ Print standardized (zero-mean, unit-stdev) FILE.mat,
 optionally based upon values in a control MAT file.
 If the header includes a 'class' column, it will be 
 left as is.
+
+The means and stdevs of a control MAT file are computed once and saved
+next to it (in CONTROL.stats.npz), along with a checksum of its contents,
+so they are only recomputed if the control file changes. FILE.mat is then
+read, standardized and printed in chunks of rows, in constant memory.
+The standardized values can also be written to a binary matrix file
+(see lib/python/silva/matrix.py), for reading without parsing.
 """
 
 # Author: Orion Buske
@@ -13,94 +20,187 @@ from __future__ import division, with_statement
 
 import os
 import sys
+import logging
 
-from numpy import array
+from hashlib import sha1
+from numpy import array, asarray, concatenate, column_stack, around, \
+    savez, load
 
 assert os.getenv('SILVA_PATH') is not None, \
     "Error: SILVA_PATH is unset."
 sys.path.insert(0, os.path.expandvars('$SILVA_PATH/lib/python'))
 from silva import maybe_gzip_open
+from silva.matrix import CHUNK_SIZE, MatrixWriter, read_header, iter_chunks
+
+STATS_EXT = '.stats.npz'
 
 
 def read_examples(filename):
-    lines = []
-    header = []
-    ncols = None
     with maybe_gzip_open(filename) as ifp:
-        header = ifp.readline().strip()
-        assert header.startswith('#')
-        header = header.replace('#', '')
-        for line in ifp:
-            line = line.strip()
-            if not line: continue
-
-            assert not line.startswith('#')
-            tokens = [float(val) for val in line.split()]
-            if ncols is None:
-                ncols = len(tokens)
-            else:
-                assert ncols == len(tokens), \
-                    "Found row in %s with %d columns (%d expected)" % (filename, len(tokens), ncols)
-
-            lines.append(tokens)
+        header, class_col = read_header(ifp)
+        chunks = list(iter_chunks(ifp, filename))
 
-    try:
-        data = array(lines, dtype=float)
-    except ValueError:
-        print >>sys.stderr
-
-    # Find class column
-    cols = header.split()
-    if cols[0] == 'class':
-        class_col = 0
+    if chunks:
+        data = concatenate(chunks)
     else:
-        class_col = None
-        
+        data = array([], dtype=float)
+
     return header, class_col, data
 
+def get_stats(data):
+    """Return (means, stds) of the columns of data"""
+    return data.mean(axis=0), data.std(axis=0)
+
+def file_checksum(filename):
+    """Return hex SHA-1 digest of the contents of filename"""
+    digest = sha1()
+    with open(filename, 'rb') as ifp:
+        for block in iter(lambda: ifp.read(1 << 20), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def stats_filename(control):
+    return os.path.splitext(control)[0] + STATS_EXT
+
+def control_stats(control):
+    """Return (header, means, stds) of the control MAT file
+
+    The stats are read from the file saved next to control, if it was
+    computed from the same contents, and are otherwise computed and saved.
+    """
+    checksum = file_checksum(control)
+    filename = stats_filename(control)
+    if os.path.isfile(filename):
+        try:
+            stats = load(filename)
+            if str(stats['checksum']) == checksum:
+                return (str(stats['header']), stats['means'], stats['stds'])
+            logging.info("Recomputing stats for changed control: %s"
+                         % control)
+        except (IOError, KeyError, ValueError), e:
+            logging.warning("Ignoring invalid control stats %s: %s"
+                            % (filename, e))
+
+    header, class_col, data = read_examples(control)
+    means, stds = get_stats(data)
+    tmp_filename = '%s.tmp%d' % (filename, os.getpid())
+    try:
+        with open(tmp_filename, 'wb') as ofp:
+            savez(ofp, checksum=array(checksum), header=array(header),
+                  means=means, stds=stds)
+        os.rename(tmp_filename, filename)
+    except (IOError, OSError), e:
+        logging.warning("Unable to save control stats %s: %s"
+                        % (filename, e))
+
+    return header, means, stds
+
+def standardize(mat, means, stds, class_col=None):
+    """Standardize mat in place, according to given column means and stds"""
+    means = asarray(means)
+    stds = asarray(stds)
+    if class_col is not None:
+        classes = mat[:, class_col].copy()
+
+    constant = stds == 0
+    mat -= means
+    mat /= stds + constant
+    mat[:, constant] = 0
+
+    # Don't standardize the class column
+    if class_col is not None:
+        mat[:, class_col] = classes
+
 def whiten_data(mat, control=None, class_col=None):
     data = mat
     if control is not None:
         data = control
 
-    means = data.mean(axis=0)
-    stds = data.std(axis=0)
     # Standardize mat according to mean/std in source array
-    for col in xrange(mat.shape[1]):
-        # Don't standardize the class column
-        if col == class_col:
-            continue
+    means, stds = get_stats(data)
+    standardize(mat, means, stds, class_col=class_col)
+
+def row_format(ncols, class_col=None, add_class=None):
+    """Return format string for a row of ncols values"""
+    fields = []
+    if add_class is not None:
+        fields.append('%d' % add_class)
 
-        if stds[col] == 0:
-            mat[:, col] = 0
+    for i in xrange(ncols):
+        if i == class_col:
+            fields.append('%d')
         else:
-            mat[:, col] = (mat[:, col] - means[col]) / stds[col]
-    
-def script(filename, control=None, add_class=None):
-    header, class_col, mat = read_examples(filename)
-    if control is not None:
-        control_header, control_class_col, control = read_examples(control)
-        assert header == control_header
+            fields.append('%.4f')
+
+    return '\t'.join(fields)
 
-    whiten_data(mat, control=control, class_col=class_col)
+def format_rows(mat, class_col=None, add_class=None):
+    """Return list of formatted rows of mat"""
+    fmt = row_format(mat.shape[1], class_col=class_col, add_class=add_class)
+    return [fmt % tuple(row) for row in mat.tolist()]
 
+def format_row(row, class_col=None, add_class=None):
+    fmt = row_format(len(row), class_col=class_col, add_class=add_class)
+    return fmt % tuple(row)
+
+def format_header(header, add_class=None):
     if add_class is not None:
-        print '#class\t%s' % header
+        return '#class\t%s' % header
     else:
-        print '#%s' % header
+        return '#%s' % header
+
+def output_values(mat, add_class=None):
+    """Return the values of mat as printed: rounded, with any added class
+    column"""
+    values = around(mat, 4)
+    if add_class is not None:
+        values = column_stack([[add_class] * len(values), values])
+    return values
 
-    for row in mat:
-        values = []
-        if add_class is not None:
-            values.append('%d' % add_class)
+def standardize_file(filename, means, stds, header=None, add_class=None,
+                     out=sys.stdout, binary=None, chunk_size=CHUNK_SIZE):
+    """Print filename standardized with means and stds, a chunk at a time
 
-        for i, val in enumerate(row):
-            if i == class_col:
-                values.append('%d' % val)
-            else:
-                values.append('%.4f' % val)
+    header, if given, must match that of filename. If binary is a
+    filename, the values are also written to it as a binary matrix.
+    """
+    with maybe_gzip_open(filename) as ifp:
+        file_header, class_col = read_header(ifp)
+        assert header is None or header == file_header, \
+            "Features in %s do not match control" % filename
+        out_header = format_header(file_header, add_class=add_class)
+        print >>out, out_header
+
+        writer = None
+        if binary is not None:
+            writer = MatrixWriter(binary, out_header.lstrip('#').split())
+        try:
+            for mat in iter_chunks(ifp, filename, chunk_size=chunk_size):
+                standardize(mat, means, stds, class_col=class_col)
+                for line in format_rows(mat, class_col=class_col,
+                                        add_class=add_class):
+                    print >>out, line
+                if writer is not None:
+                    writer.write(output_values(mat, add_class=add_class))
+        except:
+            if writer is not None:
+                writer.abort()
+            raise
+
+        if writer is not None:
+            writer.close()
+
+def script(filename, control=None, add_class=None, binary=None):
+    if control is not None:
+        header, means, stds = control_stats(control)
+    else:
+        # Standardize against itself, so all rows are needed for the stats
+        header, class_col, mat = read_examples(filename)
+        means, stds = get_stats(mat)
+        del mat
 
-        print '\t'.join(values)
+    standardize_file(filename, means, stds, header=header,
+                     add_class=add_class, binary=binary)
         
 def parse_args(args):
     from optparse import OptionParser
@@ -117,6 +217,10 @@ def parse_args(args):
                       dest='add_class', default=None,
                       help="If set, prepends a class column with the given"
                       " value")
+    parser.add_option('-b', '--binary', metavar='SMAT',
+                      dest='binary', default=None,
+                      help="Also write the standardized values to SMAT, a"
+                      " binary matrix file")
     options, args = parser.parse_args()
 
     if len(args) != 1:
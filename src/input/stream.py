@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+
+"""
+Streams VARIANTS through the whole preprocessing pipeline in chunks of
+records: synonymous filtering, 1000 Genomes Project allele frequency
+filtering, mRNA annotation, feature annotation and standardization.
+Only one chunk is held in memory (or on disk, in OUTDIR/chunks) at a time,
+and each completed chunk is checkpointed, so the script can be stopped and
+resumed. Once all chunks are complete, they are concatenated into
+OUTDIR/BASE.flt, BASE.mrna, BASE.mat, BASE.smat and BASE.input, as created
+by the staged pipeline.
+"""
+
+# Author: Orion Buske
+# Date:   ...
+from __future__ import division, with_statement
+
+import os
+import sys
+import shutil
+import logging
+
+assert os.getenv('SILVA_PATH') is not None, \
+    "Error: SILVA_PATH is unset."
+sys.path.insert(0, os.path.expandvars('$SILVA_PATH/lib/python'))
+sys.path.insert(0, os.path.expandvars('$SILVA_PATH/src/features'))
+from silva import matrix
+LOG_LEVEL = os.getenv('SILVA_LOG_LEVEL', 'INFO')
+
+import synonymous
+import standardize
+import engine
+gp1k = __import__('1000gp')
+
+CHUNK_DIRNAME = 'chunks'
+CHUNK_SIZE_FILENAME = 'CHUNK_SIZE'
+# Output extensions, in the order they are written. A chunk is complete
+# once its last file exists.
+EXTS = ['flt', 'mrna', 'mat', 'smat', 'input']
+
+
+class Pipeline(object):
+    def __init__(self, genes, control, af_table=None, af_min=0, af_max=1,
+                 protein_coords=False, context=False, gerp_table=None,
+                 gerp_cache=None):
+        """Loads shared resources once, for all chunks
+
+        af_table: 1000gp table, or None to skip allele frequency filtering
+        context: annotate only the context of each mutation used by the
+          features, rather than the full pre-mRNA (see synonymous.py)
+        gerp_table, gerp_cache: GERP table files (see engine.py)
+        control: control MAT file to standardize features against (chunks
+          are too small to standardize against themselves)
+        """
+        self.genes = genes
+        self.af_table = af_table
+        self.af_min = af_min
+        self.af_max = af_max
+        self.protein_coords = protein_coords
+        self.context = context
+        header, means, stds = standardize.control_stats(control)
+        self.control_header = header
+        self.control_stats = (means, stds)
+        gerp = {}
+        if gerp_table is not None:
+            gerp = {'table': gerp_table, 'optfile': gerp_cache}
+        self.engine = engine.FeatureEngine(**{engine.GerpFeature.name: gerp})
+
+    def filter(self, lines):
+        """Return filtered variant rows, as token lists"""
+        rows = synonymous.filter_chunk(self.genes, lines,
+                                       protein_coords=self.protein_coords)
+        # Remove variants on chromosome Y
+        rows = [row for row in rows if row[0] != 'Y']
+        if self.af_table is not None:
+            # chrom, pos, alt of each row
+            afs = gp1k.get_afs(self.af_table, [(row[0], row[1], row[4])
+                                               for row in rows])
+            kept = []
+            for row, af in zip(rows, afs):
+                af = 0 if af == '.' else float(af)
+                if self.af_min <= af <= self.af_max:
+                    kept.append(row)
+            rows = kept
+
+        return rows
+
+    def annotate(self, rows):
+        """Return mRNA-annotated rows, as token lists"""
+        annotated = []
+        for row in rows:
+            row = synonymous.annotate_tokens(self.genes, row,
+                                             context=self.context)
+            if row is not None:
+                annotated.append(row)
+
+        return annotated
+
+    def features(self, mrna_filename, outbase):
+        """Annotate features for mrna_filename, creating outbase.mat"""
+        filename = '%s.mat' % outbase
+        with open(filename + '.tmp', 'w') as ofp:
+            self.engine.write_mat(mrna_filename, out=ofp)
+        os.rename(filename + '.tmp', filename)
+        return filename
+
+    def standardize(self, mat_filename, outbase):
+        """Return (header, rows) for standardized features of mat_filename,
+        also writing them to the binary matrix outbase.smat"""
+        header, class_col, mat = standardize.read_examples(mat_filename)
+        assert header == self.control_header, \
+            "Features in %s do not match control" % mat_filename
+        means, stds = self.control_stats
+        standardize.standardize(mat, means, stds, class_col=class_col)
+        header = standardize.format_header(header, add_class=0)
+        with matrix.MatrixWriter('%s.smat' % outbase,
+                                 header.lstrip('#').split()) as writer:
+            writer.write(standardize.output_values(mat, add_class=0))
+        return (header,
+                standardize.format_rows(mat, class_col=class_col,
+                                        add_class=0))
+
+    def run_chunk(self, lines, outbase):
+        """Process chunk of input lines, checkpointing to outbase.*"""
+        def write_lines(ext, header, lines):
+            filename = '%s.%s' % (outbase, ext)
+            with open(filename + '.tmp', 'w') as ofp:
+                if header is not None:
+                    print >>ofp, header
+                for line in lines:
+                    print >>ofp, line
+            os.rename(filename + '.tmp', filename)
+            return filename
+
+        rows = self.filter(lines)
+        write_lines('flt', '#%s' % '\t'.join(synonymous.FILTER_FIELDS),
+                    ['\t'.join(row) for row in rows])
+
+        rows = self.annotate(rows)
+        fields = synonymous.ANNOTATE_FIELDS
+        if self.context:
+            fields = synonymous.CONTEXT_FIELDS
+        mrna_filename = write_lines(
+            'mrna', '#%s' % '\t'.join(fields),
+            ['\t'.join(row) for row in rows])
+
+        if rows:
+            header, lines = self.standardize(self.features(mrna_filename,
+                                                           outbase),
+                                             outbase)
+        else:
+            # Nothing to annotate, so leave the feature files empty
+            write_lines('mat', None, [])
+            columns = standardize.format_header(self.control_header,
+                                                add_class=0)
+            matrix.MatrixWriter('%s.smat' % outbase,
+                                columns.lstrip('#').split()).close()
+            header, lines = None, []
+
+        write_lines('input', header, lines)
+        return len(rows)
+
+
+def chunk_filenames(outbase):
+    return ['%s.%s' % (outbase, ext) for ext in EXTS]
+
+def check_chunk_size(chunkdir, chunk_size):
+    """Ensure resumed chunks were created with the same chunk size"""
+    filename = os.path.join(chunkdir, CHUNK_SIZE_FILENAME)
+    if os.path.isfile(filename):
+        with open(filename) as ifp:
+            found = int(ifp.read().strip())
+        if found != chunk_size:
+            raise ValueError("Existing chunks in %s have size %d (not %d)."
+                             " Please remove them or use the same chunk size"
+                             % (chunkdir, found, chunk_size))
+    else:
+        with open(filename, 'w') as ofp:
+            print >>ofp, chunk_size
+
+def merge_chunks(outbases, filename):
+    """Concatenate chunk files, keeping just the first header line"""
+    ext = os.path.splitext(filename)[1]
+    if ext == '.smat':
+        matrix.merge([outbase + ext for outbase in outbases], filename)
+        return
+
+    header = None
+    with open(filename + '.tmp', 'w') as ofp:
+        for outbase in outbases:
+            with open(outbase + ext) as ifp:
+                for line in ifp:
+                    if line.startswith('#'):
+                        if header is None:
+                            header = line
+                            ofp.write(line)
+                        else:
+                            assert line == header, \
+                                "Header mismatch in %s%s" % (outbase, ext)
+                    else:
+                        ofp.write(line)
+    os.rename(filename + '.tmp', filename)
+
+def script(outdir, filename, control=None,
+           chunk_size=synonymous.CHUNK_SIZE, protein_coords=False,
+           context=False, af_filename=None, af_cache_filename=None,
+           af_min=0, af_max=1, keep_chunks=False, gerp_table=None, gerp_cache=None,
+           gene_filename=None, cache_filename=None, genome_filename=None):
+    base = os.path.basename(filename)
+    for ext in ['.vcf', '.pcoord']:
+        if base.endswith(ext):
+            base = base[:-len(ext)]
+
+    outfiles = [os.path.join(outdir, '%s.%s' % (base, ext)) for ext in EXTS]
+    if all([os.path.isfile(f) for f in outfiles]):
+        print >>sys.stderr, "Found existing: %s" % ', '.join(outfiles)
+        return
+
+    chunkdir = os.path.join(outdir, CHUNK_DIRNAME)
+    if not os.path.isdir(chunkdir):
+        os.makedirs(chunkdir)
+    check_chunk_size(chunkdir, chunk_size)
+
+    genes = synonymous.get_genes(gene_filename=gene_filename,
+                                 cache_filename=cache_filename,
+                                 genome_filename=genome_filename)
+    af_table = None
+    if af_filename and not protein_coords:
+        af_table = gp1k.load_table(af_filename, af_cache_filename)
+
+    pipeline = Pipeline(genes, control, af_table=af_table, af_min=af_min,
+                        af_max=af_max, protein_coords=protein_coords,
+                        context=context,
+                        gerp_table=gerp_table, gerp_cache=gerp_cache)
+
+    outbases = []
+    n_total = 0
+    lines = synonymous.iter_variant_lines(filename)
+    for i, chunk in enumerate(synonymous.iter_chunks(lines, chunk_size)):
+        outbase = os.path.join(chunkdir, '%s.%05d' % (base, i))
+        outbases.append(outbase)
+        n_total += len(chunk)
+        if os.path.isfile(chunk_filenames(outbase)[-1]):
+            logging.info("Found completed chunk: %s" % outbase)
+            continue
+
+        n_kept = pipeline.run_chunk(chunk, outbase)
+        logging.info("Completed chunk %d: %d / %d variants kept" % \
+                         (i, n_kept, len(chunk)))
+
+    logging.info("Merging %d chunks (%d variants)..." % \
+                     (len(outbases), n_total))
+    for outfile in outfiles:
+        merge_chunks(outbases, outfile)
+
+    if not keep_chunks:
+        shutil.rmtree(chunkdir)
+
+def parse_args(args):
+    from optparse import OptionParser
+    usage = "usage: %prog [options] OUTDIR (VARIANTS|-)"
+    description = __doc__.strip()
+
+    parser = OptionParser(usage=usage,
+                          description=description)
+    parser.add_option("-O", "--cache-genes", metavar="FILE",
+                      dest="cache_filename", default=None,
+                      help="Read/write parsed genes to speed up re-runs")
+    parser.add_option("-g", "--genes", metavar="UCSC",
+                      dest="gene_filename", default=None,
+                      help="Read genes from UCSC file, unless cache already"
+                      " exists and specified with -O")
+    parser.add_option("-G", "--genome", metavar="2BIT",
+                      dest="genome_filename", default=None,
+                      help="Extract sequence data from 2bit file (same"
+                      " assembly as --genes)")
+    parser.add_option("--protein-coords", action="store_true",
+                      dest="protein_coords", default=False,
+                      help="VARIANTS file contains protein coordinates,"
+                      " not chromosomal coordinates (no allele frequency"
+                      " filtering is done)")
+    parser.add_option("--context", action="store_true",
+                      dest="context", default=False,
+                      help="Annotate BASE.mrna with only the context of each"
+                      " mutation used by the features (see synonymous.py)")
+    parser.add_option("--1000gp", metavar="VCF",
+                      dest="af_filename", default=None,
+                      help="Filter by allele frequencies from VCF (see"
+                      " 1000gp.py)")
+    parser.add_option("--1000gp-cache", metavar="DIR",
+                      dest="af_cache_filename", default=None,
+                      help="Read/write allele frequency table to DIR")
+    parser.add_option("--af-min", metavar="AF", type="float",
+                      dest="af_min",
+                      default=float(os.getenv('SILVA_AF_MIN', 0)),
+                      help="Minimum allele frequency (default: %default)")
+    parser.add_option("--af-max", metavar="AF", type="float",
+                      dest="af_max",
+                      default=float(os.getenv('SILVA_AF_MAX', 1)),
+                      help="Maximum allele frequency (default: %default)")
+    parser.add_option("--gerp", metavar="TABLE",
+                      dest="gerp_table", default=None,
+                      help="Read GERP scores from TABLE (see engine.py)")
+    parser.add_option("--gerp-cache", metavar="DIR",
+                      dest="gerp_cache", default=None,
+                      help="Read/write optimized GERP table (a directory)")
+    parser.add_option("-c", "--control", metavar="MAT",
+                      dest="control", default=None,
+                      help="Standardize according to data in MAT")
+    parser.add_option("-n", "--chunk-size", metavar="N", type="int",
+                      dest="chunk_size",
+                      default=int(os.getenv('SILVA_CHUNK_SIZE',
+                                            synonymous.CHUNK_SIZE)),
+                      help="Number of VARIANTS records per chunk"
+                      " (default: %default)")
+    parser.add_option("--keep-chunks", action="store_true",
+                      dest="keep_chunks", default=False,
+                      help="Do not remove OUTDIR/chunks once merged")
+    options, args = parser.parse_args(args)
+
+    if len(args) != 2:
+        parser.error("Inappropriate number of arguments")
+    if options.control is None:
+        parser.error("Control MAT file must be specified with --control")
+    if options.chunk_size < 1:
+        parser.error("Chunk size must be positive")
+
+    return options, args
+
+def main(args=sys.argv[1:]):
+    options, args = parse_args(args)
+    kwargs = dict(options.__dict__)
+    logging.basicConfig(level=LOG_LEVEL)
+    script(*args, **kwargs)
+
+if __name__ == '__main__':
+    sys.exit(main())
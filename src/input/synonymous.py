@@ -9,10 +9,17 @@ which the variant is synonymous).
 If ACTION is 'annotate' or 'generate', VARIANTS should contain the 7 columns
 outputted by first 'filter'ing. 
 If ACTION is 'annotate', additional columns are added: strand, codon, 
-codon_offset, and pre-mRNA sequence.
+codon_offset, and pre-mRNA sequence (or, with --context, only the bounded
+context of the mutation that the features use).
 If ACTION is 'generate', either random (--random) or all (--all) synonymous
 variants are generated and printed to stdout. With --random, variants are
-gene-matched, and additional flags allow matching other dimensions.
+gene-matched, and additional flags allow matching other dimensions;
+--replicates N generates N independent, seeded sets of controls.
+Both draw from a catalog of every synonymous site of every transcript,
+built once and saved within the transcript database (--cache-genes).
+With -j N, 'filter' and 'annotate' process consecutive shards of VARIANTS
+(genomic regions, if VARIANTS is sorted) on N processes, printing the
+results in input order.
 """
 
 # Author: Orion Buske
@@ -21,12 +28,18 @@ from __future__ import division, with_statement
 
 import os
 import sys
-import cPickle
+import atexit
 import logging
 
+from bisect import bisect_left, bisect_right
 from collections import defaultdict
+from itertools import izip, islice, chain
+from tempfile import mkdtemp
 from string import maketrans
-from random import sample
+from random import choice
+from numpy import array, asarray, arange, ones, cumsum, concatenate, \
+    frombuffer, flatnonzero, minimum, zeros, where, int32, int64, uint8
+from numpy.random import RandomState
 
 assert os.getenv('SILVA_PATH') is not None, \
     "Error: SILVA_PATH is unset."
@@ -34,6 +47,11 @@ sys.path.insert(0, os.path.expandvars('$SILVA_PATH/lib/python'))
 LOG_LEVEL = os.getenv('SILVA_LOG_LEVEL', 'INFO')
 
 from silva import maybe_gzip_open
+from silva.txdb import TranscriptDB, write_db, remove_db
+from silva.intervals import IntervalIndex
+from silva.catalog import SiteCatalog
+from silva.kmers import NUC_CODES
+from silva.parallel import imap_ordered
 from twobitreader import TwoBitFile as Genome
 
 STOP = '*'
@@ -66,9 +84,39 @@ for codon, aa in AA_CODE.iteritems():
                 # Mutating codon[pos] to alt is a synonymous change
                 SYN_MUTATIONS[codon].add((pos, alt))
 
+# Synonymous codon mutations as a lookup table:
+# [codon code, frame, alt code] -> is synonymous (codes as in silva.kmers)
+SYN_TABLE = zeros((64, 3, 4), dtype=bool)
+for codon, mutations in SYN_MUTATIONS.iteritems():
+    codes = [NUC_CODES[ord(nuc)] for nuc in codon]
+    for pos, alt in mutations:
+        SYN_TABLE[(codes[0] << 4) | (codes[1] << 2) | codes[2], pos,
+                  NUC_CODES[ord(alt)]] = True
+CODE_NUCS = array(list('ACGT'))
+# Code of codons with other nucleotides than ACGT
+INVALID_CODON = 64
+
 COMPLEMENT = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A'}
 COMPLEMENT_TAB = maketrans('ACGT', 'TGCA')
 
+# Number of input lines processed together
+CHUNK_SIZE = 10000
+# Overlap index of CDS spans, within transcript database
+CDS_INDEX_DIRNAME = 'cds.index'
+# Nucleotides of context around each mutation in 'annotate --context'
+# output: enough for MaxEnt splice sites (maxent.Seq) and for the folding
+# windows (twice the engine's FOLDING_DOMAIN) on either side
+CONTEXT_SPLICE = 20
+CONTEXT_FOLDING = 100
+# Catalog of synonymous sites, within transcript database
+SYN_CATALOG_DIRNAME = 'synonymous.catalog'
+# Catalog columns (see synonymous_sites)
+SYN_SITE_DTYPES = {'offset': int32, 'pos': int32, 'ref': 'S1', 'alt': 'S1',
+                   'cpg': bool, 'splice_dist': int32}
+# Codons of every transcript, within transcript database
+CODON_INDEX_DIRNAME = 'codon.index'
+CODON_DTYPES = {'codon': uint8}
+
 class Transcript(object):
     def __init__(self, gene, tx, chrom, tx_start, tx_end, strand, 
                  cds_start, cds_end, exon_starts, exon_ends, seq=None):
@@ -76,6 +124,7 @@ class Transcript(object):
         starts and ends: 0-indexed half-open
         """
         self._valid = False
+        self._id = None  # Index within TranscriptDB, if loaded from one
         self._chrom = chrom
         self._strand = strand
         self._gene = gene
@@ -116,6 +165,15 @@ class Transcript(object):
         self._cds_length = sum([end - start for start, end in self._cds])
         assert self._cds_length % 3 == 0, "CDS length not a multiple of 3"
 
+        # For projections by bisection: the ends of the CDS intervals (in
+        # genome order), and the CDS intervals in transcript order with the
+        # cds offset at which each starts
+        self._cds_ends = [end for start, end in self._cds]
+        self._tx_cds = self._cds[::-1] if self._strand == '-' else self._cds
+        self._cds_offsets = [0]
+        for start, end in self._tx_cds[:-1]:
+            self._cds_offsets.append(self._cds_offsets[-1] + end - start)
+
         if seq is not None:
             self.load_seq(seq)
 
@@ -155,28 +213,6 @@ class Transcript(object):
     def premrna(self):
         return self._premrna
 
-    def _project_to_intervals(self, pos, intervals):
-        """Return interval offset (0-indexed), given genome pos (1-indexed)
-        intervals are 0-indexed, half-open
-        """
-        offset = 0
-        if self._strand == '+':
-            for start, end in intervals:
-                if start < pos <= end:
-                    return offset + (pos - (start + 1))
-                elif pos < start + 1:
-                    return None
-                else:
-                    offset += (end - start)
-        else:
-            for start, end in reversed(intervals):
-                if start < pos <= end:
-                    return offset + (end - pos)
-                elif pos > end:
-                    return None
-                else:
-                    offset += (end - start)
-        
     def project_to_premrna(self, pos):
         """Return premrna offset (0-indexed), given genome pos (1-indexed)"""
         assert self._tx_start < pos <= self._tx_end
@@ -190,31 +226,34 @@ class Transcript(object):
         assert self._cds_start < pos <= self._cds_end, \
                "Error, pos (%r) outside of CDS: [%r, %r)" % \
                (pos, self._cds_start, self._cds_end)
-        return self._project_to_intervals(pos, self._cds)
+        # First CDS interval ending at or after pos
+        i = bisect_left(self._cds_ends, pos)
+        if i == len(self._cds) or self._cds[i][0] >= pos:
+            return None  # intronic
 
-    def _project_from_intervals(self, offset, intervals):
-        """
-        Return genome position (1-indexed), given interval offset (0-indexed)
-        and 0-indexed, half-open intervals
-        """
+        start, end = self._cds[i]
+        if self._strand == '+':
+            return self._cds_offsets[i] + (pos - (start + 1))
+        else:
+            return self._cds_offsets[len(self._cds) - 1 - i] + (end - pos)
+
+    def project_to_cds_batch(self, positions):
+        """Return array of cds offsets (0-indexed, or -1 if not in the CDS),
+        given array of genome positions (1-indexed)"""
+        positions = asarray(positions, dtype=int64)
+        bounds = array(self._cds, dtype=int64)
+        i = bounds[:, 1].searchsorted(positions, 'left')
+        inside = i < len(bounds)
+        i[~inside] = 0
+        inside &= bounds[i, 0] < positions
         if self._strand == '+':
-            for start, end in intervals:
-                size = end - start
-                if offset < 0:
-                    return None
-                elif offset < size:
-                    return start + offset + 1
-                else:
-                    offset -= size
+            offsets = array(self._cds_offsets, dtype=int64)[i] + \
+                positions - (bounds[i, 0] + 1)
         else:
-            for start, end in reversed(intervals):
-                size = end - start
-                if offset < 0:
-                    return None
-                elif offset < size:
-                    return end - offset
-                else:
-                    offset -= size
+            offsets = array(self._cds_offsets[::-1], dtype=int64)[i] + \
+                bounds[i, 1] - positions
+        offsets[~inside] = -1
+        return offsets
 
     def project_from_premrna(self, offset):
         """Return genome position (1-indexed), given premrna offset (0-indexed)"""
@@ -227,21 +266,46 @@ class Transcript(object):
     def project_from_cds(self, offset):
         """Return genome position (1-indexed), given cds offset (0-indexed)"""
         assert 0 <= offset < self._cds_length
-        return self._project_from_intervals(offset, self._cds)
+        # Last CDS interval (in transcript order) starting at or before offset
+        j = bisect_right(self._cds_offsets, offset) - 1
+        start, end = self._tx_cds[j]
+        if self._strand == '+':
+            return start + (offset - self._cds_offsets[j]) + 1
+        else:
+            return end - (offset - self._cds_offsets[j])
+
+    def project_from_cds_batch(self, offsets):
+        """Return array of genome positions (1-indexed), given array of
+        cds offsets (0-indexed)"""
+        offsets = asarray(offsets, dtype=int64)
+        assert ((0 <= offsets) & (offsets < self._cds_length)).all()
+        starts = array(self._cds_offsets, dtype=int64)
+        bounds = array(self._tx_cds, dtype=int64)
+        j = starts.searchsorted(offsets, 'right') - 1
+        if self._strand == '+':
+            return bounds[j, 0] + (offsets - starts[j]) + 1
+        else:
+            return bounds[j, 1] - (offsets - starts[j])
     
     def load_seq(self, seq):
         assert seq is not None, "seq is None"
-        stop_codons = set(['TAA', 'TAG', 'TGA'])
-
         premrna = seq[self._tx_start:self._tx_end].tostring().upper()
-
-        seqs = []
-        for start, end in self._cds:
-            seqs.append(seq[start:end].tostring().upper())
-
         if self._strand == '-':
             premrna = premrna.translate(COMPLEMENT_TAB)[::-1]
-            seqs = [s.translate(COMPLEMENT_TAB)[::-1] for s in reversed(seqs)]
+
+        self.load_premrna(premrna)
+
+    def load_premrna(self, premrna):
+        """Load sequence from the (transcript-strand) pre-mRNA"""
+        stop_codons = set(['TAA', 'TAG', 'TGA'])
+        assert len(premrna) == self._tx_length, "pre-mRNA length != tx length"
+
+        if self._strand == '+':
+            seqs = [premrna[start - self._tx_start:end - self._tx_start]
+                    for start, end in self._cds]
+        else:
+            seqs = [premrna[self._tx_end - end:self._tx_end - start]
+                    for start, end in reversed(self._cds)]
             
         self._mrna = ''.join(seqs)
         self._premrna = premrna
@@ -256,11 +320,12 @@ class Transcript(object):
         start = (aa - 1) * 3
         return self._mrna[start:start+3]
 
-    def mutation_str(self, pos, ref, alt):
-        """Given genomic pos (1-indexed), ref nuc and alt nuc, return
-        mrna string in 'standard' form: ACT|ACGCACA[G/T]|ACAACA
-
-        Splice sites are marked with pipes, mutation is in brackets
+    def _mutation_chunks(self, pos, ref, alt):
+        """Return (edges, i, mut_offset, ref, alt) for a mutation at genomic
+        pos (1-indexed): the sorted pre-mRNA offsets of all edges between
+        exons and introns (including both ends), the index of the chunk
+        between edges that holds the mutation, its pre-mRNA offset, and ref
+        and alt on the transcript strand
         """
         premrna = self._premrna
         assert premrna
@@ -284,24 +349,86 @@ class Transcript(object):
             edges = [self._tx_length - e for e in edges]
             
         edges = list(sorted(edges))
-        
+        # find sequence block with mutation
+        i = bisect_right(edges, mut_offset) - 1
+        return edges, i, mut_offset, ref, alt
+
+    def mutation_str(self, pos, ref, alt):
+        """Given genomic pos (1-indexed), ref nuc and alt nuc, return
+        mrna string in 'standard' form: ACT|ACGCACA[G/T]|ACAACA
+
+        Splice sites are marked with pipes, mutation is in brackets
+        """
+        premrna = self._premrna
+        edges, i, mut_offset, ref, alt = self._mutation_chunks(pos, ref, alt)
         seqs = []
         for start, end in zip(edges[:-1], edges[1:]):
             seqs.append(premrna[start:end])
 
-        # find sequence block with mutation
-        for i, seq in enumerate(seqs):
-            if mut_offset < len(seq):
-                # insert mutation
-                assert seq[mut_offset] == ref
-                seqs[i] = '%s[%s/%s]%s' % (seq[:mut_offset], ref, alt, seq[mut_offset+1:])
-                break
-            else:
-                mut_offset -= len(seq)
+        # insert mutation
+        seqs[i] = '%s[%s/%s]%s' % (premrna[edges[i]:mut_offset], ref, alt,
+                                   premrna[mut_offset + 1:edges[i + 1]])
 
         # add splice markers
         return '|'.join(seqs)
 
+    def mutation_context(self, pos, ref, alt, splice_flank=CONTEXT_SPLICE,
+                         folding_flank=CONTEXT_FOLDING):
+        """Given genomic pos (1-indexed), ref nuc and alt nuc, return the
+        parts of mutation_str used by the features, as a string of
+        ';'-separated key=value pairs:
+
+        exon: the mutated exon, e.g. ACGCACA[G/T]
+        up, down: the splice_flank nucs of pre-mRNA before and after exon
+          (empty at either end of the transcript)
+        premrna, mrna: the folding_flank nucs on either side of the
+          mutation in the pre-mRNA and the mRNA, e.g. GCACA[G/T]ACAAC
+        premrna_flanks, mrna_flanks: the total number of nucs before and
+          after the mutation in the pre-mRNA and the mRNA
+        junctions: the number of splice markers before and after it
+
+        As in mutation_str, 'exons' are the even-numbered chunks between
+        edges, and the mRNA is their concatenation.
+        """
+        premrna = self._premrna
+        edges, i, mut_offset, ref, alt = self._mutation_chunks(pos, ref, alt)
+        mut = '[%s/%s]' % (ref, alt)
+        start, end = edges[i], edges[i + 1]
+        head = premrna[start:mut_offset]
+        tail = premrna[mut_offset + 1:end]
+        sizes = [b - a for a, b in zip(edges[:-1], edges[1:])]
+
+        in_exon = i % 2 == 0
+        # Nearby mRNA, collected one exon at a time from the mutated chunk
+        mrna_pre = head if in_exon else ''
+        j = i - 1
+        while len(mrna_pre) < folding_flank and j >= 0:
+            if j % 2 == 0:
+                mrna_pre = premrna[edges[j]:edges[j + 1]] + mrna_pre
+            j -= 1
+        mrna_post = tail
+        j = i + 2
+        while len(mrna_post) < folding_flank and j < len(sizes):
+            mrna_post += premrna[edges[j]:edges[j + 1]]
+            j += 2
+
+        context = [
+            ('exon', head + mut + tail),
+            ('up', premrna[max(start - splice_flank, 0):start]),
+            ('down', premrna[end:end + splice_flank]),
+            ('premrna', premrna[max(mut_offset - folding_flank, 0):mut_offset]
+             + mut + premrna[mut_offset + 1:mut_offset + 1 + folding_flank]),
+            ('mrna', (mrna_pre[-folding_flank:] + mut +
+                      mrna_post[:folding_flank]) if in_exon else ''),
+            ('premrna_flanks', '%d,%d' % (mut_offset,
+                                          len(premrna) - mut_offset - 1)),
+            ('mrna_flanks', '%d,%d' % (sum(sizes[0:i:2]) +
+                                       (len(head) if in_exon else 0),
+                                       len(tail) + sum(sizes[i + 2::2]))),
+            ('junctions', '%d,%d' % (i, len(sizes) - 1 - i)),
+            ]
+        return ';'.join(['%s=%s' % item for item in context])
+
     def is_synonymous(self, pos, ref, alt):
         """Is ref -> alt at pos (1-indexed, genomic) a synonymous change?"""
         try:
@@ -352,66 +479,299 @@ def iter_ucsc_genes(filename):
                    'tx': name}
 
 
+class Genes(object):
+    """Read-only, dict-like mapping: gene name -> set(Transcript)
+
+    Backed by a TranscriptDB. A Transcript (and its sequence) is only read
+    from the database the first time a variant touches it.
+    """
+    def __init__(self, db):
+        self.db = db
+        self.index = self._load_cds_index(db)
+        self._index = db.gene_index()
+        self._transcripts = {}
+        self._catalog = None
+        self._codon_index = None
+
+    @staticmethod
+    def _load_cds_index(db):
+        """Load (building and saving, if necessary) the CDS overlap index"""
+        dirname = os.path.join(db.dirname, CDS_INDEX_DIRNAME)
+        if os.path.isdir(dirname):
+            return IntervalIndex.load(dirname)
+
+        print >>sys.stderr, "Indexing CDS intervals: %s" % dirname
+        # CDS spans as 1-indexed, closed intervals
+        index = IntervalIndex.build(db.chrom, db.cds_start + 1, db.cds_end)
+        try:
+            index.save(dirname)
+        except OSError, e:
+            logging.warning('Could not save CDS index: %s' % e)
+        return index
+
+    def _load(self, i):
+        t = Transcript(**self.db.record(i))
+        t.load_premrna(self.db.premrna(i))
+        t._id = i
+        return t
+
+    def _load_catalog(self, dirname, func, dtypes):
+        """Load (building and saving, if necessary) the SiteCatalog in
+        dirname of func(Transcript) for every transcript"""
+        dirname = os.path.join(self.db.dirname, dirname)
+        if os.path.isdir(dirname):
+            return SiteCatalog.load(dirname)
+
+        print >>sys.stderr, "Cataloging transcripts: %s" % dirname
+        catalog = SiteCatalog.build((func(self._load(i))
+                                     for i in xrange(len(self.db))), dtypes)
+        try:
+            catalog.save(dirname)
+        except OSError, e:
+            logging.warning('Could not save catalog: %s' % e)
+        return catalog
+
+    def catalog(self):
+        """Return SiteCatalog of the synonymous sites of every transcript"""
+        if self._catalog is None:
+            self._catalog = self._load_catalog(SYN_CATALOG_DIRNAME,
+                                               synonymous_sites,
+                                               SYN_SITE_DTYPES)
+        return self._catalog
+
+    def codon_index(self):
+        """Return SiteCatalog of the codons of every transcript, by amino
+        acid position (see transcript_codons)"""
+        if self._codon_index is None:
+            self._codon_index = self._load_catalog(CODON_INDEX_DIRNAME,
+                                                   transcript_codons,
+                                                   CODON_DTYPES)
+        return self._codon_index
+
+    def synonymous_sites(self, tx):
+        """Return dict of the catalog arrays for Transcript tx"""
+        assert tx._id is not None, "Transcript not from database: %s" % tx
+        return self.catalog().sites(tx._id)
+
+    def transcript(self, i):
+        """Return (cached) Transcript i of the database"""
+        try:
+            return self._transcripts[i]
+        except KeyError:
+            t = self._transcripts[i] = self._load(i)
+            return t
+
+    def transcripts(self, ids):
+        """Return list of (cached) Transcripts for database ids"""
+        return [self.transcript(int(i)) for i in ids]
+
+    def overlapping(self, chrom, pos):
+        """Return list of Transcripts with CDS spanning pos (1-indexed)"""
+        return self.transcripts(self.index.query(chrom, pos))
+
+    def __getitem__(self, gene):
+        return set([self.transcript(i) for i in self._index[gene]])
+
+    def get(self, gene, default=None):
+        if gene in self._index:
+            return self[gene]
+        else:
+            return default
+
+    def __contains__(self, gene):
+        return gene in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def iteritems(self):
+        """Iterate over all (gene, set(Transcript)), without caching them"""
+        for gene, ids in self._index.iteritems():
+            yield gene, set([self._load(i) for i in ids])
+
+
+def iter_transcripts(gene_filename, genome_filename):
+    """Yield (entry, pre-mRNA) for all valid transcripts in gene_filename
+
+    Sequence data is extracted from the genome_filename 2bit file
+    """
+    genome = Genome(genome_filename)
+
+    missed_chroms = set()
+    n_zero_len = 0
+    for entry in iter_ucsc_genes(gene_filename):
+        chrom = entry['chrom']
+        if not chrom.startswith('chr'):
+            chrom = 'chr%s' % chrom
+
+        if chrom not in genome:
+            if chrom not in missed_chroms:
+                print >>sys.stderr, "Could not find sequence for %s" \
+                    " in: %s" % (chrom, genome_filename)
+                missed_chroms.add(chrom)
+
+            continue
+
+        try:
+            t = Transcript(seq=genome[chrom], **entry)
+        except AssertionError, e:
+            if "Zero-length CDS" in str(e):
+                n_zero_len += 1
+            else:
+                print >>sys.stderr, "Skipping transcript: %s: %s" \
+                    % (entry['gene'], e)
+            continue
+
+        if t.valid():
+            yield entry, t.premrna()
+
+    if n_zero_len:
+        print >>sys.stderr, "Skipped %d transcripts with zero-length CDS" \
+            " annotations" % n_zero_len
+
+    if missed_chroms:
+        print >>sys.stderr, "Missing sequences with gene annotations: %s" \
+            % ', '.join(sorted(missed_chroms))
+
 def get_genes(gene_filename=None, cache_filename=None,
               genome_filename=None, **kwargs):
-    """Loads (potentially cached) dict: gene_name -> set(genes)
+    """Loads (potentially cached) Genes: gene_name -> set(Transcript)
 
-    If not cached, genome_filename FASTA expected to provide sequence data
+    If cache_filename does not exist, the transcript database is built from
+    the gene_filename UCSC table, with sequence data from the
+    genome_filename 2bit file, and saved there. If no cache_filename is
+    given, a temporary database is used.
     """
     assert gene_filename and genome_filename or cache_filename
-    if cache_filename is not None and os.path.isfile(cache_filename):
-        print >>sys.stderr, "Loading genes from pickled file: %s" % cache_filename
-        with maybe_gzip_open(cache_filename) as ifp:
-            genes = cPickle.load(ifp)
-    else:
-        genome = Genome(genome_filename)
-
-        genes = defaultdict(set)
-        missed_chroms = set()
-        n_zero_len = 0
-        for entry in iter_ucsc_genes(gene_filename):
-            chrom = entry['chrom']
-            if not chrom.startswith('chr'):
-                chrom = 'chr%s' % chrom
-                
-            if chrom not in genome:
-                if chrom not in missed_chroms:
-                    print >>sys.stderr, "Could not find sequence for %s" \
-                        " in: %s" % (chrom, genome_filename)
-                    missed_chroms.add(chrom)
-                
-                continue
-
-            # Substitute id with gene name
-            entry['seq'] = genome[chrom]
-            try:
-                t = Transcript(**entry)
-            except AssertionError, e:
-                if "Zero-length CDS" in str(e):
-                    n_zero_len += 1
-                else:
-                    print >>sys.stderr, "Skipping transcript: %s: %s" \
-                        % (entry['gene'], e)
+    assert cache_filename is None or not os.path.isfile(cache_filename), \
+        "Expected transcript database directory, found file: %s" \
+        % cache_filename
+    if cache_filename is None or not os.path.isdir(cache_filename):
+        assert gene_filename and genome_filename, \
+            "Missing transcript database: %s" % cache_filename
+        if cache_filename is None:
+            tmpdir = mkdtemp(prefix='silva-genes.')
+            atexit.register(remove_db, tmpdir)
+            cache_filename = os.path.join(tmpdir, 'genes.db')
+
+        print >>sys.stderr, "Saving genes to database: %s" % cache_filename
+        write_db(cache_filename,
+                 iter_transcripts(gene_filename, genome_filename))
+
+    print >>sys.stderr, "Loading genes from database: %s" % cache_filename
+    return Genes(TranscriptDB(cache_filename))
+
+def encode_codons(mrna):
+    """Return (codes, codons) arrays for mrna: the code of each nucleotide
+    (as in silva.kmers) and of each codon (or INVALID_CODON)"""
+    codes = NUC_CODES[frombuffer(mrna, dtype=uint8)].astype(int64)
+    triplets = codes.reshape(-1, 3)
+    codons = (triplets[:, 0] << 4) | (triplets[:, 1] << 2) | triplets[:, 2]
+    codons[(triplets < 0).any(axis=1)] = INVALID_CODON
+    return codes, codons
+
+def transcript_codons(tx):
+    """Return dict of the codon codes of tx (the codon of amino acid
+    position p is at index p - 1)"""
+    return {'codon': encode_codons(tx._mrna)[1]}
+
+# Memoized protein_frames tables
+_protein_frames = {}
+
+def protein_frames(aa, mutation):
+    """Return array: codon code -> frame at which mutation (e.g. 'C>T') is
+    the only synonymous change of that codon, coding aa (or -1 if none)"""
+    key = (aa, mutation)
+    if key not in _protein_frames:
+        nuc_from, nuc_to = mutation.split('>')
+        frames = zeros(INVALID_CODON + 1, dtype=int64) - 1
+        for codon, codon_aa in AA_CODE.iteritems():
+            if codon_aa != aa: continue
+
+            # Verify synonymous mutation is unambiguous
+            frame = None
+            for i in range(len(codon)):
+                if codon[i] == nuc_from and \
+                       AA_CODE.get(codon[:i]+nuc_to+codon[i+1:]) == aa:
+                    if frame is None:
+                        frame = i
+                    else:
+                        frame = None  # ambiguous
+                        break
+
+            if frame is not None:
+                codes = encode_codons(codon)[1]
+                frames[codes[0]] = frame
+
+        _protein_frames[key] = frames
+    return _protein_frames[key]
+
+def get_transcripts_from_protein(genes, records):
+    """Find longest transcripts matching each of records of protein
+    coordinates: (gene, aa_pos, aa, mutation) (see
+    get_transcript_from_protein)
+
+    Records are grouped by gene, and the codons at their positions in
+    every transcript of the gene are read from the codon index at once.
+
+    returns list of (tx, chrom, pos, ref, alt), or None for each record
+    without an unambiguous match
+    """
+    index = genes.codon_index()
+    db = genes.db
+    gene_index = db.gene_index()
+    by_gene = defaultdict(list)
+    for k, record in enumerate(records):
+        by_gene[record[0]].append(k)
+
+    matches = [None] * len(records)
+    for gene, ks in by_gene.iteritems():
+        ids = array(gene_index.get(gene, []), dtype=int64)
+        if len(ids):
+            starts = index.offsets[ids]
+            n_codons = index.offsets[ids + 1] - starts
+            lengths = db.tx_end[ids] - db.tx_start[ids]
+            # Codon of each record (rows) in each transcript (columns)
+            aa_index = array([int(records[k][1]) - 1 for k in ks],
+                             dtype=int64)[:, None]
+            valid = (aa_index >= 0) & (aa_index < n_codons)
+            codons = index.columns['codon'][where(valid, starts + aa_index,
+                                                  0)]
+            codons = where(valid, codons, INVALID_CODON)
+
+        for row, k in enumerate(ks):
+            gene, aa_pos, aa, mutation = records[k]
+            if not len(ids):
+                frames = array([], dtype=int64)
+            else:
+                frames = protein_frames(aa, mutation)[codons[row]]
+            matched = flatnonzero(frames >= 0)
+            if not len(matched):
+                print_protein_mismatch(genes, gene, aa_pos, aa, mutation)
                 continue
 
-            if t.valid():
-                genes[entry['gene']].add(t)
-
-        if n_zero_len:
-            print >>sys.stderr, "Skipped %d transcripts with zero-length CDS" \
-                " annotations" % n_zero_len
+            # Longest transcript
+            j = matched[lengths[matched].argmax()]
+            tx = genes.transcript(int(ids[j]))
+            nuc_from, nuc_to = mutation.split('>')
+            ref = nuc_from if tx.strand() == '+' else COMPLEMENT[nuc_from]
+            alt = nuc_to if tx.strand() == '+' else COMPLEMENT[nuc_to]
+            cds_offset = (int(aa_pos) - 1) * 3 + int(frames[j])
+            pos = tx.project_from_cds(cds_offset)
+            matches[k] = (tx, tx.chrom(), pos, ref, alt)
 
-        if missed_chroms:
-            print >>sys.stderr, "Missing sequences with gene annotations: %s" \
-                % ', '.join(sorted(missed_chroms))
-            
-        genes = dict(genes)  # remove defaultdict
-        if cache_filename:
-            print >>sys.stderr, "Saving genes to pickled file: %s" % cache_filename
-            with open(cache_filename, 'wb') as ofp:
-                cPickle.dump(genes, ofp, cPickle.HIGHEST_PROTOCOL)
+    return matches
 
-    return genes
+def print_protein_mismatch(genes, gene, aa_pos, aa, mutation):
+    txs = genes.get(gene, [])
+    print >>sys.stderr, "No match found for %s, %s, %s, %s" % (gene, aa_pos, aa, mutation)
+    print >>sys.stderr, "Found %d transcripts" % len(txs)
+    for tx in txs:
+        codon = tx.get_codon(int(aa_pos))
+        print >>sys.stderr, "%s: codon: %s -> %s" % (tx.tx(), codon, AA_CODE.get(codon, ''))
 
 def get_transcript_from_protein(genes, gene, aa_pos, aa, mutation, *args, **kwargs):
     """Find longest transcripts matching protein coordinates
@@ -423,51 +783,17 @@ def get_transcript_from_protein(genes, gene, aa_pos, aa, mutation, *args, **kwar
 
     returns (tx, chrom, pos, ref, alt)
     """
-    aa_pos = int(aa_pos)
-    txs = genes.get(gene, [])
-    matches = []
-    for tx in txs:
-        codon = tx.get_codon(aa_pos)
-        nuc_from, nuc_to = mutation.split('>')
-        if not codon or AA_CODE[codon] != aa: continue
-        
-        # Verify synonymous mutation is unambiguous
-        frame = None
-        for i in range(len(codon)):
-            if codon[i] == nuc_from and \
-                   AA_CODE[codon[:i]+nuc_to+codon[i+1:]] == aa:
-                if frame is None:
-                    frame = i
-                else:
-                    frame = None  # ambiguous
-                    break
-                
-        if frame is not None: # unambiguous match
-            ref = nuc_from if tx.strand() == '+' else COMPLEMENT[nuc_from]
-            alt = nuc_to if tx.strand() == '+' else COMPLEMENT[nuc_to]
-            cds_offset = (aa_pos - 1) * 3 + frame
-            pos = tx.project_from_cds(cds_offset)
-            matches.append((tx, tx.chrom(), pos, ref, alt))
-            
-    if matches:
-        return max(matches)  # longest transcript
-    else:
-        print >>sys.stderr, "No match found for %s, %s, %s, %s" % (gene, aa_pos, aa, mutation)
-        print >>sys.stderr, "Found %d transcripts" % len(txs)
-        for tx in txs:
-            codon = tx.get_codon(aa_pos)
-            nuc_from, nuc_to = mutation.split('>')
-            print >>sys.stderr, "%s: codon: %s -> %s" % (tx.tx(), codon, AA_CODE.get(codon, ''))
+    return get_transcripts_from_protein(genes,
+                                        [(gene, aa_pos, aa, mutation)])[0]
 
 
-def get_transcript(genes, pos, ref, alt, gene_id, tx_id):
-    try:
-        txs = genes[gene_id]
-    except KeyError:
+def get_transcript(genes, chrom, pos, ref, alt, gene_id, tx_id):
+    if gene_id not in genes:
         print >>sys.stderr, "Missing entry for gene: %s" % gene_id
         return
 
-    txs = [x for x in txs if x.tx() == tx_id]
+    txs = [x for x in genes.overlapping(chrom, pos)
+           if x.gene() == gene_id and x.tx() == tx_id]
     if len(txs) == 0:
         print >>sys.stderr, "Missing entry for transcript: %s" % tx_id
         return
@@ -486,229 +812,389 @@ def get_transcript(genes, pos, ref, alt, gene_id, tx_id):
               "synonymous among copies of %s" % (pos, ref, alt, tx_id)
         return
 
-def random_synonymous_site(tx, cpg=None, avoid_splice=False):
-    """Return random synonymous site (cds offset, ref, alt)
-    cpg: if True or False, returned site is matched to this
-    avoid_splice: if True, no mutations within 3 bp of splice site will be chosen
+def synonymous_sites(tx):
+    """Return dict of arrays describing every synonymous SNV of tx:
+    offset: cds offset (0-indexed)
+    pos: genome position (1-indexed)
+    ref, alt: nucleotides (transcript strand)
+    cpg: whether the mutation creates or destroys a CpG in the mRNA
+    splice_dist: distance in the mRNA to the nearest splice site (or CDS start)
     """
-    splice_sites = []
-    cum_sum = 0
-    cds_intervals = reversed(tx._cds) if tx._strand == '-' else tx._cds
-    for start, end in cds_intervals:
-        splice_sites.append(cum_sum)
-        cum_sum += (end - start)
-        
-    assert cum_sum == len(tx._mrna)
-
-    matched_sites = set()
-    syn_sites = set()
-    for codon_offset in xrange(0, len(tx._mrna), 3):
-        codon = tx._mrna[codon_offset:codon_offset + 3]
-        for frame, alt in SYN_MUTATIONS[codon]:
-            offset = codon_offset + frame
-            ref = codon[frame]
-            pre = tx._mrna[max(offset - 1, 0):offset]
-            post = tx._mrna[offset + 1:offset + 2]
-            has_cpg = bool((pre and pre[0] == 'C' and 
-                            (ref == 'G' or alt == 'G')) or 
-                           (post and post[0] == 'G' and 
-                            (ref == 'C' or alt == 'C')))
-            splice_dist = min([abs(s - offset) for s in splice_sites])
-            syn_sites.add((offset, ref, alt))
-            if cpg is None or cpg == has_cpg:
-                if not avoid_splice or splice_dist > 3:
-                    matched_sites.add((offset, ref, alt))
-
-    if matched_sites:
-        sites = matched_sites
-    else:
-        sites = syn_sites
+    mrna = tx._mrna
+    assert mrna is not None
+    codes, codons = encode_codons(mrna)
+    # Codons with other nucleotides than ACGT have no synonymous mutations
+    valid = codons != INVALID_CODON
+    syn = SYN_TABLE[where(valid, codons, 0)]
+    syn[~valid] = False
+    codon_index, frame, alt = syn.nonzero()
+    offset = 3 * codon_index + frame
+    ref = codes[offset]
+
+    # Neighbouring nucleotides in the mRNA (-1 past either end)
+    padded = concatenate([[-1], codes, [-1]])
+    pre = padded[offset]
+    post = padded[offset + 2]
+    C, G = NUC_CODES[ord('C')], NUC_CODES[ord('G')]
+    cpg = (((pre == C) & ((ref == G) | (alt == G))) |
+           ((post == G) & ((ref == C) | (alt == C))))
+
+    # Distance to the start of the CDS interval holding each site, or of
+    # the next one (the mRNA offsets of all splice sites)
+    starts = array(tx._cds_offsets, dtype=int64)
+    interval = starts.searchsorted(offset, 'right') - 1
+    splice_dist = offset - starts[interval]
+    has_next = interval + 1 < len(starts)
+    splice_dist[has_next] = minimum(splice_dist[has_next],
+                                    starts[interval[has_next] + 1] -
+                                    offset[has_next])
+    pos = tx.project_from_cds_batch(offset)
+
+    return {'offset': offset, 'pos': pos, 'ref': CODE_NUCS[ref],
+            'alt': CODE_NUCS[alt], 'cpg': cpg, 'splice_dist': splice_dist}
+
+def matched_sites(sites, cpg=None, avoid_splice=False):
+    """Return array of the indices of the matching synonymous sites
+    sites: synonymous sites of a transcript (see synonymous_sites)
+    cpg: if True or False, returned sites are matched to this
+    avoid_splice: if True, no mutations within 3 bp of splice site are returned
+    If no site matches, all are returned.
+    """
+    matched = ones(len(sites['offset']), dtype=bool)
+    if cpg is not None:
+        matched &= sites['cpg'] == cpg
+    if avoid_splice:
+        matched &= sites['splice_dist'] > 3
+
+    indices = flatnonzero(matched)
+    if not len(indices):
+        indices = arange(len(matched))
         print >>sys.stderr, "Warning: no matched synonymous mutation possible"
 
-    return sample(sites, 1)[0]
-
-def random_controls(genes, filename, match_cpg=False, avoid_splice=False):
-    fields = ['chrom', 'pos', 'id', 'ref', 'alt', 'gene', 'tx']
-    print '#%s' % '\t'.join(fields)
-    with maybe_gzip_open(filename) as ifp:
-        for line in ifp:
-            line = line.rstrip()
-            if not line or line.startswith('#'): continue
+    return indices
 
-            tokens = line.split()
-            chrom, pos, id, ref, alt, gene_id, tx_id = tokens[:7]
-            chrom = chrom[3:] if chrom.startswith('chr') else chrom
-            pos = int(pos)
-            tx = get_transcript(genes, pos, ref, alt, gene_id, tx_id)
-            if not tx:
-                continue
+def random_synonymous_site(sites, cpg=None, avoid_splice=False):
+    """Return random synonymous site (cds offset, ref, alt)
+    (see matched_sites for arguments)
+    """
+    i = choice(matched_sites(sites, cpg=cpg, avoid_splice=avoid_splice))
+    return int(sites['offset'][i]), str(sites['ref'][i]), str(sites['alt'][i])
 
-            if match_cpg:
-                offset = tx.project_to_premrna(pos)
-                pre = tx.premrna()[offset-1:offset]
-                post = tx.premrna()[offset+1:offset+2]
-                tx_ref = ref
-                tx_alt = alt
-                if tx.strand() == '-':
-                    tx_ref = ref.translate(COMPLEMENT_TAB)
-                    tx_alt = alt.translate(COMPLEMENT_TAB)
-                assert tx_ref == tx.premrna()[offset]
-                cpg = bool((pre and pre[0] == 'C' and
-                            (tx_ref == 'G' or tx_alt == 'G')) or
-                           (post and post[0] == 'G' and
-                            (tx_ref == 'C' or tx_alt == 'C')))
-            else:
-                cpg=None
+def random_controls(genes, filename, match_cpg=False, avoid_splice=False,
+                    replicates=1, seed=None, output=None):
+    """Print replicates sets of random synonymous variants, matched to
+    those in filename, to stdout or to the files output % r, for r in
+    range(replicates)
 
-            cds_offset, new_ref, new_alt = \
-                random_synonymous_site(tx, cpg=cpg, avoid_splice=avoid_splice)
-            new_pos = tx.project_from_cds(cds_offset)
+    Set r is drawn from RandomState([seed, r]), so each is reproducible
+    independently of the others.
+    """
+    if seed is None:
+        seed = RandomState().randint(2 ** 31)
+    print >>sys.stderr, "Generating %d set(s) of controls with seed: %d" \
+        % (replicates, seed)
+
+    # Candidate sites (as catalog rows) are found once for each distinct
+    # (transcript, cpg) of the input variants, and stored back to back
+    catalog = genes.catalog()
+    candidates = []
+    group_ids = {}
+    variants = []
+    for line in iter_variant_lines(filename):
+        tokens = line.split()
+        chrom, pos, id, ref, alt, gene_id, tx_id = tokens[:7]
+        chrom = chrom[3:] if chrom.startswith('chr') else chrom
+        pos = int(pos)
+        tx = get_transcript(genes, chrom, pos, ref, alt, gene_id, tx_id)
+        if not tx:
+            continue
+
+        if match_cpg:
+            offset = tx.project_to_premrna(pos)
+            pre = tx.premrna()[offset-1:offset]
+            post = tx.premrna()[offset+1:offset+2]
+            tx_ref = ref
+            tx_alt = alt
             if tx.strand() == '-':
-                new_ref = COMPLEMENT[new_ref]
-                new_alt = COMPLEMENT[new_alt]
+                tx_ref = ref.translate(COMPLEMENT_TAB)
+                tx_alt = alt.translate(COMPLEMENT_TAB)
+            assert tx_ref == tx.premrna()[offset]
+            cpg = bool((pre and pre[0] == 'C' and
+                        (tx_ref == 'G' or tx_alt == 'G')) or
+                       (post and post[0] == 'G' and
+                        (tx_ref == 'C' or tx_alt == 'C')))
+        else:
+            cpg=None
+
+        key = (tx._id, cpg)
+        group = group_ids.get(key)
+        if group is None:
+            group = group_ids[key] = len(candidates)
+            sites = matched_sites(genes.synonymous_sites(tx), cpg=cpg,
+                                  avoid_splice=avoid_splice)
+            candidates.append(catalog.offsets[tx._id] + sites)
+        variants.append((chrom, tokens, tx, group))
+
+    groups = array([group for chrom, tokens, tx, group in variants],
+                   dtype=int64)
+    counts = array([len(sites) for sites in candidates], dtype=int64)
+    firsts = cumsum(counts) - counts
+    candidates = concatenate(candidates or [array([], dtype=int64)])
 
-            print '\t'.join([chrom, str(new_pos), id, new_ref, new_alt, 
-                             gene_id, tx.tx()] + tokens[7:])
+    fields = ['chrom', 'pos', 'id', 'ref', 'alt', 'gene', 'tx']
+    for r in xrange(replicates):
+        # One uniform choice among the candidates of each variant
+        draws = RandomState([seed, r]).random_sample(len(groups))
+        rows = candidates[firsts[groups] +
+                          (draws * counts[groups]).astype(int64)]
+        positions = catalog.columns['pos'][rows].tolist()
+        refs = catalog.columns['ref'][rows].tolist()
+        alts = catalog.columns['alt'][rows].tolist()
+
+        ofp = sys.stdout if output is None else open(output % r, 'w')
+        try:
+            print >>ofp, '#%s' % '\t'.join(fields)
+            for (chrom, tokens, tx, group), new_pos, new_ref, new_alt \
+                    in izip(variants, positions, refs, alts):
+                if tx.strand() == '-':
+                    new_ref = COMPLEMENT[new_ref]
+                    new_alt = COMPLEMENT[new_alt]
+
+                print >>ofp, '\t'.join([chrom, str(new_pos), tokens[2],
+                                        new_ref, new_alt, tokens[5],
+                                        tx.tx()] + tokens[7:])
+        finally:
+            if output is not None:
+                ofp.close()
 
 def print_all_synonymous(genes):
     fields = ['chrom', 'pos', 'id', 'ref', 'alt', 'gene', 'tx']
     print '#%s' % '\t'.join(fields)
     
-    for gene, txs in genes.iteritems():
-        tx = max(txs)
-        for offset in xrange(0, len(tx._mrna), 3):
-            codon = tx._mrna[offset:offset + 3]
-            for frame, alt in SYN_MUTATIONS[codon]:
-                ref = codon[frame]
-                if tx.strand() == '-':
-                    ref = COMPLEMENT[ref]
-                    alt = COMPLEMENT[alt]
-
-                pos = tx.project_from_cds(offset+frame)
-                print '\t'.join([tx.chrom(), str(pos), '.', ref, alt, 
-                                 gene, tx.tx()])
-
-def filter_variants(genes, filename, protein_coords=False):
-    # Do chromosomal binning to efficiently lookup overlapping transcripts
-    n_bins = 2048
-    tx_locations = defaultdict(lambda: defaultdict(list))
-    for gene, txs in genes.iteritems():
-        for tx in txs:
-            assert tx.gene() == gene
-            start = tx._cds_start + 1
-            end = tx._cds_end
-            i = int(start / n_bins)
-            j = int(end / n_bins)
-            for bin in xrange(i, j+1):
-                tx_locations[tx.chrom()][bin].append((start, end, tx))
-
-    def find_overlapping_transcripts(chrom, pos):
-        bin = int(pos / n_bins)
-        txs = tx_locations[chrom][bin]
-        return [tx for (start, end, tx) in txs if start <= pos <= end]
-            
-    fields = ['chrom', 'pos', 'id', 'ref', 'alt', 'gene', 'tx']
-    print '#%s' % '\t'.join(fields)
-    n_total = 0
-    n_kept = 0
+    # Streamed from the catalog and database arrays: no transcript is loaded
+    catalog = genes.catalog()
+    db = genes.db
+    for gene, ids in db.gene_index().iteritems():
+        # Longest transcript
+        i = max(ids, key=lambda i: db.tx_end[i] - db.tx_start[i])
+        sites = catalog.sites(i)
+        refs = ''.join(sites['ref'].tolist())
+        alts = ''.join(sites['alt'].tolist())
+        if db.strand[i] == '-':
+            refs = refs.translate(COMPLEMENT_TAB)
+            alts = alts.translate(COMPLEMENT_TAB)
+
+        chrom = str(db.chrom[i])
+        tx = str(db.tx[i])
+        for pos, ref, alt in izip(sites['pos'].tolist(), refs, alts):
+            print '\t'.join([chrom, str(pos), '.', ref, alt, gene, tx])
+
+def iter_variant_lines(filename):
+    """Yield stripped, non-empty, non-comment lines of filename"""
     with maybe_gzip_open(filename) as ifp:
         for line in ifp:
             line = line.rstrip()
             if not line or line.startswith('#'): continue
-            n_total += 1
-
-            tokens = line.split()
-            if protein_coords:
-                gene, codon, aa, mut = tokens[:4]
-                rest = tokens[1:]
-                match = get_transcript_from_protein(genes, gene, codon, 
-                                                    aa, mut)
-                if match is None:
-                    tx = None
-                else:
-                    (tx, chrom, pos, ref, alt) = match
-                    id = '.'
-            else:
-                chrom, pos, id, ref, alts = tokens[:5]
-                rest = tokens[5:]
-                chrom = chrom[3:] if chrom.startswith('chr') else chrom
-                alt = alts.split(',')[0]
-                # Only process SNVs
-                ref = ref.strip()
-                alt = alt.strip()
-                if len(ref) != 1 or len(alt) != 1:
-                    logging.debug('Dropping non-SNP line: %s' % line)
-                    continue
-
-                pos = int(pos)
-                txs = []
-                for tx in find_overlapping_transcripts(chrom, pos):
-                    try:
-                        if tx.is_synonymous(pos, ref, alt):
-                            txs.append(tx)
-                    except AssertionError:
-                        continue
-
-                tx = max(txs) if txs else None  # Take longest valid transcript
-
-            if not tx:
-                logging.debug('Variant is not synonymous on any transcript: %s' % line)
+            yield line
+
+def iter_chunks(iterable, size=CHUNK_SIZE):
+    """Yield lists of up to size consecutive items of iterable"""
+    iterable = iter(iterable)
+    while True:
+        chunk = list(islice(iterable, size))
+        if not chunk:
+            break
+        yield chunk
+
+def filter_chunk(genes, lines, protein_coords=False):
+    """Return output tokens for each synonymous variant in lines
+
+    Overlapping transcripts are found with one batch query per chromosome,
+    and protein coordinates are resolved in one batch.
+    """
+    entries = []
+    queries = defaultdict(list)  # chrom -> [entry index]
+    protein_queries = []  # [entry index]
+    for line in lines:
+        tokens = line.split()
+        if protein_coords:
+            protein_queries.append(len(entries))
+            entries.append((line, None))
+        else:
+            chrom, pos, id, ref, alts = tokens[:5]
+            rest = tokens[5:]
+            chrom = chrom[3:] if chrom.startswith('chr') else chrom
+            alt = alts.split(',')[0]
+            # Only process SNVs
+            ref = ref.strip()
+            alt = alt.strip()
+            if len(ref) != 1 or len(alt) != 1:
+                logging.debug('Dropping non-SNP line: %s' % line)
                 continue
 
-            n_kept += 1
-            print '\t'.join([chrom, str(pos), id, ref, alt, tx.gene(), tx.tx()] + rest)
-
-        logging.info("Found %d synonymous variants (%d dropped)" % \
-              (n_kept, n_total - n_kept))
-
-def annotate_variants(genes, filename):
-    fields = ['chrom', 'pos', 'id', 'ref', 'alt', 'gene', 'tx', 'strand',
-              'codon', 'frame', 'premrna']
-    print '#%s' % '\t'.join(fields)
-    with maybe_gzip_open(filename) as ifp:
-        for line in ifp:
-            line = line.rstrip()
-            if not line or line.startswith('#'): continue
-
-            tokens = line.split()
-            chrom, pos, id, ref, alt, gene_id, tx_id = tokens[:7]
-            chrom = chrom[3:] if chrom.startswith('chr') else chrom
             pos = int(pos)
+            queries[chrom].append(len(entries))
+            entries.append((line, [chrom, pos, id, ref, alt, rest, None]))
+
+    if protein_queries:
+        records = [entries[i][0].split()[:4] for i in protein_queries]
+        matches = get_transcripts_from_protein(genes, records)
+        for i, match in izip(protein_queries, matches):
+            if match is not None:
+                line = entries[i][0]
+                rest = line.split()[1:]
+                (tx, chrom, pos, ref, alt) = match
+                entries[i] = (line, (chrom, pos, '.', ref, alt, rest, tx))
+
+    for chrom, indices in queries.iteritems():
+        positions = [entries[i][1][1] for i in indices]
+        overlaps = defaultdict(list)
+        for k, tx_index in izip(*genes.index.query_batch(chrom, positions)):
+            overlaps[indices[k]].append(tx_index)
+
+        for i in indices:
+            chrom, pos, id, ref, alt, rest, tx = entries[i][1]
+            txs = []
+            for tx in genes.transcripts(overlaps[i]):
+                try:
+                    if tx.is_synonymous(pos, ref, alt):
+                        txs.append(tx)
+                except AssertionError:
+                    continue
 
-            tx = get_transcript(genes, pos, ref, alt, gene_id, tx_id)
-            if not tx:
-                logging.warning('Transcript not found for variant: %s' % line)
-                continue
+            # Take longest valid transcript
+            entries[i][1][-1] = max(txs, key=len) if txs else None
+
+    rows = []
+    for line, entry in entries:
+        if entry is None or not entry[-1]:
+            logging.debug('Variant is not synonymous on any transcript: %s' % line)
+            continue
+
+        chrom, pos, id, ref, alt, rest, tx = entry
+        rows.append([chrom, str(pos), id, ref, alt, tx.gene(), tx.tx()] + rest)
+
+    return rows
+
+# Genes of each worker process (see init_worker)
+_worker_genes = None
+
+def init_worker(db_dirname):
+    """Open the (read-only, memory-mapped) transcript database in a worker"""
+    global _worker_genes
+    _worker_genes = Genes(TranscriptDB(db_dirname))
+
+def _run_shard(args):
+    func, lines, kwargs = args
+    return func(_worker_genes, lines, **kwargs)
+
+def map_shards(genes, func, shards, n_jobs=1, **kwargs):
+    """Yield func(genes, shard, **kwargs) for each shard (list of lines), in
+    order, running on n_jobs processes if there is more than one shard"""
+    shards = iter(shards)
+    first = list(islice(shards, 2))
+    shards = chain(first, shards)
+    if n_jobs > 1 and len(first) > 1:
+        return imap_ordered(_run_shard,
+                            ((func, lines, kwargs) for lines in shards),
+                            n_jobs=n_jobs, initializer=init_worker,
+                            initargs=(genes.db.dirname,))
+    else:
+        return (func(genes, lines, **kwargs) for lines in shards)
 
-            # Get codon, frame, and mrna
-            cds_offset = tx.project_to_cds(pos)
-            aa_pos = int(cds_offset / 3) + 1
-            codon = tx.get_codon(aa_pos)
-            frame = cds_offset % 3
+def filter_shard(genes, lines, protein_coords=False):
+    """Return (number of lines, filter_chunk rows)"""
+    return len(lines), filter_chunk(genes, lines,
+                                    protein_coords=protein_coords)
 
-            mut_str = tx.mutation_str(pos, ref, alt)
-            print '\t'.join([chrom, str(pos), id, ref, alt, tx.gene(), tx.tx(),
-                              tx.strand(), codon, str(frame), mut_str] + tokens[7:])
+FILTER_FIELDS = ['chrom', 'pos', 'id', 'ref', 'alt', 'gene', 'tx']
+
+def filter_variants(genes, filename, protein_coords=False, n_jobs=1):
+    print '#%s' % '\t'.join(FILTER_FIELDS)
+    n_total = 0
+    n_kept = 0
+    shards = iter_chunks(iter_variant_lines(filename))
+    for n_lines, rows in map_shards(genes, filter_shard, shards, n_jobs,
+                                    protein_coords=protein_coords):
+        n_total += n_lines
+        n_kept += len(rows)
+        for row in rows:
+            print '\t'.join(row)
+
+    logging.info("Found %d synonymous variants (%d dropped)" % \
+          (n_kept, n_total - n_kept))
+
+ANNOTATE_FIELDS = ['chrom', 'pos', 'id', 'ref', 'alt', 'gene', 'tx', 'strand',
+                   'codon', 'frame', 'premrna']
+# Fields with --context
+CONTEXT_FIELDS = ANNOTATE_FIELDS[:-1] + ['context']
+
+def annotate_tokens(genes, tokens, context=False):
+    """Return output tokens for a filtered variant, or None if not found
+
+    If context, the last field is the mutation context (see
+    Transcript.mutation_context) instead of the full pre-mRNA.
+    """
+    chrom, pos, id, ref, alt, gene_id, tx_id = tokens[:7]
+    chrom = chrom[3:] if chrom.startswith('chr') else chrom
+    pos = int(pos)
+
+    tx = get_transcript(genes, chrom, pos, ref, alt, gene_id, tx_id)
+    if not tx:
+        logging.warning('Transcript not found for variant: %s' % \
+                            '\t'.join(tokens))
+        return None
+
+    # Get codon, frame, and mrna
+    cds_offset = tx.project_to_cds(pos)
+    aa_pos = int(cds_offset / 3) + 1
+    codon = tx.get_codon(aa_pos)
+    frame = cds_offset % 3
+
+    if context:
+        mut_str = tx.mutation_context(pos, ref, alt)
+    else:
+        mut_str = tx.mutation_str(pos, ref, alt)
+    return [chrom, str(pos), id, ref, alt, tx.gene(), tx.tx(),
+            tx.strand(), codon, str(frame), mut_str] + tokens[7:]
+
+def annotate_shard(genes, lines, context=False):
+    """Return annotate_tokens rows for lines, skipping any not found"""
+    rows = [annotate_tokens(genes, line.split(), context=context)
+            for line in lines]
+    return [row for row in rows if row is not None]
+
+def annotate_variants(genes, filename, context=False, n_jobs=1):
+    fields = CONTEXT_FIELDS if context else ANNOTATE_FIELDS
+    print '#%s' % '\t'.join(fields)
+    shards = iter_chunks(iter_variant_lines(filename))
+    for rows in map_shards(genes, annotate_shard, shards, n_jobs,
+                           context=context):
+        for row in rows:
+            print '\t'.join(row)
 
 
 
 def script(action, filename, protein_coords=False, genome_filename=None,
            all=False, random=False, match_cpg=False, avoid_splice=False,
+           replicates=1, seed=None, output=None, context=False, n_jobs=1,
            **kwargs):
     genes = get_genes(genome_filename=genome_filename, **kwargs)
 
     if action == 'generate':
         if random:
             random_controls(genes, filename, match_cpg=match_cpg, 
-                            avoid_splice=avoid_splice)
+                            avoid_splice=avoid_splice, replicates=replicates,
+                            seed=seed, output=output)
         elif all:
             print_all_synonymous(genes)
         else:
             raise NotImplementedError()
     elif action == 'filter':
-        filter_variants(genes, filename, protein_coords=protein_coords)
+        filter_variants(genes, filename, protein_coords=protein_coords,
+                        n_jobs=n_jobs)
     elif action == 'annotate':
-        annotate_variants(genes, filename)
+        annotate_variants(genes, filename, context=context, n_jobs=n_jobs)
     else:
         raise NotImplementedError()
 
@@ -721,6 +1207,34 @@ def run_tests():
         def __getitem__(self, val):
             return seq(self.value[val])
 
+    def check_batch_projections(t):
+        positions = range(t._tx_start - 1, t._tx_end + 3)
+        expected = []
+        for pos in positions:
+            try:
+                offset = t.project_to_cds(pos)
+            except AssertionError:
+                offset = None
+            expected.append(-1 if offset is None else offset)
+        assert t.project_to_cds_batch(positions).tolist() == expected
+        offsets = range(len(t.cds()))
+        assert t.project_from_cds_batch(offsets).tolist() == \
+            [t.project_from_cds(offset) for offset in offsets]
+
+    def check_context(t):
+        for offset in range(len(t.cds())):
+            ref = t.cds()[offset]
+            alt = 'A' if ref != 'A' else 'C'
+            if t.strand() == '-':
+                ref, alt = COMPLEMENT[ref], COMPLEMENT[alt]
+            pos = t.project_from_cds(offset)
+            seq = t.mutation_str(pos, ref, alt)
+            context = dict([item.split('=', 1) for item in
+                            t.mutation_context(pos, ref, alt).split(';')])
+            assert context['exon'] in seq.split('|')
+            assert context['premrna'] in seq.replace('|', '')
+            assert context['mrna'] in ''.join(seq.split('|')[::2])
+
     t1 = Transcript('name1', 'tx1', 'chr1', 1, 23, '+', 3, 22,
                     [1, 11], [10, 23], 
                     seq=seq('CAAATGCCCTATTCCCCCCTAATCCCC'))
@@ -756,6 +1270,8 @@ def run_tests():
     for i in range(len(t1)):
         r = t1.project_to_premrna(t1.project_from_premrna(i))
         assert r == i, "Inconsistent premrna translation for offset: %d" % i
+    check_batch_projections(t1)
+    check_context(t1)
 
     # MINUS STRAND!
     t1 = Transcript('name1', 'tx1', 'chr1', 1, 23, '-', 3, 22,
@@ -764,10 +1280,19 @@ def run_tests():
     #                         uueeeeeeeeeeeieeeeeeeu
     print t1
     print t1.__dict__
+    sites = synonymous_sites(t1)
     for i in range(20):
-        site = random_synonymous_site(t1, cpg=None, avoid_splice=True)
+        site = random_synonymous_site(sites, cpg=None, avoid_splice=True)
         print site
 
+    for offset, pos, ref, alt in zip(sites['offset'], sites['pos'],
+                                     sites['ref'], sites['alt']):
+        assert t1.project_from_cds(offset) == pos
+        assert t1.cds()[offset] == ref
+        assert t1.is_synonymous(pos, COMPLEMENT[ref], COMPLEMENT[alt])
+    assert len(sites['offset']) == \
+        sum([len(SYN_MUTATIONS[t1.get_codon(aa)]) for aa in range(1, 7)])
+
     assert t1.get_codon(1) == 'ATG'
     assert t1.get_codon(3) == 'TTT'
     assert t1.get_codon(6) == 'TAA'
@@ -797,6 +1322,8 @@ def run_tests():
     for i in range(len(t1)):
         r = t1.project_to_premrna(t1.project_from_premrna(i))
         assert r == i, "Inconsistent premrna translation for offset: %d" % i
+    check_batch_projections(t1)
+    check_context(t1)
 
 def parse_args(args):
     from optparse import OptionParser
@@ -832,6 +1359,29 @@ def parse_args(args):
                       dest="avoid_splice", default=False,
                       help="Random variants will not be within 3bp of"
                       " annotated splice sites.")
+    parser.add_option("--replicates", metavar="N", type="int",
+                      dest="replicates", default=1,
+                      help="Generate N independent sets of random variants"
+                      " (default: %default)")
+    parser.add_option("--seed", metavar="INT", type="int",
+                      dest="seed", default=None,
+                      help="Seed for random variants (default: random, and"
+                      " printed to stderr)")
+    parser.add_option("--output", metavar="PATTERN",
+                      dest="output", default=None,
+                      help="Write set r of random variants to the file"
+                      " PATTERN % r (e.g. 'controls.%d.vcf'), instead of"
+                      " stdout. Required with --replicates > 1.")
+    parser.add_option("--context", action="store_true",
+                      dest="context", default=False,
+                      help="If ACTION is 'annotate', print only the context"
+                      " of each mutation used by the features, instead of"
+                      " the full pre-mRNA")
+    parser.add_option("-j", "--jobs", metavar="N", type="int",
+                      dest="n_jobs",
+                      default=int(os.getenv('SILVA_N_THREADS', 1)),
+                      help="Filter or annotate with N processes"
+                      " (default: %default)")
     parser.add_option("--test", action="store_true", dest="run_tests")
     options, args = parser.parse_args()
 
@@ -841,6 +1391,18 @@ def parse_args(args):
     if len(args) != 2:
         parser.error("Inappropriate number of arguments")
 
+    if options.replicates < 1:
+        parser.error("--replicates must be at least 1")
+    if options.output is None:
+        if options.replicates > 1:
+            parser.error("--output is required with --replicates > 1")
+    else:
+        try:
+            options.output % 0
+        except (TypeError, ValueError):
+            parser.error("--output must contain a replicate format"
+                         " (e.g. %%d): %s" % options.output)
+
     return options, args
 
 def main(args=sys.argv[1:]):
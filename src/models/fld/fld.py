@@ -22,6 +22,7 @@ from numpy.linalg import inv
 
 sys.path.insert(0, os.path.expandvars("$SILVA_PATH/lib/python"))
 from silva import maybe_gzip_open
+from silva.matrix import is_smat, load
 
 
 __version__ = 4
@@ -31,8 +32,12 @@ FALSE = 0
 
 def load_data(vector_filename, log=sys.stderr):
     print >>log, "Loading vector data from file: %s" % vector_filename
-    with maybe_gzip_open(vector_filename) as ifp:
-        data = loadtxt(ifp, dtype=float)
+    if vector_filename != '-' and not vector_filename.endswith('.gz') \
+            and is_smat(vector_filename):
+        columns, data = load(vector_filename)
+    else:
+        with maybe_gzip_open(vector_filename) as ifp:
+            data = loadtxt(ifp, dtype=float)
 
     # Pop solution column
     solutions = data[:, 0]
@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+
+"""
+Score the examples in TESTFILE (.input or .smat) with a random forest
+exported from R by the 'export' script (FOREST is the export directory).
+
+Prints the fraction of trees voting for the second class and the class
+column of each example, as the 'test' script does with
+predict(rf, type='vote', norm.votes=TRUE), but without starting R or
+loading the saved model. Trees are traversed for all examples at once,
+a batch of trees at a time, across a pool of threads.
+"""
+
+# Author: Orion Buske
+# Date:   ...
+from __future__ import division, with_statement
+
+import os
+import re
+import sys
+
+from math import floor, log10
+from hashlib import md5
+from multiprocessing.pool import ThreadPool
+from numpy import asarray, arange, zeros, where, flatnonzero, bincount, \
+    repeat, column_stack, ascontiguousarray, int32, float64
+
+assert os.getenv('SILVA_PATH') is not None, \
+    "Error: SILVA_PATH is unset."
+sys.path.insert(0, os.path.expandvars('$SILVA_PATH/lib/python'))
+from silva import matrix
+
+# Traversals done at once (examples * trees per batch), small enough for
+# the working arrays to stay in cache
+BATCH_SIZE = 1 << 17
+
+
+class Forest(object):
+    """Random forest classifier, as flat arrays over the nodes of all trees
+
+    Node i splits on column feature[i] of the data (going to left[i] if
+    the value is <= threshold[i], and to right[i] otherwise), or is a leaf
+    (feature[i] == -1) predicting class index prediction[i].
+    """
+    def __init__(self, features, classes, roots, feature, threshold,
+                 left, right, prediction):
+        self.features = features
+        self.classes = classes
+        self.roots = roots
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.prediction = prediction
+        # Children of node i: right at 2*i, left at 2*i + 1, so the next
+        # node is branches[2 * i + (value <= threshold[i])]
+        self._branches = column_stack([right, left]).ravel()
+
+    @classmethod
+    def load(cls, dirname):
+        """Load forest exported to dirname"""
+        def read_lines(filename):
+            with open(os.path.join(dirname, filename)) as ifp:
+                return [line.strip() for line in ifp if line.strip()]
+
+        features = read_lines('features.txt')
+        classes = read_lines('classes.txt')
+        columns, nodes = matrix.load(os.path.join(dirname, 'nodes.smat'))
+        nodes = dict(zip(columns, asarray(nodes).T))
+
+        # Nodes of each tree are numbered from 1, and the trees are in order
+        tree = nodes['tree'].astype(int32)
+        starts = flatnonzero(tree[1:] != tree[:-1]) + 1
+        roots = zeros(len(starts) + 1, dtype=int32)
+        roots[1:] = starts
+        offsets = repeat(roots, bincount(tree - tree[0]))
+        is_leaf = nodes['status'] == -1
+
+        feature = where(is_leaf, -1, nodes['var'] - 1).astype(int32)
+        left = where(is_leaf, -1, offsets + nodes['left'] - 1).astype(int32)
+        right = where(is_leaf, -1, offsets + nodes['right'] - 1).astype(int32)
+        prediction = where(is_leaf, nodes['prediction'] - 1, -1).astype(int32)
+        return cls(features, classes, roots, feature,
+                   nodes['threshold'].astype(float64), left, right,
+                   prediction)
+
+    def __len__(self):
+        """Return number of trees"""
+        return len(self.roots)
+
+    def leaves(self, data, trees):
+        """Return (examples * trees) array of the leaf reached by each row
+        of data (ordered as self.features) in each of trees"""
+        n_trees = len(trees)
+        values = data.ravel()
+        node = self.roots[asarray(trees)][None, :].repeat(len(data),
+                                                          axis=0).ravel()
+        leaves = node.copy()
+        # Traversals not yet at a leaf, their nodes, and the offsets of
+        # their rows in values
+        index = arange(len(node))
+        offset = (index // n_trees) * data.shape[1]
+        while len(index):
+            feature = self.feature[node]
+            done = feature < 0
+            if done.any():
+                leaves[index[done]] = node[done]
+                keep = ~done
+                index = index[keep]
+                node = node[keep]
+                offset = offset[keep]
+                feature = feature[keep]
+
+            go_left = values[offset + feature] <= self.threshold[node]
+            node = self._branches[2 * node + go_left]
+
+        return leaves
+
+    def count_votes(self, data, trees):
+        """Return (examples, classes) array of the votes of trees"""
+        n_classes = len(self.classes)
+        leaves = self.leaves(data, trees)
+        rows = arange(len(data)).repeat(len(trees))
+        votes = bincount(rows * n_classes + self.prediction[leaves],
+                         minlength=len(data) * n_classes)
+        return votes.reshape((len(data), n_classes))
+
+    def votes(self, data, n_threads=1, batch_size=BATCH_SIZE):
+        """Return (examples, classes) array of the fraction of trees voting
+        for each class, for each row of data (ordered as self.features)
+
+        Each thread traverses a batch of trees for all rows, visiting about
+        batch_size leaves.
+        """
+        data = ascontiguousarray(data, dtype=float64)
+        votes = zeros((len(data), len(self.classes)))
+        if not len(data):
+            return votes
+
+        trees_per_batch = max(1, batch_size // len(data))
+        batches = [arange(start, min(start + trees_per_batch, len(self)))
+                   for start in xrange(0, len(self), trees_per_batch)]
+        pool = ThreadPool(max(1, n_threads))
+        try:
+            for counts in pool.imap_unordered(
+                lambda trees: self.count_votes(data, trees), batches):
+                votes += counts
+        finally:
+            pool.close()
+            pool.join()
+
+        return votes / len(self)
+
+
+def make_names(names):
+    """Return names as R's make.names(names, unique=TRUE) would"""
+    valid = []
+    for name in names:
+        if not re.match(r'[A-Za-z]|\.(?![0-9])', name):
+            name = 'X' + name
+        valid.append(re.sub(r'[^A-Za-z0-9._]', '.', name))
+
+    # As make.unique: append .1, .2, ... to repeated names
+    seen = set(valid)
+    counts = {}
+    unique = []
+    for i, name in enumerate(valid):
+        if name in valid[:i]:
+            count = counts.get(name, 0)
+            while True:
+                count += 1
+                new_name = '%s.%d' % (name, count)
+                if new_name not in seen:
+                    break
+            counts[name] = count
+            seen.add(new_name)
+            name = new_name
+        unique.append(name)
+
+    return unique
+
+def _scientific(x, digits):
+    """Return (exponent, significant digits) of x, as R formats it with
+    at most digits significant digits"""
+    if x == 0:
+        return 0, 1
+    r = abs(x)
+    kp = int(floor(log10(r)))
+    if kp >= 0:
+        alpha = r / 10.0 ** kp
+    else:
+        alpha = r * 10.0 ** -kp
+    alpha = int(round(alpha * 10 ** (digits - 1)))
+    if alpha >= 10 ** digits:
+        alpha //= 10
+        kp += 1
+    nsig = digits
+    while nsig > 1 and alpha % 10 == 0:
+        alpha //= 10
+        nsig -= 1
+    return kp, nsig
+
+def format_r(values, digits):
+    """Return values formatted as R's format(values, digits=digits): with
+    a common number of decimals (or in scientific notation, if narrower),
+    padded to a common width"""
+    values = [float(x) for x in values]
+    if not values:
+        return []
+    neg = int(min(values) < 0)
+    mxsl = rgt = mxns = 0
+    mxe = mne = 0
+    for x in values:
+        kp, nsig = _scientific(x, digits)
+        left = kp + 1
+        mxsl = max(mxsl, int(x < 0) + max(left, 1))
+        rgt = max(rgt, nsig - left)
+        mxns = max(mxns, nsig)
+        mxe = max(mxe, kp)
+        mne = min(mne, kp)
+
+    e = 2 if mxe >= 100 or mne <= -100 else 1
+    d = mxns - 1
+    width = neg + (d > 0) + d + 4 + e
+    fixed_width = mxsl + rgt + (rgt > 0)
+    if fixed_width <= width:
+        return ['%*.*f' % (fixed_width, rgt, x) for x in values]
+    else:
+        return ['%*.*e' % (width, d, x) for x in values]
+
+def file_checksum(filename):
+    """Return hex MD5 digest of the contents of filename"""
+    digest = md5()
+    with open(filename, 'rb') as ifp:
+        for block in iter(lambda: ifp.read(1 << 20), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def is_current_export(modelfile, forest_dirname):
+    """Return whether forest_dirname is an export of modelfile as it is now
+
+    The export records the checksum of the model in model.md5.
+    """
+    try:
+        with open(os.path.join(forest_dirname, 'model.md5')) as ifp:
+            checksum = ifp.read().strip()
+    except IOError:
+        return False
+    return checksum == file_checksum(modelfile)
+
+def score_file(forest, filename, n_threads=1):
+    """Return list of (score, class) strings for the examples in filename,
+    as printed by the 'test' script"""
+    columns, data = matrix.read_matrix(filename)
+    if not columns or columns[0] != 'class':
+        raise ValueError("Expected first column to be class: %s" % filename)
+
+    # Match the columns to the predictors by name, as predict does
+    names = make_names(columns)
+    index = dict([(name, i) for i, name in enumerate(names) if i > 0])
+    missing = [name for name in forest.features if name not in index]
+    if missing:
+        raise ValueError("Features missing from %s: %s"
+                         % (filename, ', '.join(missing)))
+    cols = [index[name] for name in forest.features]
+
+    votes = forest.votes(asarray(data)[:, cols], n_threads=n_threads)
+    return zip(format_r(votes[:, 1], 3), format_r(data[:, 0], 1))
+
+def script(forest_dirname, filename, n_threads=1):
+    forest = Forest.load(forest_dirname)
+    for score, cls in score_file(forest, filename, n_threads=n_threads):
+        print '%s\t%s' % (score, cls)
+
+def run_tests():
+    from numpy import array
+    from numpy.random import RandomState
+
+    def build_tree(random, n_features, depth):
+        """Return random tree as getTree rows: left, right, var,
+        threshold, status, prediction"""
+        rows = []
+        def add(depth):
+            i = len(rows)
+            rows.append(None)
+            if depth == 0 or random.random_sample() < 0.2:
+                rows[i] = [0, 0, 0, 0, -1, random.randint(1, 3)]
+            else:
+                var = random.randint(1, n_features + 1)
+                threshold = round(random.normal(), 1)
+                left = add(depth - 1)
+                right = add(depth - 1)
+                rows[i] = [left + 1, right + 1, var, threshold, 1, 0]
+            return i
+        add(depth)
+        return rows
+
+    def predict(tree, row):
+        node = 0
+        while tree[node][4] != -1:
+            left, right, var, threshold = tree[node][:4]
+            node = (left if row[var - 1] <= threshold else right) - 1
+        return tree[node][5] - 1
+
+    random = RandomState(0)
+    n_features = 4
+    trees = [build_tree(random, n_features, 6) for i in xrange(25)]
+    nodes = array([[k + 1] + row
+                   for k, tree in enumerate(trees) for row in tree])
+    data = random.normal(size=(50, n_features)).round(1)
+    expected = zeros((len(data), 2))
+    for tree in trees:
+        for i, row in enumerate(data):
+            expected[i, predict(tree, row)] += 1
+    expected /= len(trees)
+
+    import shutil
+    import tempfile
+    tmpdir = tempfile.mkdtemp()
+    try:
+        with matrix.MatrixWriter(os.path.join(tmpdir, 'nodes.smat'),
+                                 ['tree', 'left', 'right', 'var',
+                                  'threshold', 'status',
+                                  'prediction']) as writer:
+            writer.write(nodes)
+        for filename, lines in [('features.txt', ['a', 'b', 'c', 'd']),
+                                ('classes.txt', ['0', '1'])]:
+            with open(os.path.join(tmpdir, filename), 'w') as ofp:
+                ofp.write('\n'.join(lines) + '\n')
+        forest = Forest.load(tmpdir)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    assert len(forest) == len(trees)
+    for batch_size in [1, 120, BATCH_SIZE]:
+        for n_threads in [1, 3]:
+            votes = forest.votes(data, n_threads=n_threads,
+                                 batch_size=batch_size)
+            assert (votes == expected).all()
+
+    assert make_names(['#class', 'GERP++', 'CpG?', 'MES', '2x', 'MES',
+                       'MES.1']) == \
+        ['X.class', 'GERP..', 'CpG.', 'MES', 'X2x', 'MES.2', 'MES.1']
+    assert format_r([0, 0.5, 0.123456], 3) == ['0.000', '0.500', '0.123']
+    assert format_r([0.0015, 0.5], 3) == ['0.0015', '0.5000']
+    assert format_r([0.00049975, 0.5], 3) == ['5e-04', '5e-01']
+    assert format_r([0, 1], 3) == ['0', '1']
+    assert format_r([0.0000123], 3) == ['1.23e-05']
+    assert format_r([0, 1, 0], 1) == ['0', '1', '0']
+    print >>sys.stderr, "All tests passed"
+
+def parse_args(args):
+    from optparse import OptionParser
+    usage = "usage: %prog [options] FOREST TESTFILE"
+    description = __doc__.strip()
+
+    parser = OptionParser(usage=usage,
+                          description=description)
+    parser.add_option("-j", "--threads", metavar="N", type="int",
+                      dest="n_threads",
+                      default=int(os.getenv('SILVA_N_THREADS', 1)),
+                      help="Traverse trees with N threads (default:"
+                      " %default)")
+    parser.add_option("--test", action="store_true", dest="run_tests")
+    options, args = parser.parse_args()
+
+    if options.run_tests:
+        sys.exit(run_tests())
+
+    if len(args) != 2:
+        parser.error("Inappropriate number of arguments")
+
+    return options, args
+
+def main(args=sys.argv[1:]):
+    options, args = parse_args(args)
+    kwargs = dict(options.__dict__)
+    del kwargs['run_tests']
+
+    script(*args, **kwargs)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+"""
+Score every BASE.input in each OUTDIR (created with silva-preprocess)
+with every trained model in MODELDIR/*.model, creating
+OUTDIR/BASE.MODEL.scored (the score of each example, one per line).
+
+Models are run concurrently, each in its own process, and each is
+loaded once and applied to all the inputs, so its loading cost is shared
+by the whole batch. Models exported with the 'export' script (to
+MODELDIR/MODEL.forest) are scored by forest.py, others (or those
+changed since their export) are exported first if MODELDIR is writable,
+and the rest are scored by the R 'test' script. Existing score files are
+not overwritten.
+"""
+
+# Author: Orion Buske
+# Date:   ...
+from __future__ import division, with_statement
+
+import os
+import sys
+import logging
+import subprocess
+
+from glob import glob
+
+assert os.getenv('SILVA_PATH') is not None, \
+    "Error: SILVA_PATH is unset."
+sys.path.insert(0, os.path.expandvars('$SILVA_PATH/lib/python'))
+from silva.parallel import imap_ordered
+
+import forest as _forest
+
+LOG_LEVEL = os.getenv('SILVA_LOG_LEVEL', 'INFO')
+MODEL_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def find_inputs(outdirs):
+    """Return list of (outdir, base, testfile) for each input in outdirs
+
+    testfile is BASE.smat if it exists, else BASE.input.
+    """
+    inputs = []
+    for outdir in outdirs:
+        filenames = sorted(glob(os.path.join(outdir, '*.input')))
+        if not filenames:
+            raise ValueError("Expected .input file in %s. Was"
+                             " silva-preprocess successful?" % outdir)
+        for filename in filenames:
+            base = os.path.basename(filename)[:-len('.input')]
+            for ext in ['flt', 'input']:
+                required = os.path.join(outdir, '%s.%s' % (base, ext))
+                if not os.path.isfile(required) or \
+                        not os.path.getsize(required):
+                    raise ValueError("Expected %s file in %s. Was"
+                                     " silva-preprocess successful?"
+                                     % (os.path.basename(required), outdir))
+
+            testfile = filename
+            smat = os.path.join(outdir, '%s.smat' % base)
+            if os.path.isfile(smat) and os.path.getsize(smat):
+                testfile = smat
+            inputs.append((outdir, base, testfile))
+
+    return inputs
+
+def score_filename(outdir, base, model):
+    return os.path.join(outdir, '%s.%s.scored' % (base, model))
+
+def write_scores(filename, scores):
+    """Write the scores (strings) to filename, atomically"""
+    tmp_filename = '%s.tmp%d' % (filename, os.getpid())
+    with open(tmp_filename, 'w') as ofp:
+        for score in scores:
+            print >>ofp, score
+    os.rename(tmp_filename, filename)
+
+def export_model(modelfile, forest_dirname):
+    """Try to export modelfile to forest_dirname, returning success"""
+    logging.info("Exporting model: %s" % modelfile)
+    try:
+        subprocess.check_call([os.path.join(MODEL_DIR, 'export'),
+                               modelfile, forest_dirname])
+    except (OSError, subprocess.CalledProcessError), e:
+        logging.warning("Could not export %s (%s), using R"
+                        % (modelfile, e))
+        return False
+    return True
+
+def run_model(job):
+    """Score (testfile, scorefile) pairs with modelfile"""
+    modelfile, pairs, n_threads = job
+    forest_dirname = os.path.splitext(modelfile)[0] + '.forest'
+    exported = _forest.is_current_export(modelfile, forest_dirname)
+    if not exported:
+        if os.path.isdir(forest_dirname):
+            logging.info("Ignoring stale export of changed model: %s"
+                         % modelfile)
+        if os.access(os.path.dirname(modelfile), os.W_OK):
+            exported = export_model(modelfile, forest_dirname)
+
+    if exported:
+        forest = _forest.Forest.load(forest_dirname)
+        for testfile, scorefile in pairs:
+            rows = _forest.score_file(forest, testfile, n_threads=n_threads)
+            write_scores(scorefile, [score for score, cls in rows])
+    else:
+        # Score all files with one R process, keeping just the scores
+        tmp_filenames = ['%s.tmp%d.txt' % (scorefile, os.getpid())
+                         for testfile, scorefile in pairs]
+        args = [os.path.join(MODEL_DIR, 'test'), modelfile]
+        for (testfile, scorefile), tmp_filename in zip(pairs, tmp_filenames):
+            args.extend([testfile, tmp_filename])
+        subprocess.check_call(args)
+        for (testfile, scorefile), tmp_filename in zip(pairs, tmp_filenames):
+            with open(tmp_filename) as ifp:
+                write_scores(scorefile, [line.split('\t')[0].strip()
+                                         for line in ifp])
+            os.remove(tmp_filename)
+
+    return modelfile, len(pairs)
+
+def script(modeldir, outdirs, n_threads=1):
+    modelfiles = sorted(glob(os.path.join(modeldir, '*.model')))
+    if not modelfiles:
+        raise ValueError("Could not find saved models: %s/*.model"
+                         % modeldir)
+    for modelfile in modelfiles:
+        if not os.path.getsize(modelfile):
+            raise ValueError("Empty saved model: %s" % modelfile)
+
+    inputs = find_inputs(outdirs)
+    jobs = []
+    for modelfile in modelfiles:
+        model = os.path.basename(modelfile)[:-len('.model')]
+        pairs = []
+        for outdir, base, testfile in inputs:
+            scorefile = score_filename(outdir, base, model)
+            if not os.path.isfile(scorefile) or \
+                    not os.path.getsize(scorefile):
+                pairs.append((testfile, scorefile))
+        if pairs:
+            jobs.append((modelfile, pairs))
+
+    # Models run concurrently, sharing the threads; each splits any spare
+    # threads among its trees
+    n_jobs = max(1, min(n_threads, len(jobs)))
+    jobs = [(modelfile, pairs, max(1, n_threads // n_jobs))
+            for modelfile, pairs in jobs]
+    for modelfile, n_scored in imap_ordered(run_model, jobs, n_jobs=n_jobs):
+        logging.info("Scored %d inputs with model: %s"
+                     % (n_scored, os.path.basename(modelfile)))
+
+def parse_args(args):
+    from optparse import OptionParser
+    usage = "usage: %prog [options] MODELDIR OUTDIR..."
+    description = __doc__.strip()
+
+    parser = OptionParser(usage=usage,
+                          description=description)
+    parser.add_option("-j", "--threads", metavar="N", type="int",
+                      dest="n_threads",
+                      default=int(os.getenv('SILVA_N_THREADS', 1)),
+                      help="Run up to N models at once (default: %default)")
+    options, args = parser.parse_args()
+
+    if len(args) < 2:
+        parser.error("Inappropriate number of arguments")
+
+    return options, args
+
+def main(args=sys.argv[1:]):
+    options, args = parse_args(args)
+    logging.basicConfig(level=LOG_LEVEL)
+
+    script(args[0], args[1:], n_threads=options.n_threads)
+
+if __name__ == '__main__':
+    sys.exit(main())
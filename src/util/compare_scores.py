@@ -9,44 +9,22 @@ Expects .flt and .scored files in each directory.
 """
 
 
+import os
 import sys
 import signal
 
-from numpy import array, concatenate
+from numpy import array
 from glob import glob
 
+sys.path.insert(0, os.path.expandvars('$SILVA_PATH/lib/python'))
+from silva.ranking import rank_against
+
 args = sys.argv[1:]
 if len(args) != 2:
     print __doc__
     sys.exit(1)
 
 
-# The following two rank functions are used in place of scipy's rankdata,
-# in order to remove scipy as a dependency.
-# http://stackoverflow.com/questions/3071415/efficient-method-to-calculate-the-rank-vector-of-a-list-in-python
-def rank_simple(vector):
-    return sorted(range(len(vector)), key=vector.__getitem__)
-
-def rankdata(a):
-    n = len(a)
-    ivec=rank_simple(a)
-    svec=[a[rank] for rank in ivec]
-    sumranks = 0
-    dupcount = 0
-    newarray = [0]*n
-    for i in xrange(n):
-        sumranks += i
-        dupcount += 1
-        if i==n-1 or svec[i] != svec[i+1]:
-            averank = sumranks / float(dupcount) + 1
-            for j in xrange(i-dupcount+1,i+1):
-                newarray[ivec[j]] = averank
-                
-            sumranks = 0
-            dupcount = 0
-            
-    return newarray
-
 def read_scores(filename):
     scores = []
     with open(filename) as ifp:
@@ -61,12 +39,6 @@ def read_scores(filename):
 
     return array(scores)
 
-def calc_score(case_score, control_scores):
-    combined = concatenate([array([case_score]), control_scores])
-    # Invert data so highest is ranked first
-    ranks = rankdata(-combined)
-    return ranks[0], case_score
-
 
 # Parse arguments
 def find_files(d):
@@ -83,9 +55,9 @@ control, control_scored = find_files(control_dir)
 case_scores = read_scores(case_scored)
 control_scores = read_scores(control_scored)
 
-scores = []
-for row in case_scores:
-    scores.append(calc_score(row, control_scores))
+# Rank of each case variant among the control variants, with the data
+# inverted so highest is ranked first
+scores = zip(rank_against(-case_scores, -control_scores), case_scores)
 
 lines = []
 with open(case) as ifp:
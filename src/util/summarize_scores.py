@@ -1,105 +1,75 @@
 #!/usr/bin/env python
 
 """
-Usage: $0 FILE SCORED...
-
 FILE has variants, one per line.
-Each SCORED file has a score, one per variant in FILE.
+Each SCORED file has a score, one per variant in FILE, or is a binary
+matrix file with the scores in its first column.
 
 Reports ranked, annotated lines.
+
+With --top or --min-score, only the highest-scoring lines are reported
+(with their ranks among all lines). FILE is then streamed, holding just
+the reported lines, so memory use is bounded by their number.
 """
 
 
+import os
 import sys
 import signal
 
-from collections import defaultdict
-from numpy import array, column_stack, median, argsort
+from heapq import heappush, heappushpop
+from numpy import column_stack, argsort, fromstring, flatnonzero, \
+    isnan, zeros
+
+sys.path.insert(0, os.path.expandvars('$SILVA_PATH/lib/python'))
+from silva.matrix import is_smat, load
+from silva.ranking import rankdata, mean_reciprocal_rank
 
 LOW_LABEL = "likely benign"
 MID_LABEL = "potentially pathogenic"
 MID_CUTOFF = 0.28
 HIGH_LABEL = "likely pathogenic"
 HIGH_CUTOFF = 0.48
+# Scores scanned at a time when selecting and ranking the top lines
+CHUNK_SIZE = 1 << 16
 
-# The following two rank functions are used in place of scipy's rankdata,
-# in order to remove scipy as a dependency.
-# http://stackoverflow.com/questions/3071415/efficient-method-to-calculate-the-rank-vector-of-a-list-in-python
-def rank_simple(vector):
-    return sorted(range(len(vector)), key=vector.__getitem__)
-
-def rankdata(a):
-    n = len(a)
-    ivec=rank_simple(a)
-    svec=[a[rank] for rank in ivec]
-    sumranks = 0
-    dupcount = 0
-    newarray = [0]*n
-    for i in xrange(n):
-        sumranks += i
-        dupcount += 1
-        if i==n-1 or svec[i] != svec[i+1]:
-            averank = sumranks / float(dupcount) + 1
-            for j in xrange(i-dupcount+1,i+1):
-                newarray[ivec[j]] = averank
-                
-            sumranks = 0
-            dupcount = 0
-            
-    return newarray
-
-
-args = sys.argv[1:]
-if len(args) < 2:
-    print __doc__
-    sys.exit(1)
 
 def read_scores(filename):
-    scores = []
-    with open(filename) as ifp:
-        scores = [float(line) for line in ifp]
-
-    # Rank the negated scores
-    return array(scores)
-
-file = args[0]
-scored = args[1:]
-
-ranks_list = []
-for filename in scored:
-    scores = read_scores(filename)
-    ranks_list.append(rankdata(-scores))
-    
-ranks = column_stack(ranks_list)
-
-#scores = ranks.shape[1]/(1/ranks).sum(axis=1)  # Harmonic mean rank
-#scores = ranks.mean(axis=1)  # Mean rank
-#Use score if there's only one, else use MRR
-if len(scored) > 1:
-    scores = (1/ranks).sum(axis=1)/ranks.shape[1]  # Mean reciprocal rank
-
-order = argsort(-scores)
-ranks = rankdata(-scores)
-
-lines = []
-with open(file) as ifp:
-    for line in ifp:
-        line = line.strip()
-        # Reorder gene and tx columns to the front, as hack until
-        # internal file formats can be cleaned up
-        tokens = line.lstrip('#').split('\t')
-        tokens = tokens[5:7] + tokens[:5] + tokens[7:]
-        if line.startswith('#'):
-            print "#%s" % '\t'.join(["rank", "score", "class"] + tokens)
-        else:
-            lines.append('\t'.join(tokens))
-
-assert len(lines) == len(order)
+    if is_smat(filename):
+        columns, data = load(filename)
+        return data[:, 0]
 
-# Treat SIGPIPE as Unix would expect
-signal.signal(signal.SIGPIPE, signal.SIG_DFL)
-for i in order:
-    score, rank, line = scores[i], ranks[i], lines[i]
+    with open(filename) as ifp:
+        return fromstring(ifp.read(), dtype=float, sep=' ')
+
+def get_scores(scored):
+    """Return array of the score of each variant: the score itself if there
+    is only one SCORED file, else the mean reciprocal rank across them"""
+    #scores = ranks.shape[1]/(1/ranks).sum(axis=1)  # Harmonic mean rank
+    #scores = ranks.mean(axis=1)  # Mean rank
+    if len(scored) == 1:
+        return read_scores(scored[0])
+
+    ranks = column_stack([rankdata(-read_scores(filename))
+                          for filename in scored])
+    return mean_reciprocal_rank(ranks)
+
+def iter_lines(filename):
+    """Yield (is_header, line) for each line of variant file, with the gene
+    and tx columns moved to the front"""
+    with open(filename) as ifp:
+        for line in ifp:
+            line = line.strip()
+            # Reorder gene and tx columns to the front, as hack until
+            # internal file formats can be cleaned up
+            tokens = line.lstrip('#').split('\t')
+            tokens = tokens[5:7] + tokens[:5] + tokens[7:]
+            yield line.startswith('#'), tokens
+
+def format_header(tokens):
+    return "#%s" % '\t'.join(["rank", "score", "class"] + tokens)
+
+def format_line(rank, score, line):
     cls = LOW_LABEL
     if score >= HIGH_CUTOFF:
         cls = HIGH_LABEL
@@ -108,5 +78,123 @@ for i in order:
 
     rank = '%.1f' % rank
     rank = rank[:-2] if rank.endswith('.0') else rank
-    print '\t'.join([rank, '%.3f' % score, cls, line])
+    return '\t'.join([rank, '%.3f' % score, cls, line])
 
+def print_all(filename, scores):
+    order = argsort(-scores)
+    ranks = rankdata(-scores)
+
+    lines = []
+    for is_header, tokens in iter_lines(filename):
+        if is_header:
+            print format_header(tokens)
+        else:
+            lines.append('\t'.join(tokens))
+
+    assert len(lines) == len(order)
+
+    for i in order:
+        print format_line(ranks[i], scores[i], lines[i])
+
+def select_top(scores, top=None, min_score=None):
+    """Return list of the indices of the top-scoring variants, best first
+
+    Keeps the top scores (ties broken by index) in a heap of at most top
+    entries, and only those at least min_score.
+    """
+    heap = []
+    for start in xrange(0, len(scores), CHUNK_SIZE):
+        chunk = scores[start:start + CHUNK_SIZE]
+        keep = ~isnan(chunk)
+        if min_score is not None:
+            keep &= chunk >= min_score
+        if top is not None and len(heap) == top:
+            # Later variants only displace strictly higher scores
+            keep &= chunk > heap[0][0]
+        for i in flatnonzero(keep):
+            item = (float(chunk[i]), -(start + i))
+            if top is None or len(heap) < top:
+                heappush(heap, item)
+            elif item > heap[0]:
+                heappushpop(heap, item)
+
+    return [-i for score, i in sorted(heap, reverse=True)]
+
+def count_ranks(scores, values):
+    """Return array of the rank of each of values among scores (highest
+    first, with ties given their mean rank), as rankdata(-scores) would"""
+    greater = zeros(len(values))
+    ties = zeros(len(values))
+    for start in xrange(0, len(scores), CHUNK_SIZE):
+        chunk = scores[start:start + CHUNK_SIZE]
+        chunk = chunk[~isnan(chunk)]
+        chunk.sort()
+        below = chunk.searchsorted(values, side='left')
+        above = chunk.searchsorted(values, side='right')
+        greater += len(chunk) - above
+        ties += above - below
+    return greater + (ties + 1) / 2
+
+def print_top(filename, scores, top=None, min_score=None):
+    indices = select_top(scores, top=top, min_score=min_score)
+    values = scores[indices]
+    ranks = count_ranks(scores, values)
+
+    # Stream the variants, keeping just the selected lines
+    wanted = set(indices)
+    lines = {}
+    n_lines = 0
+    for is_header, tokens in iter_lines(filename):
+        if is_header:
+            print format_header(tokens)
+        else:
+            if n_lines in wanted:
+                lines[n_lines] = '\t'.join(tokens)
+            n_lines += 1
+
+    assert n_lines == len(scores)
+
+    for i, rank, score in zip(indices, ranks, values):
+        print format_line(rank, score, lines[i])
+
+def script(filename, scored, top=None, min_score=None):
+    scores = get_scores(scored)
+    # Treat SIGPIPE as Unix would expect
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+    if top is None and min_score is None:
+        print_all(filename, scores)
+    else:
+        print_top(filename, scores, top=top, min_score=min_score)
+
+def parse_args(args):
+    from optparse import OptionParser
+    usage = "usage: %prog [options] FILE SCORED..."
+    description = __doc__.strip()
+
+    parser = OptionParser(usage=usage,
+                          description=description)
+    parser.add_option("-k", "--top", metavar="K", type="int",
+                      dest="top", default=None,
+                      help="Only report the K highest-scoring variants")
+    parser.add_option("-m", "--min-score", metavar="SCORE", type="float",
+                      dest="min_score", default=None,
+                      help="Only report variants scoring at least SCORE"
+                      " (e.g. %s, for all but '%s')" % (MID_CUTOFF,
+                                                        LOW_LABEL))
+    options, args = parser.parse_args()
+
+    if len(args) < 2:
+        parser.error("Inappropriate number of arguments")
+    if options.top is not None and options.top < 1:
+        parser.error("--top must be positive")
+
+    return options, args
+
+def main(args=sys.argv[1:]):
+    options, args = parse_args(args)
+    kwargs = dict(options.__dict__)
+
+    script(args[0], args[1:], **kwargs)
+
+if __name__ == '__main__':
+    sys.exit(main())